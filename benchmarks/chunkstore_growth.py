@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Compare storage growth and ingest time of the content-defined chunk
+store with plain git for many versions of a CSV that changes by a few
+rows per version.
+
+Usage:
+
+    python benchmarks/chunkstore_growth.py [--rows N] [--versions N] [--changes N]
+
+Plain git is measured with loose objects (as left by add/commit) and
+after a final git gc, which is when delta compression happens.
+"""
+
+import os, sys, time, random, shutil, tempfile, subprocess, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dgitcore.datasets.chunkstore import ChunkStore
+
+def du(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+def git(rootdir, *args):
+    subprocess.check_output(['git', '-c', 'user.name=bench',
+                             '-c', 'user.email=bench@example.com'] + list(args),
+                            cwd=rootdir, stderr=subprocess.STDOUT)
+
+def make_rows(count):
+    return ["{},{},{:.6f},{}\n".format(i,
+                                       random.randint(0, 10**6),
+                                       random.random(),
+                                       "x" * random.randint(5, 40))
+            for i in range(count)]
+
+def mutate(rows, changes):
+    """
+    Insert, update and delete a few rows
+    """
+    for i in range(changes):
+        op = random.choice(['insert', 'update', 'delete'])
+        pos = random.randint(0, len(rows) - 1)
+        row = "{},{},{:.6f},new\n".format(pos, random.randint(0, 10**6),
+                                         random.random())
+        if op == 'insert':
+            rows.insert(pos, row)
+        elif op == 'update':
+            rows[pos] = row
+        else:
+            del rows[pos]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--versions', type=int, default=100)
+    parser.add_argument('--changes', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp()
+    try:
+        gitdir = os.path.join(workdir, 'git')
+        storedir = os.path.join(workdir, 'store')
+        os.makedirs(gitdir)
+        git(gitdir, 'init', '-q', '.')
+        store = ChunkStore(storedir)
+
+        filename = os.path.join(workdir, 'data.csv')
+        rows = make_rows(args.rows)
+
+        gittime = 0
+        storetime = 0
+        filesize = 0
+        for version in range(args.versions):
+            if version > 0:
+                mutate(rows, args.changes)
+            with open(filename, 'w') as fd:
+                fd.write("".join(rows))
+            filesize = os.path.getsize(filename)
+
+            start = time.time()
+            shutil.copyfile(filename, os.path.join(gitdir, 'data.csv'))
+            git(gitdir, 'add', 'data.csv')
+            git(gitdir, 'commit', '-q', '-m', 'Version {}'.format(version))
+            gittime += time.time() - start
+
+            start = time.time()
+            store.put(filename)
+            storetime += time.time() - start
+
+        gitloose = du(os.path.join(gitdir, '.git', 'objects'))
+        start = time.time()
+        git(gitdir, 'gc', '-q')
+        gctime = time.time() - start
+        gitpacked = du(os.path.join(gitdir, '.git', 'objects'))
+        storesize = du(storedir)
+
+        print("File size: {:.1f} MB, {} versions, {} changes per version".format(
+            filesize / 1e6, args.versions, args.changes))
+        print("{:<20} {:>12} {:>12}".format("", "storage MB", "ingest s"))
+        print("{:<20} {:>12.1f} {:>12.2f}".format("git (loose)", gitloose / 1e6, gittime))
+        print("{:<20} {:>12.1f} {:>12.2f}".format("git (after gc)", gitpacked / 1e6,
+                                                  gittime + gctime))
+        print("{:<20} {:>12.1f} {:>12.2f}".format("chunk store", storesize / 1e6, storetime))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Cost of writing datapackage.json as the number of resources grows.
+Each resource carries a preview and a schema, as they do after
+metadata annotation.
+
+Usage:
+
+    python benchmarks/package_write.py [--resources N [N ...]] [--preview BYTES]
+
+Compared are the plain json.dumps(indent=4) rewrite, write_package
+with the default and compact encodings, write_package after adding a
+resource, and write_package when the package has not changed (it is
+neither serialized nor written).
+"""
+
+import os, sys, time, json, random, shutil, tempfile, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dgitcore.datasets.package import write_package
+from dgitcore.plugins.repomanager import Repo
+
+def make_repo(rootdir, package, encoding=None):
+    repo = Repo('bench', 'bench')
+    repo.rootdir = rootdir
+    repo.package = package
+    if encoding is not None:
+        repo.options['package-encoding'] = encoding
+    return repo
+
+def make_resource(i, preview):
+    return {
+        'relativepath': "data/file{:06d}.csv".format(i),
+        'sha256': "{:064x}".format(random.getrandbits(256)),
+        'size': random.randint(1000, 10**8),
+        'mimetype': 'text/csv',
+        'content': "x" * preview,
+        'schema': {
+            'fields': [{'name': "col{}".format(j), 'type': 'number'}
+                       for j in range(10)]
+        },
+    }
+
+def make_package(count, preview):
+    return {
+        'title': 'Benchmark',
+        'description': 'Package write benchmark',
+        'resources': [make_resource(i, preview) for i in range(count)]
+    }
+
+def timeit(func, repeat):
+    start = time.time()
+    for i in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resources', type=int, nargs='+',
+                        default=[100, 1000, 10000, 50000])
+    parser.add_argument('--preview', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'datapackage.json')
+        print("{:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>11}".format(
+            "resources", "default MB", "compact MB", "dumps s", "default s",
+            "compact s", "add s", "unchanged s"))
+        for count in args.resources:
+            package = make_package(count, args.preview)
+
+            def plain():
+                with open(path, 'w') as fd:
+                    fd.write(json.dumps(package, indent=4))
+            plaintime = timeit(plain, args.repeat)
+
+            repo = make_repo(workdir, package)
+            # Remove the file so that every write happens
+            def default():
+                os.unlink(path)
+                repo.mark_package_modified()
+                write_package(repo)
+            defaulttime = timeit(default, args.repeat)
+            defaultsize = os.path.getsize(path)
+
+            # One resource added before each write
+            added = [count]
+            def add():
+                repo.add_resource(make_resource(added[0], args.preview))
+                added[0] += 1
+                write_package(repo)
+            addtime = timeit(add, args.repeat)
+            unchangedtime = timeit(lambda: write_package(repo), args.repeat)
+
+            repo = make_repo(workdir, package, 'compact')
+            def compact():
+                os.unlink(path)
+                repo.mark_package_modified()
+                write_package(repo)
+            compacttime = timeit(compact, args.repeat)
+            compactsize = os.path.getsize(path)
+
+            print("{:>10} {:>10.1f} {:>10.1f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>11.6f}".format(
+                count, defaultsize / 1e6, compactsize / 1e6, plaintime,
+                defaulttime, compacttime, addtime, unchangedtime))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+asyncio version of the dgit API for use within an event loop.
+
+Git commands (commit, push, pull, status) run as asyncio subprocesses.
+Everything else (init, clone, add, validate, post, hashing and
+representation work) is offloaded to a thread pool so that the loop is
+never blocked. Operations on the same repo are serialized; operations
+on different repos run concurrently.
+
+Cancelling a call kills the git process it is waiting on, along with
+the processes git started (hooks, ssh). Work that
+has been offloaded to a thread cannot be interrupted; the cancellation
+takes effect (and the repo is released) once it finishes.
+
+Example::
+
+    from dgitcore import api, api_async
+
+    api.initialize()
+    repo = api.lookup('pingali', 'hello')
+    result = await api_async.commit(repo, ['-a', '-m', 'Update'])
+"""
+
+import os, signal, asyncio, functools, threading, weakref
+from concurrent.futures import ThreadPoolExecutor
+from dgitcore import datasets
+from dgitcore.datasets import common, objectstore
+from dgitcore.helper import log_action
+from dgitcore.plugins.common import plugins_get_mgr
+
+__all__ = ['init', 'clone', 'add', 'commit', 'push', 'pull',
+           'status', 'validate', 'post']
+
+# Threads used for work that cannot be done asynchronously
+OFFLOAD_WORKERS = 8
+
+executor = None
+# Locks belong to an event loop
+locks = weakref.WeakKeyDictionary()
+locks_guard = threading.Lock()
+
+def _executor():
+    global executor
+    with locks_guard:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=OFFLOAD_WORKERS)
+        return executor
+
+def _lock(key):
+    """
+    Lock serializing the operations on a repo
+    """
+    loop = asyncio.get_running_loop()
+    with locks_guard:
+        if loop not in locks:
+            locks[loop] = {}
+        if key not in locks[loop]:
+            locks[loop][key] = asyncio.Lock()
+        return locks[loop][key]
+
+def _repo_lock(repo):
+    return _lock((repo.username, repo.reponame))
+
+async def _offload(func, *args, **kwargs):
+    """
+    Run a blocking function in the thread pool. If the caller is
+    cancelled, wait for the function to finish before propagating the
+    cancellation so that the repo is not released while it is in use.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_executor(),
+                                  functools.partial(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+def _log(func, result, *args):
+    log_action(func, result, *args)
+
+async def _git(repo, cmd):
+    """
+    Run a git command in the repo as an asyncio subprocess
+
+    Returns
+    -------
+
+    dict with cmd, status and message (as the synchronous commands)
+    """
+    manager = repo.manager
+    await _offload(manager.refresh_worktree, repo)
+
+    gitexec = manager._executor()
+    p = await asyncio.create_subprocess_exec(gitexec.git, *cmd,
+                                             stdin=asyncio.subprocess.DEVNULL,
+                                             stdout=asyncio.subprocess.PIPE,
+                                             stderr=asyncio.subprocess.STDOUT,
+                                             cwd=repo.rootdir,
+                                             env=gitexec.environ,
+                                             start_new_session=True)
+    try:
+        (output, _) = await p.communicate()
+    except asyncio.CancelledError:
+        # The children of git hold its output open, so they are
+        # killed as well or the wait would not return
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        await p.wait()
+        raise
+
+    return {
+        'cmd': cmd,
+        'status': 'success' if p.returncode == 0 else 'error',
+        'message': output.decode('utf-8', 'replace').strip()
+    }
+
+#####################################################
+# Repo commands
+#####################################################
+
+async def init(username, reponame, setup, force=False, options=None,
+               noinput=False):
+    """
+    Initialize a repo (see datasets.init)
+    """
+    async with _lock((username, reponame)):
+        return await _offload(datasets.init, username, reponame, setup,
+                              force, options, noinput)
+
+async def clone(url, options=None):
+    """
+    Clone a URL (see datasets.clone). The clone is serialized with the
+    other operations on the repo it creates.
+    """
+    repomgr = plugins_get_mgr().get(what='repomanager', name='git')
+    async with _lock(repomgr.clone_key(url)):
+        return await _offload(datasets.clone, url, options)
+
+async def add(repo, args, targetdir, **kwargs):
+    """
+    Add files to the repo (see datasets.add). Hashing and copying run
+    in the thread pool.
+    """
+    async with _repo_lock(repo):
+        return await _offload(datasets.add, repo, args, targetdir, **kwargs)
+
+async def commit(repo, args=[]):
+    """
+    Commit changes to the repo
+
+    Parameters
+    ----------
+
+    repo: Repository object
+    args: Arguments to git commit
+    """
+    async with _repo_lock(repo):
+        result = await _git(repo, ['commit'] + list(args))
+        await _offload(repo.manager.update_catalog, repo)
+        await _offload(_log, common.commit, result, repo, args)
+        return result
+
+async def push(repo, args=[]):
+    """
+    Push changes (and large files) to the backend
+
+    Parameters
+    ----------
+
+    repo: Repository object
+    args: Arguments to git push
+    """
+    async with _repo_lock(repo):
+        await _offload(objectstore.push, repo)
+        result = await _git(repo, ['push'] + list(args))
+        await _offload(_log, common.push, result, repo, args)
+        return result
+
+async def pull(repo, args=[]):
+    """
+    Pull changes from the backend
+
+    Parameters
+    ----------
+
+    repo: Repository object
+    args: Arguments to git pull
+    """
+    async with _repo_lock(repo):
+        result = await _git(repo, ['pull'] + list(args))
+        await _offload(repo.manager.after_pull, repo)
+        await _offload(repo.manager.update_catalog, repo)
+        await _offload(_log, common.pull, result, repo, args)
+        return result
+
+async def status(repo, args=[]):
+    """
+    Show the status of the repo
+
+    Parameters
+    ----------
+
+    repo: Repository object
+    args: Arguments to git status
+    """
+    async with _repo_lock(repo):
+        result = await _git(repo, ['status'] + list(args))
+        await _offload(_log, common.status, result, repo, args)
+        return result
+
+async def validate(repo, **kwargs):
+    """
+    Validate the repo (see datasets.validate)
+    """
+    async with _repo_lock(repo):
+        return await _offload(datasets.validate, repo, **kwargs)
+
+async def post(repo, args=[]):
+    """
+    Post the metadata of the repo (see datasets.post)
+    """
+    async with _repo_lock(repo):
+        return await _offload(datasets.post, repo, args)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+Catalog of the repos in a workspace (<workspace>/catalog.db, SQLite).
+
+The catalog records the key, rootdir, remote URL, HEAD commit, number
+of resources, total size and last modification time of each repo. It
+is updated as repos are created, changed and dropped, so that listing
+and searching repos does not require loading every repo. On startup,
+the catalog is reconciled with the repos found in the workspace (see
+Catalog.reconcile).
+"""
+
+import os, time, sqlite3, threading
+from collections import OrderedDict
+
+schema = [
+    """CREATE TABLE IF NOT EXISTS repos (
+           username TEXT NOT NULL,
+           reponame TEXT NOT NULL,
+           rootdir TEXT NOT NULL,
+           remoteurl TEXT,
+           head TEXT,
+           resources INTEGER,
+           bytes INTEGER,
+           modified REAL,
+           PRIMARY KEY (username, reponame))""",
+    "CREATE INDEX IF NOT EXISTS repos_reponame ON repos (reponame)",
+    "CREATE INDEX IF NOT EXISTS repos_modified ON repos (modified)",
+]
+
+columns = ['username', 'reponame', 'rootdir', 'remoteurl',
+           'head', 'resources', 'bytes', 'modified']
+
+class Catalog(object):
+    """
+    Workspace catalog
+
+    Parameters
+    ----------
+
+    workspace: Workspace directory
+    """
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.path = os.path.join(workspace, 'catalog.db')
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def connect(self):
+        # The workspace may have been removed underneath us
+        if self.connection is not None and not self.exists():
+            self.close()
+
+        if self.connection is None:
+            try:
+                os.makedirs(self.workspace)
+            except:
+                pass
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         check_same_thread=False)
+            with connection:
+                for statement in schema:
+                    connection.execute(statement)
+            self.connection = connection
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def summarize(self, repo, package=True):
+        """
+        Compute the catalog entry of a repo. Without the package, the
+        number of resources and the size are left unknown (None) and
+        the package is not loaded.
+        """
+        if not package:
+            return OrderedDict([
+                ('username', repo.username),
+                ('reponame', repo.reponame),
+                ('rootdir', repo.rootdir),
+                ('remoteurl', repo.remoteurl),
+                ('head', repo.manager.head(repo)),
+                ('resources', None),
+                ('bytes', None),
+                ('modified', time.time())
+            ])
+
+        resources = repo.package['resources']
+        total = 0
+        for r in resources:
+            if r.get('size') is not None:
+                total += r['size']
+                continue
+            path = os.path.join(repo.rootdir, r['relativepath'])
+            if os.path.isfile(path):
+                total += os.path.getsize(path)
+
+        return OrderedDict([
+            ('username', repo.username),
+            ('reponame', repo.reponame),
+            ('rootdir', repo.rootdir),
+            ('remoteurl', repo.remoteurl),
+            ('head', repo.manager.head(repo)),
+            ('resources', len(resources)),
+            ('bytes', total),
+            ('modified', time.time())
+        ])
+
+    def update(self, repos, package=True):
+        """
+        Insert or update the entries of one or more repos in a single
+        transaction
+        """
+        if not isinstance(repos, (list, tuple)):
+            repos = [repos]
+        entries = [list(self.summarize(r, package).values()) for r in repos]
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO repos ({}) VALUES ({})".format(
+                        ", ".join(columns), ", ".join(["?"] * len(columns))),
+                    entries)
+
+    def remove(self, username, reponame):
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("DELETE FROM repos WHERE username = ? AND reponame = ?",
+                                   (username, reponame))
+
+    def reconcile(self, repos):
+        """
+        Bring the catalog in line with the repos found in the
+        workspace. Entries of repos that no longer exist are removed.
+        Repos that are not in the catalog are added without loading
+        their package. Only the repos whose datapackage.json changed
+        after their entry was recorded are summarized again.
+
+        Parameters
+        ----------
+
+        repos: Repos found in the workspace
+        """
+        known = dict([((e['username'], e['reponame']), e)
+                      for e in self.search()])
+
+        added = []
+        changed = []
+        for r in repos:
+            entry = known.pop((r.username, r.reponame), None)
+            if entry is None or entry['rootdir'] != r.rootdir:
+                added.append(r)
+                continue
+            package = os.path.join(r.rootdir, 'datapackage.json')
+            try:
+                if os.path.getmtime(package) > (entry['modified'] or 0):
+                    changed.append(r)
+            except OSError:
+                pass
+
+        for (username, reponame) in known:
+            self.remove(username, reponame)
+        if len(added) > 0:
+            self.update(added, package=False)
+        if len(changed) > 0:
+            self.update(changed)
+
+    def search(self, username=None, reponame=None, pattern=None):
+        """
+        Find repos. pattern is a glob over username/reponame.
+
+        Returns
+        -------
+
+        List of entries (OrderedDict) ordered by username and reponame
+        """
+        clauses = []
+        params = []
+        if username is not None:
+            clauses.append("username = ?")
+            params.append(username)
+        if reponame is not None:
+            clauses.append("reponame = ?")
+            params.append(reponame)
+        if pattern is not None:
+            clauses.append("(username || '/' || reponame) GLOB ?")
+            params.append(pattern)
+
+        query = "SELECT {} FROM repos".format(", ".join(columns))
+        if len(clauses) > 0:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY username, reponame"
+
+        with self.lock:
+            rows = self.connect().execute(query, params).fetchall()
+        return [OrderedDict(zip(columns, row)) for row in rows]
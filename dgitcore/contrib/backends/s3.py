@@ -11,13 +11,15 @@ for simplicity.
 * bucket: s3 bucket to store the repositories
 * prefix: Prefix within the bucket
 
+Large files (see dgitcore.datasets.objectstore) are stored under
+s3://<bucket>/<prefix>/objects/.
+
 """
-import os, sys, stat, subprocess
+import os, sys, stat, subprocess, pipes
 import boto3
 import getpass
 from dgitcore.plugins.backend import BackendBase
 from dgitcore.config import get_config, ChoiceValidator, NonEmptyValidator
-from dgitcore.helper import cd
 
 postreceive_template="""#!/bin/bash
 CMD="%(client)s"
@@ -57,8 +59,15 @@ class S3Backend(BackendBase):
             'reponame': reponame
             }
 
+    def object_url(self, key):
+        return "s3://%(bucket)s/%(prefix)s/objects/%(key)s" % {
+            'bucket': self.bucket,
+            'prefix': self.prefix,
+            'key': key
+            }
+
     def run(self, cmd):
-        cmd = " ".join(cmd)
+        cmd = " ".join([pipes.quote(c) for c in cmd])
         output = subprocess.check_output(cmd,
                                          stderr=subprocess.STDOUT,
                                          shell=True)
@@ -164,6 +173,27 @@ class S3Backend(BackendBase):
 
         return True
 
+    def has_object(self, key):
+        try:
+            return self.url_is_valid(self.object_url(key))
+        except subprocess.CalledProcessError:
+            return False
+
+    def put_object(self, key, filename):
+        if self.client == 'aws':
+            cmd = ["aws", "s3", "cp", filename, self.object_url(key)]
+        else:
+            cmd = ["s3cmd", "-c", self.s3cfg, "put", filename, self.object_url(key)]
+        self.run(cmd)
+
+    def get_object(self, key, filename):
+        if self.client == 'aws':
+            cmd = ["aws", "s3", "cp", self.object_url(key), filename]
+        else:
+            cmd = ["s3cmd", "-c", self.s3cfg, "get", "--force",
+                   self.object_url(key), filename]
+        self.run(cmd)
+
     def clone_repo(self, url, gitdir):
 
         if not self.url_is_valid(url):
@@ -176,15 +206,15 @@ class S3Backend(BackendBase):
 
 
         print("Syncing into local directory", gitdir)
-        with cd(gitdir):
-            if self.client == 'aws':
-                cmd = ["aws", "s3", "sync", '--delete', url + "/", "."]
-            else:
-                cmd = ["s3cmd", "-c", self.s3cfg, "sync", url + "/", "."]
-            # print("CMD", cmd)
-            output = self.run(cmd)
-            #print(output)
-            print("Sync'd dataset with s3")
+        target = os.path.abspath(gitdir) + "/"
+        if self.client == 'aws':
+            cmd = ["aws", "s3", "sync", '--delete', url + "/", target]
+        else:
+            cmd = ["s3cmd", "-c", self.s3cfg, "sync", url + "/", target]
+        # print("CMD", cmd)
+        output = self.run(cmd)
+        #print(output)
+        print("Sync'd dataset with s3")
 
 
         # Make sure that hook is has correct permissions
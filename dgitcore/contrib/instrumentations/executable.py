@@ -4,46 +4,44 @@ import os, sys
 import json
 import messytables
 import subprocess
-from dgitcore.helper import cd
 from dgitcore.plugins.instrumentation import InstrumentationBase
 from dgitcore.config import get_config
 
 
-def run(cmd):
+def run(cmd, cwd=None):
     output = subprocess.check_output(cmd,
                                      stderr=subprocess.STDOUT,
-                                     shell=True)
+                                     shell=True,
+                                     cwd=cwd)
     output = output.decode('utf-8')
     output = output.strip()
     return output
 
 def repo_origin(filename, what=['Push  URL']):
 
-    with cd(os.path.dirname(filename)):
-        cmd = "git remote show origin"
-        output = run(cmd)
-        #* remote origin
-        #Fetch URL: git@github.com:jaredpar/VsVim.git
-        #Push  URL: git@github.com:jaredpar/VsVim.git
-        #HEAD branch: master
-        #Remote branches:
-
-        response = {}
-        output = output.split("\n")
-        output = output[1:]
-        for o in output:
-            for w in what:
-                if w in o:
-                    response[w] = o[o.index(":")+1:]
+    cmd = "git remote show origin"
+    output = run(cmd, cwd=os.path.dirname(filename))
+    #* remote origin
+    #Fetch URL: git@github.com:jaredpar/VsVim.git
+    #Push  URL: git@github.com:jaredpar/VsVim.git
+    #HEAD branch: master
+    #Remote branches:
+
+    response = {}
+    output = output.split("\n")
+    output = output[1:]
+    for o in output:
+        for w in what:
+            if w in o:
+                response[w] = o[o.index(":")+1:]
 
     return response
 
 def repo_remote_url(filename):
 
-    with cd(os.path.dirname(filename)):
-        cmd = "git config --get remote.origin.url"
-        output = run(cmd)
-        return {'remote.origin.url': output.strip()}
+    cmd = "git config --get remote.origin.url"
+    output = run(cmd, cwd=os.path.dirname(filename))
+    return {'remote.origin.url': output.strip()}
 
 def executable_commit(filename,
                       what=['commit', 'username', 'useremail', 'date']):
@@ -61,35 +59,32 @@ def executable_commit(filename,
 
     codes = ",".join([mapping[w] for w in what if w in mapping])
 
-    with cd(os.path.dirname(filename)):
-        cmd = 'git log -n 1  --date=iso --pretty="%s" -- %s ' %(codes, filename)
-        output = run(cmd)
-        output = output.strip()
-        output = output.split(",")
-        return {what[i]: output[i] for i in range(len(what))}
+    cmd = 'git log -n 1  --date=iso --pretty="%s" -- %s ' %(codes, filename)
+    output = run(cmd, cwd=os.path.dirname(filename))
+    output = output.strip()
+    output = output.split(",")
+    return {what[i]: output[i] for i in range(len(what))}
 
     return {}
 
 def executable_repopath(filename):
 
-    with cd(os.path.dirname(filename)):
-        cmd = 'git rev-parse --show-prefix'
-        output = run(cmd)
-        output = output.strip()
-        return {
-            'path': os.path.join(output, os.path.basename(filename))
-        }
+    cmd = 'git rev-parse --show-prefix'
+    output = run(cmd, cwd=os.path.dirname(filename))
+    output = output.strip()
+    return {
+        'path': os.path.join(output, os.path.basename(filename))
+    }
 
 def executable_filetype(filename):
 
-    with cd(os.path.dirname(filename)):
-        cmd = '/usr/bin/file ' + filename
-        output = run(cmd)
-        output = output.strip()
-        output = output[output.index(":")+1:]
-        return {
-            'filetype': output
-        }
+    cmd = '/usr/bin/file ' + filename
+    output = run(cmd, cwd=os.path.dirname(filename))
+    output = output.strip()
+    output = output[output.index(":")+1:]
+    return {
+        'filetype': output
+    }
 
 def get_metadata(args):
     filename = args[0]
@@ -9,12 +9,15 @@ GitManager does not have independent variables but it inherits attributes from '
 * email: (from User) Email of the user
 
 """
-import os, sys, json, subprocess, re, json
-import pipes, collections
-import shutil
-from sh import git
+import os, sys, json, subprocess, re, json, time
+import collections
+import shutil, tempfile, threading, glob
 from dgitcore.plugins.repomanager import RepoManagerBase, Repo
-from dgitcore.helper import cd
+from dgitcore.helper import ingest_file
+from dgitcore.gitexec import GitExecutor
+from dgitcore.catalog import Catalog
+from dgitcore.datasets import objectstore
+from dgitcore.datasets.package import write_package
 from dgitcore.exceptions import *
 
 class GitRepoManager(RepoManagerBase):
@@ -29,70 +32,109 @@ class GitRepoManager(RepoManagerBase):
         self.metadatadir = '.git'
         self.repos = {}
         self.enable = True
+        self.executor = None
+        self.lock = threading.Lock()
+        # Permalink resolution (see permalinks)
+        self.toplevels = {}
+        self.permalink_roots = {}
+        self.permalink_lock = threading.Lock()
+        # Location of the sparse checkout selection of each repo
+        self.sparse_files = {}
         super(GitRepoManager, self).__init__('git',
                                              'v0',
                                              "Git-based Repository Manager")
 
+    # Upper bound on the size of the pathspecs passed to a single git
+    # invocation (well below the usual ARG_MAX of 2MB)
+    stage_chunkbytes = 128 * 1024
+
     # =>  Helper functions
-    def _run(self, cmd):
+    def _executor(self):
+        """
+        Executor with the identity of the user. It is created on first
+        use (after the configuration has been loaded).
+        """
+        with self.lock:
+            if self.executor is None:
+                # This is here in case the .gitconfig is not accessible for
+                # some reason. 
+                self.executor = GitExecutor({
+                    'GIT_COMMITTER_NAME': self.fullname,
+                    'GIT_COMMITTER_EMAIL': self.email,
+                    'GIT_AUTHOR_NAME': self.fullname,
+                    'GIT_AUTHOR_EMAIL': self.email
+                })
+            return self.executor
+
+    def _execute(self, cmd, stdin=None, cwd=None, env=None):
         """
-        Helper function to run commands
+        Run a git command without a shell
 
         Parameters
         ----------
         cmd : list
               Arguments to git command
-        """
-
-        # This is here in case the .gitconfig is not accessible for
-        # some reason. 
-        environ = os.environ.copy() 
+        stdin: bytes to be fed to the command's standard input
+        cwd: Directory to run the command in (default: current)
+        env: Additional environment variables
 
-        environ['GIT_COMMITTER_NAME'] = self.fullname
-        environ['GIT_COMMITTER_EMAIL'] = self.email 
-        environ['GIT_AUTHOR_NAME'] = self.fullname
-        environ['GIT_AUTHOR_EMAIL'] = self.email 
+        Returns
+        -------
 
-        cmd = [pipes.quote(c) for c in cmd]
-        cmd = " ".join(['/usr/bin/git'] + cmd)
-        cmd += "; exit 0"
+        GitResult(returncode, output)
+        """
         #print("Running cmd", cmd)
-        try:
-            output = subprocess.check_output(cmd,
-                                             stderr=subprocess.STDOUT,
-                                             shell=True,
-                                             env=environ)
-        except subprocess.CalledProcessError as e:
-            output = e.output
-
-        output = output.decode('utf-8')
+        return self._executor().run(cmd, cwd=cwd, stdin=stdin, env=env)
+
+    def _run(self, cmd, stdin=None, cwd=None, env=None):
+        """
+        Helper function to run commands. Returns the output (stdout and
+        stderr). Use _execute if the exit code is needed.
+        """
+        output = self._execute(cmd, stdin=stdin, cwd=cwd, env=env).output
         output = output.strip()
         # print("Output of command", output)
         return output
 
+    def head(self, repo):
+        """
+        Commit at HEAD (None if the repo has no commits)
+        """
+        result = self._execute(['rev-parse', '--verify', '-q', 'HEAD'],
+                               cwd=repo.rootdir)
+        if result.returncode != 0:
+            return None
+        return result.output.strip()
+
+    def object_reader(self, repo):
+        """
+        Long-lived reader for the objects of the repo (see
+        dgitcore.gitexec.GitObjectReader)
+        """
+        return self._executor().reader(repo.rootdir)
+
     def _run_generic_command(self, repo, cmd):
         """
-        Run a generic command within the repo. Assumes that you are
-        in the repo's root directory
+        Run a generic command within the repo. The command runs in the
+        repo's root directory (the process' working directory is not
+        changed, so this can be used from several threads).
         """
         
         result = None
-        with cd(repo.rootdir):
-            # Dont use sh. It is not collecting the stdout of all
-            # child processes.
-            output = self._run(cmd)
-            try:
-                result = {
-                    'cmd': cmd,
-                    'status': 'success',
-                    'message': output,
-                }
-            except Exception as e:
-                result = {
-                    'cmd': cmd,
-                    'status': 'error',
-                    'message': str(e)
-                }
+        try:
+            self.refresh_worktree(repo)
+            output = self._execute(cmd, cwd=repo.rootdir)
+            result = {
+                'cmd': cmd,
+                'status': 'success' if output.returncode == 0 else 'error',
+                'message': output.output.strip(),
+            }
+        except Exception as e:
+            result = {
+                'cmd': cmd,
+                'status': 'error',
+                'message': str(e)
+            }
 
         return result
 
@@ -150,7 +192,26 @@ class GitRepoManager(RepoManagerBase):
         args: git-specific args
 
         """
-        return self._run_generic_command(repo, ["pull"] + args)
+        result = self._run_generic_command(repo, ["pull"] + args)
+        self.after_pull(repo)
+        return result
+
+    def after_pull(self, repo):
+        """
+        The package may have changed in a pull. It is reloaded when
+        next used, and new resources that match the selection of a
+        sparse checkout are materialized.
+
+        Parameters
+        ----------
+
+        repo: Repository object
+        """
+        if os.path.exists(os.path.join(repo.rootdir, 'datapackage.json')):
+            repo.set_package_loader(self.load_package)
+            patterns = self.sparse_patterns(repo)
+            if patterns is not None:
+                self.sparse_checkout(repo, patterns)
 
     def status(self, repo, args=[]):
         """
@@ -254,8 +315,12 @@ class GitRepoManager(RepoManagerBase):
         os.makedirs(server_repodir)
 
         # Initialize the repo
-        with cd(server_repodir):
-            git.init(".", "--bare")
+        self._check(self._execute(['init', '--bare', '.'], cwd=server_repodir),
+                    "initialize repo")
+
+        # Allow partial clones (clone-filter) of the repo
+        self._run(['config', 'uploadpack.allowFilter', 'true'],
+                  cwd=server_repodir)
 
         if backend is not None:
             backend.init_repo(server_repodir)
@@ -271,8 +336,9 @@ class GitRepoManager(RepoManagerBase):
         os.makedirs(repodir)
 
         # Now clone...
-        with cd(os.path.dirname(repodir)):
-            git.clone(server_repodir, '--no-hardlinks')
+        self._check(self._execute(['clone', '--no-hardlinks', server_repodir],
+                                  cwd=os.path.dirname(repodir)),
+                    "clone repo")
 
         url = server_repodir
         if backend is not None:
@@ -286,7 +352,18 @@ class GitRepoManager(RepoManagerBase):
         self.add(repo)
         return repo
 
-    def clone(self, url, backend=None):
+    def clone_key(self, url):
+        """
+        Key (username, reponame) of the repo that a clone of the URL
+        creates
+        """
+        # s3://bucket/git/username/repo.git
+        username = self.username
+        reponame = url.split("/")[-1] # with git
+        reponame = reponame.replace(".git","")
+        return (username, reponame)
+
+    def clone(self, url, backend=None, options=None):
         """
         Clone a URL
 
@@ -294,15 +371,18 @@ class GitRepoManager(RepoManagerBase):
         ----------
 
         url : URL of the repo. Supports s3://, git@, http://
+        backend: Backend of the URL (None for git URLs)
+        options: dict with clone-depth (shallow clone with that many
+                 commits), clone-filter (partial clone, e.g.,
+                 blob:none; missing objects are fetched when they are
+                 first read), clone-single-branch (true/false) and
+                 clone-sparse (patterns of the resources to
+                 materialize, see sparse_checkout). These are the
+                 keys used in dgit.json.
         """
 
-
-        # s3://bucket/git/username/repo.git
-        username = self.username
-        reponame = url.split("/")[-1] # with git
-        reponame = reponame.replace(".git","")
-
-        key = (username, reponame)
+        key = self.clone_key(url)
+        (username, reponame) = key
 
         # In local filesystem-based server, add a repo
         server_repodir = self.server_rootdir(username,
@@ -311,47 +391,73 @@ class GitRepoManager(RepoManagerBase):
 
         rootdir = self.rootdir(username,  reponame, create=False)
 
+        try:
+            os.makedirs(os.path.dirname(rootdir))
+        except:
+            pass
+
+        cloneargs = self._clone_args(options)
+
+        # Sparse clones are checked out once the selection is known
+        sparse = None
+        if options is not None:
+            sparse = options.get('clone-sparse')
+        checkoutargs = ['--no-checkout'] if sparse else []
 
         if backend is None:
             # Backend is standard git repo (https://, git@...)
-            with cd(os.path.dirname(rootdir)):
-                self._run(['clone', '--no-hardlinks', url])
+            source = url
+            if len(cloneargs) > 0 and os.path.isdir(url):
+                source = "file://" + os.path.abspath(url)
+            self._check(self._execute(['clone', '--no-hardlinks'] + cloneargs +
+                                      checkoutargs + [source],
+                                      cwd=os.path.dirname(rootdir)),
+                        "clone repo")
         else:
             # Backend is s3
             # Sync if needed.
             if not os.path.exists(server_repodir):
                 # s3 -> .dgit/git/pingali/hello.git -> .dgit/datasets/pingali/hello
                 backend.clone_repo(url, server_repodir)
-
-            # After sync clone,
-            with cd(os.path.dirname(rootdir)):
-                self._run(['clone', '--no-hardlinks', server_repodir])
-
-
-        # Insert the notes push
-        if True:
-            configfile = os.path.join(rootdir, '.git', 'config')
-            content = open(configfile).read()
-            original = "fetch = +refs/heads/*:refs/remotes/origin/*"
-            replacement ="""fetch = +refs/heads/*:refs/remotes/origin/*\n        fetch = +refs/notes/*:refs/notes/*"""
-            if "notes" not in content:
-                content = content.replace(original, replacement)
-                with open(configfile, 'w') as fd:
-                    fd.write(content)
-
-            # Pull the notes if any as well..
-            with cd(rootdir):
-                self._run(['pull','origin'])
+                self._run(['config', 'uploadpack.allowFilter', 'true'],
+                          cwd=server_repodir)
+
+            # After sync clone. Shallow and partial clones are only
+            # possible over a transport (file://), not with a local
+            # copy.
+            source = server_repodir
+            if len(cloneargs) > 0:
+                source = "file://" + os.path.abspath(server_repodir)
+            self._check(self._execute(['clone', '--no-hardlinks'] + cloneargs +
+                                      checkoutargs + [source],
+                                      cwd=os.path.dirname(rootdir)),
+                        "clone repo")
+
+        # Fetch the notes as well
+        self._run(['config', '--add', 'remote.origin.fetch',
+                   '+refs/notes/*:refs/notes/*'], cwd=rootdir)
+        fetchargs = ['fetch', 'origin', '+refs/notes/*:refs/notes/*']
+        if options is not None and options.get('clone-depth'):
+            fetchargs.insert(1, '--depth={}'.format(int(options['clone-depth'])))
+        self._run(fetchargs, cwd=rootdir)
+
+        # Only the package is needed to find the selected resources
+        if sparse:
+            self._check(self._execute(['sparse-checkout', 'set', '--no-cone'] +
+                                      self.sparse_always, cwd=rootdir),
+                        "set up sparse checkout")
+            self._check(self._execute(['checkout'], cwd=rootdir),
+                        "check out repo")
 
         # Insert the object into the internal table we maintain...
         r = Repo(username, reponame)
         r.rootdir = rootdir
         r.remoteurl = url
         r.manager = self
+        r.set_package_loader(self.load_package)
 
-        package = os.path.join(r.rootdir, 'datapackage.json')
-        packagedata = open(package).read()
-        r.package = json.JSONDecoder(object_pairs_hook=collections.OrderedDict).decode(packagedata)
+        if sparse and os.path.exists(os.path.join(rootdir, 'datapackage.json')):
+            self.sparse_checkout(r, sparse)
 
         return self.add(r)
 
@@ -362,21 +468,21 @@ class GitRepoManager(RepoManagerBase):
         """
 
         result = None
-        with cd(repo.rootdir):
-            try:
-                cmd = ['rm'] + list(args)
-                result = {
-                    'status': 'success',
-                    'message': self._run(cmd)
-                }
-            except Exception as e:
-                result = {
-                    'status': 'error',
-                    'message': str(e)
-                }
+        self.refresh_worktree(repo)
+        try:
+            cmd = ['rm'] + list(args)
+            result = {
+                'status': 'success',
+                'message': self._run(cmd, cwd=repo.rootdir)
+            }
+        except Exception as e:
+            result = {
+                'status': 'error',
+                'message': str(e)
+            }
 
-            # print(result)
-            return result
+        # print(result)
+        return result
 
     def drop(self, repo, args=[]):
         """
@@ -385,6 +491,8 @@ class GitRepoManager(RepoManagerBase):
 
         # Clean up the rootdir
         rootdir = repo.rootdir
+        if self.executor is not None:
+            self.executor.release(rootdir)
         if os.path.exists(rootdir):
             print("Cleaning repo directory: {}".format(rootdir))
             shutil.rmtree(rootdir)
@@ -404,105 +512,684 @@ class GitRepoManager(RepoManagerBase):
             'message': "successful cleanup"
         }
 
-    def permalink(self, repo, path):
+    def _toplevel(self, dirname):
         """
-        Get the permalink to command that generated the dataset
+        Root of the git checkout that contains dirname (None if it is
+        not in one). The answer is cached per directory.
         """
+        with self.permalink_lock:
+            if dirname in self.toplevels:
+                rootdir = self.toplevels[dirname]
+                if rootdir is None or os.path.exists(os.path.join(rootdir, '.git')):
+                    return rootdir
+
+        result = self._execute(["rev-parse", "--show-toplevel"], cwd=dirname)
+        rootdir = result.output.strip() if result.returncode == 0 else None
+        with self.permalink_lock:
+            self.toplevels[dirname] = rootdir
+        return rootdir
+
+    def _head_state(self, rootdir):
+        """
+        Commit at HEAD and the modification time of the config, read
+        from the files under .git where possible so that checking
+        whether cached permalinks are still valid is cheap.
+        """
+        gitdir = os.path.join(rootdir, '.git')
+        if not os.path.isdir(gitdir):
+            # Worktrees and submodules have a .git file instead
+            return (self._run(["rev-parse", "-q", "--verify", "HEAD"], cwd=rootdir),
+                    None)
 
-        if not os.path.exists(path): 
-            # print("Path does not exist", path)
-            return (None, None) 
-
-        # Get this directory
-        cwd = os.getcwd()
-
-        # Find the root of the repo and cd into that directory..
-        if os.path.isfile(path):
-            os.chdir(os.path.dirname(path))
+        try:
+            with open(os.path.join(gitdir, 'HEAD')) as fd:
+                head = fd.read().strip()
+            if head.startswith("ref: "):
+                ref = head[5:]
+                head = None
+                refpath = os.path.join(gitdir, *ref.split("/"))
+                if os.path.exists(refpath):
+                    with open(refpath) as fd:
+                        head = fd.read().strip()
+                elif os.path.exists(os.path.join(gitdir, 'packed-refs')):
+                    with open(os.path.join(gitdir, 'packed-refs')) as fd:
+                        for line in fd:
+                            parts = line.strip().split(" ")
+                            if len(parts) == 2 and parts[1] == ref:
+                                head = parts[0]
+                                break
+            mtime = os.path.getmtime(os.path.join(gitdir, 'config'))
+        except (IOError, OSError):
+            return (None, None)
 
-        rootdir = self._run(["rev-parse", "--show-toplevel"])
-        if "fatal" in rootdir:
-            # print("fatal", rootdir)
-            return (None, None) 
+        return (head, mtime)
 
-        os.chdir(rootdir)
-        # print("Rootdir = ", rootdir)
+    def _permalink_base(self, remoteurl):
+        """
+        Web URL of the project for a remote url, e.g.,
+        https://github.com/pingali/dgit for git@github.com:pingali/dgit.git
+        """
+        # Now match it against two possible formats of the remote url
+        # Examples
+        #git@gitlab.com:pingali/simple-regression.git
+        #https://gitlab.com/kanban_demo/test_project.git
+        m = re.search('^git@([^:\/]+):([^/]+)/([^/]+)', remoteurl)
+        if m is None:
+            m = re.search('^https://([^:/]+)/([^/]+)/([^/]+)', remoteurl)
+        if m is None:
+            return None
 
-        # Now find relative path
-        relpath = os.path.relpath(path, rootdir)
-        # print("relpath = ", relpath)
+        domain = m.group(1)
+        username = m.group(2)
+        project = m.group(3)
+        if project.endswith(".git"):
+            project = project[:-4]
+        return "https://{}/{}/{}".format(domain, username, project)
 
-        # Get the last commit for this file
-        #3764cc2600b221ac7d7497de3d0dbcb4cffa2914
-        sha1 = self._run(["log", "-n", "1", "--format=format:%H", relpath])
-        # print("sha1 = ", sha1)
+    def _permalink_root(self, rootdir):
+        """
+        Cached remote and last commits of a checkout. The entry is
+        discarded when HEAD (or the config) changes.
+        """
+        state = self._head_state(rootdir)
+        with self.permalink_lock:
+            entry = self.permalink_roots.get(rootdir)
+            if entry is not None and entry['state'] == state:
+                return entry
+
+        remoteurl = self._run(["config", "--get", "remote.origin.url"],
+                              cwd=rootdir)
+        entry = {
+            'state': state,
+            'base': self._permalink_base(remoteurl),
+            'commits': {}
+        }
+        with self.permalink_lock:
+            self.permalink_roots[rootdir] = entry
+        return entry
 
-        # Get the repo URL
-        #git@gitlab.com:pingali/simple-regression.git
-        #https://gitlab.com/kanban_demo/test_project.git
-        remoteurl = self._run(["config", "--get", "remote.origin.url"])
-        # print("remoteurl = ", remoteurl)
+    def _last_commits(self, rootdir, relpaths):
+        """
+        Last commit that touched each of the paths (files or
+        directories) using a single walk of the history. The walk stops
+        as soon as all the paths have been seen.
+        """
+        found = {}
+        pending = set(relpaths)
+        gitexec = self._executor()
+        cmd = [gitexec.git, "log", "--format=%x01%H", "--name-only",
+               "--no-renames", "-z", "--"] + list(relpaths)
+        env = dict(gitexec.environ)
+        env['GIT_LITERAL_PATHSPECS'] = '1'
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, cwd=rootdir, env=env)
+        try:
+            sha1 = None
+            leftover = b""
+            while len(pending) > 0:
+                data = p.stdout.read(64 * 1024)
+                if len(data) == 0:
+                    break
+                tokens = (leftover + data).split(b"\0")
+                leftover = tokens.pop()
+                for token in tokens:
+                    # Each commit is \x01<sha> followed by the NUL
+                    # terminated names of the files it changed (the
+                    # first one after a newline)
+                    token = token.decode('utf-8', 'replace')
+                    if token.startswith("\x01"):
+                        (sha1, _, token) = token[1:].partition("\n")
+                    token = token.lstrip("\n")
+                    if token == "" or sha1 is None:
+                        continue
+                    # The file and all its parent directories
+                    candidates = [token, "."]
+                    parent = os.path.dirname(token)
+                    while parent != "":
+                        candidates.append(parent)
+                        parent = os.path.dirname(parent)
+                    for c in candidates:
+                        if c in pending:
+                            found[c] = sha1
+                            pending.discard(c)
+        finally:
+            if p.poll() is None:
+                p.kill()
+            p.stdout.close()
+            p.wait()
+
+        return found
+
+    def permalinks(self, repo, paths):
+        """
+        Get the permalinks to a number of files (e.g., the commands
+        that generated the dataset). The git checkout, remote and last
+        commit of each path are cached until HEAD changes, and the
+        commits of all uncached paths in a checkout are found with one
+        git log.
 
-        # Go back to the original directory...
-        os.chdir(cwd)
+        Parameters
+        ----------
 
-        # Now match it against two possible formats of the remote url
-        # Examples
-        #https://help.github.com/articles/getting-permanent-links-to-files/
-        #https://github.com/github/hubot/blob/ed25584f5ac2520a6c28547ffd0961c7abd7ea49/README.md
-        #https://gitlab.com/pingali/simple-regression/blob/3764cc2600b221ac7d7497de3d0dbcb4cffa2914/model.py
-        #https://github.com/pingali/dgit/blob/ff91b5d04b2978cad0bf9b006d1b0a16d18a778e/README.rst
-        #https://gitlab.com/kanban_demo/test_project/blob/b004677c23b3a31eb7b5588a5194857b2c8b2b95/README.md
+        repo: Repository object
+        paths: List of paths
 
-        m = re.search('^git@([^:\/]+):([^/]+)/([^/]+)', remoteurl)
-        if m is None:
-            m = re.search('^https://([^:/]+)/([^/]+)/([^/]+)', remoteurl)
-        if m is not None:
-            domain = m.group(1)
-            username = m.group(2)
-            project = m.group(3)
-            if project.endswith(".git"):
-                project = project[:-4]
-            permalink = "https://{}/{}/{}/blob/{}/{}".format(domain, username, project,
-                                                        sha1, relpath)
-            # print("permalink = ", permalink)
-            return (relpath, permalink)
-        else:
-            return (None, None)
+        Returns
+        -------
 
+        dict mapping each path to (relpath, permalink) or (None, None)
+        if the path is not part of a git checkout with a known remote
+        """
+        results = {}
+        pending = collections.OrderedDict()
+        for path in paths:
+            results[path] = (None, None)
+            if not os.path.exists(path):
+                continue
+
+            # Find the root of the repo
+            abspath = os.path.abspath(path)
+            dirname = abspath if os.path.isdir(abspath) else os.path.dirname(abspath)
+            rootdir = self._toplevel(dirname)
+            if rootdir is None:
+                continue
+            relpath = os.path.relpath(abspath, rootdir)
+            pending.setdefault(rootdir, []).append((path, relpath))
+
+        for rootdir, entries in pending.items():
+            entry = self._permalink_root(rootdir)
+            if entry['base'] is None:
+                continue
+
+            commits = entry['commits']
+            with self.permalink_lock:
+                missing = sorted(set([relpath for (_, relpath) in entries
+                                      if relpath not in commits]))
+            if len(missing) > 0:
+                found = {}
+                for chunk in self._chunk_paths(missing, self.stage_chunkbytes):
+                    found.update(self._last_commits(rootdir, chunk))
+                with self.permalink_lock:
+                    for relpath in missing:
+                        commits[relpath] = found.get(relpath, "")
+
+            #https://github.com/pingali/dgit/blob/ff91b5d04b2978cad0bf9b006d1b0a16d18a778e/README.rst
+            for (path, relpath) in entries:
+                results[path] = (relpath,
+                                 "{}/blob/{}/{}".format(entry['base'],
+                                                        commits[relpath],
+                                                        relpath))
+
+        return results
 
+    def permalink(self, repo, path):
+        """
+        Get the permalink to command that generated the dataset
+        """
+        return self.permalinks(repo, [path])[path]
 
     def add_raw(self, repo, files):
         result = None
-        with cd(repo.rootdir):
-            try:
-                result = self._run(["add"] + files)
-            except:
-                pass
+        try:
+            result = self._run(["add"] + files, cwd=repo.rootdir)
+        except:
+            pass
+
+
+    def _git_version(self):
+        if not hasattr(self, '_version'):
+            output = self._run(['--version'])
+            m = re.search(r'(\d+)\.(\d+)', output)
+            self._version = (0, 0)
+            if m is not None:
+                self._version = (int(m.group(1)), int(m.group(2)))
+        return self._version
+
+    def _chunk_paths(self, paths, maxbytes):
+        chunk = []
+        size = 0
+        for p in paths:
+            if len(chunk) > 0 and size + len(p) + 1 > maxbytes:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(p)
+            size += len(p) + 1
+        if len(chunk) > 0:
+            yield chunk
+
+    def stage_files(self, repo, paths):
+        """
+        Stage a list of paths (relative to the repo root) with as few
+        git invocations as possible. Paths are passed NUL-separated on
+        stdin where git supports it (>= 2.25) and on the command line
+        otherwise.
+        """
+        start = time.time()
+        self.refresh_worktree(repo)
+
+        # git does not stage paths outside of the sparse checkout
+        if self.is_sparse(repo):
+            self._add_to_sparse(repo, paths)
+
+        pathspec_file = self._git_version() >= (2, 25)
+        maxbytes = self.stage_chunkbytes
+        if pathspec_file:
+            maxbytes *= 64
+
+        outputs = []
+        status = 'success'
+        for chunk in self._chunk_paths(paths, maxbytes):
+            if pathspec_file:
+                stdin = "".join([p + "\0" for p in chunk])
+                result = self._execute(['--literal-pathspecs', 'add',
+                                        '--pathspec-from-file=-',
+                                        '--pathspec-file-nul'],
+                                       stdin=stdin.encode('utf-8'),
+                                       cwd=repo.rootdir)
+            else:
+                result = self._execute(['--literal-pathspecs', 'add',
+                                        '--'] + chunk,
+                                       cwd=repo.rootdir)
+            if result.returncode != 0:
+                status = 'error'
+            if result.output.strip() != "":
+                outputs.append(result.output.strip())
+
+        elapsed = time.time() - start
+        message = "\n".join(outputs)
+        print("Staged {} file(s) in {:.2f}s".format(len(paths), elapsed))
 
+        return {
+            'status': status,
+            'message': message,
+            'staged': len(paths),
+            'elapsed': elapsed
+        }
 
-    def add_files(self, repo, files):
+    def copy_file(self, repo, f, mode=None):
         """
-        Add files to the repo
+        Copy a single file into the repo (without staging it)
+
+        Parameters
+        ----------
+
+        repo: Repository object
+        f: dict with relativepath and localfullpath
+        mode: Ingest mode (reflink, hardlink, copy_file_range,
+              copy). Defaults to ingest-mode in dgit.json or copy.
+
+        If the ingest reads the file and the file does not have a
+        sha256 yet, it is filled in.
+
+        Files larger than large-file-threshold (dgit.json) go into the
+        object store and only a pointer is written to the repo. The
+        record is marked with storage=objectstore, the size and the
+        manifest of chunked versions.
         """
-        rootdir = repo.rootdir
+        if mode is None:
+            mode = repo.options.get('ingest-mode', 'copy')
+
+        relativepath = f['relativepath']
+        sourcepath = f['localfullpath']
+
+        # Prepare the target path
+        targetpath = os.path.join(repo.rootdir, relativepath)
+        try:
+            os.makedirs(os.path.dirname(targetpath))
+        except:
+            pass
+
+        pointer = self._store_large_file(repo, f, mode)
+        if pointer is not None:
+            if os.path.lexists(targetpath):
+                os.unlink(targetpath)
+            with open(targetpath, 'w') as fd:
+                fd.write(pointer)
+            return targetpath
+
+        # print(sourcepath," => ", targetpath)
+        (used, sha256) = ingest_file(sourcepath, targetpath, mode)
+        if sha256 is not None and f.get('sha256') in [None, ""]:
+            f['sha256'] = sha256
+
+        return targetpath
+
+    def _store_large_file(self, repo, f, mode):
+        """
+        Move the file into the object store if it is above the
+        large-file threshold. Returns the content of the pointer to be
+        committed instead or None.
+        """
+        threshold = objectstore.threshold(repo)
+        if threshold is None or os.path.getsize(f['localfullpath']) <= threshold:
+            return None
+
+        if mode is None:
+            mode = repo.options.get('ingest-mode', 'copy')
+        store = objectstore.ObjectStore(repo)
+        stored = store.put(f['localfullpath'], f.get('sha256'), mode)
+        f.update(stored)
+        f['storage'] = 'objectstore'
+        return objectstore.pointer_content(stored['sha256'], stored['size'])
+
+    def add_files(self, repo, files, mode=None):
+        """
+        Add files to the repo. All files are copied first and then
+        staged together.
+
+        Parameters
+        ----------
+
+        repo: Repository object
+        files: List of dicts with relativepath and localfullpath
+        mode: Ingest mode (see copy_file)
+        """
+        paths = []
         for f in files:
-            relativepath = f['relativepath']
-            sourcepath = f['localfullpath']
-            if sourcepath is None:
+            if f['localfullpath'] is None:
                 # This can happen if the relative path is a URL
                 continue #
-            # Prepare the target path
-            targetpath = os.path.join(rootdir, relativepath)
-            try:
-                os.makedirs(os.path.dirname(targetpath))
-            except:
-                pass
-            # print(sourcepath," => ", targetpath)
-            print("Updating: {}".format(relativepath))
-            shutil.copyfile(sourcepath, targetpath)
-            with cd(repo.rootdir):
-                self._run(['add', relativepath])
+            print("Updating: {}".format(f['relativepath']))
+            self.copy_file(repo, f, mode)
+            paths.append(f['relativepath'])
+
+        return self.stage_files(repo, paths)
+
+    def _clone_args(self, options):
+        """
+        Arguments to git clone for the clone options (see clone)
+        """
+        args = []
+        if options is None:
+            return args
+        if options.get('clone-depth'):
+            args.append('--depth={}'.format(int(options['clone-depth'])))
+        if options.get('clone-filter'):
+            args.append('--filter={}'.format(options['clone-filter']))
+        if options.get('clone-single-branch'):
+            args.append('--single-branch')
+        return args
+
+    def _check(self, result, what):
+        """
+        Raise an exception if the command failed. Returns the output.
+        """
+        if result.returncode != 0:
+            raise Exception("Could not {}: {}".format(what, result.output))
+        return result.output.strip()
+
+    def _stale_marker(self, repo):
+        return repo.cache_path('worktree', 'stale')
+
+    def worktree_stale(self, repo):
+        """
+        Check if commits have been made with commit_files that are not
+        reflected in the checkout yet
+        """
+        return repo.cache_check(self._stale_marker(repo))
+
+    def refresh_worktree(self, repo):
+        """
+        Bring the index and the checkout up to date with HEAD after
+        commit_files(refresh=False). Only the files that changed since
+        the commit the checkout reflects are written.
+        """
+        marker = self._stale_marker(repo)
+        if not repo.cache_check(marker):
+            return
+
+        old = repo.cache_read(marker).strip()
+        start = time.time()
+        result = self._execute(['read-tree', '-m', '-u', old, 'HEAD'],
+                               cwd=repo.rootdir)
+        if result.returncode != 0:
+            raise Exception("Could not refresh the checkout: " + result.output)
+        os.unlink(marker['full'])
+        print("Refreshed checkout in {:.2f}s".format(time.time() - start))
+
+    def commit_files(self, repo, files, message, refresh=False, mode=None):
+        """
+        Commit files directly into the object database without copying
+        them into the checkout or staging them. The blobs are written
+        by a single hash-object, the tree is built in a temporary index
+        that starts from HEAD, and HEAD is moved with update-ref.
+        datapackage.json is written from repo.package (and is the only
+        file updated in the checkout).
+
+        The rest of the checkout and its index are left at the previous
+        commit unless refresh is set. They are brought up to date the
+        next time the checkout is used (see refresh_worktree). Changes
+        staged in the checkout must be committed first.
+
+        Parameters
+        ----------
+
+        repo: Repository object
+        files: List of dicts with relativepath and localfullpath
+        message: Commit message
+        refresh: Update the checkout right away
+        mode: Ingest mode for large files (see copy_file)
+        """
+        start = time.time()
+        rootdir = repo.rootdir
+
+        result = self._execute(['rev-parse', '--verify', '-q', 'HEAD'], cwd=rootdir)
+        head = result.output.strip() if result.returncode == 0 else None
+
+        # Staged changes would not be part of the commit and would be
+        # dropped by the refresh. (While the checkout is stale nothing
+        # can be staged.)
+        if head is not None and not self.worktree_stale(repo):
+            staged = self._check(self._execute(['diff-index', '--cached',
+                                                '--name-only', 'HEAD'],
+                                               cwd=rootdir),
+                                 "check the staged files")
+            staged = [p for p in staged.split("\n")
+                      if p not in ["", "datapackage.json"]]
+            if len(staged) > 0:
+                raise Exception("Commit the staged changes first: {}".format(
+                    ", ".join(staged[:5])))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # relativepath => (filemode, path of the content)
+            entries = collections.OrderedDict()
+            inline = collections.OrderedDict()
+            for f in files:
+                sourcepath = f['localfullpath']
+                if sourcepath is None:
+                    # This can happen if the relative path is a URL
+                    continue
+                pointer = self._store_large_file(repo, f, mode)
+                if pointer is not None:
+                    inline[f['relativepath']] = pointer
+                    continue
+                filemode = '100755' if os.access(sourcepath, os.X_OK) else '100644'
+                entries[f['relativepath']] = (filemode, os.path.abspath(sourcepath))
+
+            # datapackage.json is written once the large files are in
+            # the store (which records their size, storage and
+            # manifest in the resources). It is kept current in the
+            # checkout so that the package is loaded correctly later,
+            # and staged so that the refresh does not see it as a
+            # local modification.
+            write_package(repo)
+            self._check(self._execute(['add', 'datapackage.json'], cwd=rootdir),
+                        "stage datapackage.json")
+
+            for i, (relativepath, content) in enumerate(inline.items()):
+                path = os.path.join(tmpdir, "inline{}".format(i))
+                with open(path, 'w') as fd:
+                    fd.write(content)
+                entries[relativepath] = ('100644', path)
+            entries['datapackage.json'] = ('100644',
+                                           os.path.join(rootdir, 'datapackage.json'))
+
+            paths = [e[1] for e in entries.values()]
+            for p in paths:
+                if "\n" in p:
+                    raise Exception("Cannot commit paths with newlines: {}".format(p))
+
+            output = self._check(self._execute(['hash-object', '-w', '--no-filters',
+                                                '--stdin-paths'],
+                                               stdin="".join([p + "\n" for p in paths]).encode('utf-8'),
+                                               cwd=rootdir),
+                                 "write blobs")
+            blobs = output.split("\n")
+            if len(blobs) != len(paths):
+                raise Exception("Could not write blobs: " + output)
+
+            env = {'GIT_INDEX_FILE': os.path.join(tmpdir, 'index')}
+            if head is not None:
+                self._check(self._execute(['read-tree', head], cwd=rootdir, env=env),
+                            "read tree")
+
+            indexinfo = "".join(["{} {}\t{}\0".format(filemode, blob, relativepath)
+                                 for ((relativepath, (filemode, path)), blob)
+                                 in zip(entries.items(), blobs)])
+            self._check(self._execute(['update-index', '-z', '--index-info'],
+                                      stdin=indexinfo.encode('utf-8'),
+                                      cwd=rootdir, env=env),
+                        "update index")
+
+            tree = self._check(self._execute(['write-tree'], cwd=rootdir, env=env),
+                               "write tree")
+        finally:
+            shutil.rmtree(tmpdir)
+
+        cmd = ['commit-tree', tree, '-m', message]
+        if head is not None:
+            cmd += ['-p', head]
+        commit = self._check(self._execute(cmd, cwd=rootdir), "commit")
+
+        self._check(self._execute(['update-ref', '-m', 'commit: ' + message,
+                                   'HEAD', commit, head or '0' * 40],
+                                  cwd=rootdir),
+                    "update HEAD")
+
+        # Remember the tree the index of the checkout still reflects
+        index = self._check(self._execute(['write-tree'], cwd=rootdir),
+                            "write tree")
+        repo.cache_write(self._stale_marker(repo), index)
+
+        elapsed = time.time() - start
+        print("Committed {} file(s) in {:.2f}s".format(len(entries), elapsed))
+
+        if refresh:
+            self.refresh_worktree(repo)
+
+        return {
+            'status': 'success',
+            'message': commit,
+            'commit': commit,
+            'committed': len(entries),
+            'elapsed': elapsed
+        }
+
+    def load_package(self, repo):
+        """
+        Read the repo's datapackage.json. In a sparse checkout, each
+        resource is marked with whether it is materialized (on disk).
+        """
+        package = os.path.join(repo.rootdir, 'datapackage.json')
+        packagedata = open(package).read()
+        package = json.JSONDecoder(object_pairs_hook=collections.OrderedDict).decode(packagedata)
+        if self.is_sparse(repo):
+            self._mark_materialized(repo, package)
+        return package
+
+    # Files that are in every sparse checkout
+    sparse_always = ['/datapackage.json', '/.gitignore']
+
+    def _sparse_file(self, repo):
+        """
+        File with the selection of a sparse checkout. It is in the git
+        directory, which is not always .git (e.g., worktrees).
+        """
+        path = self.sparse_files.get(repo.rootdir)
+        if path is None:
+            result = self._execute(['rev-parse', '--git-path', 'info/dgit-sparse'],
+                                   cwd=repo.rootdir)
+            if result.returncode != 0:
+                return os.path.join(repo.rootdir, '.git', 'info', 'dgit-sparse')
+            path = os.path.join(repo.rootdir, result.output.strip())
+            self.sparse_files[repo.rootdir] = path
+        return path
+
+    def is_sparse(self, repo):
+        return os.path.exists(self._sparse_file(repo))
+
+    def sparse_patterns(self, repo):
+        """
+        Resource patterns selected for materialization or None if the
+        whole repo is checked out
+        """
+        if not self.is_sparse(repo):
+            return None
+        return open(self._sparse_file(repo)).read().splitlines()
+
+    def _mark_materialized(self, repo, package):
+        for r in package['resources']:
+            path = os.path.join(repo.rootdir, r['relativepath'])
+            r['materialized'] = os.path.exists(path)
+
+    def _sparse_spec(self, paths):
+        """
+        git sparse-checkout (non-cone) patterns for a list of paths
+        """
+        return ["/" + re.sub(r'([\\*?\[ !#])', r'\\\1', p) for p in paths]
+
+    def sparse_checkout(self, repo, patterns):
+        """
+        Materialize only the resources that match the patterns (see
+        Repo.find_matching_files). datapackage.json is always
+        materialized and lists all the resources. The selection is
+        kept in .git/info/dgit-sparse and reapplied on pull. Files
+        added to the repo later become part of the selection.
+
+        Parameters
+        ----------
+
+        repo: Repository object
+        patterns: List of patterns or None to materialize everything
+        """
+        rootdir = repo.rootdir
+        sparsefile = self._sparse_file(repo)
+
+        if patterns is None:
+            self._check(self._execute(['sparse-checkout', 'disable'], cwd=rootdir),
+                        "disable sparse checkout")
+            if os.path.exists(sparsefile):
+                os.unlink(sparsefile)
+            for r in repo.package['resources']:
+                r.pop('materialized', None)
+            return
+
+        with open(sparsefile, 'w') as fd:
+            fd.write("".join([p + "\n" for p in patterns]))
+
+        # The resources are listed individually. The patterns use
+        # fnmatch syntax which differs from git's.
+        paths = sorted(repo.find_matching_files(patterns))
+        spec = self.sparse_always + self._sparse_spec(paths)
+        self._check(self._execute(['sparse-checkout', 'set', '--no-cone', '--stdin'],
+                                  stdin="\n".join(spec).encode('utf-8'),
+                                  cwd=rootdir),
+                    "update sparse checkout")
+        self._mark_materialized(repo, repo.package)
+
+    def _add_to_sparse(self, repo, paths):
+        """
+        Include paths in the sparse checkout (before staging them)
+        """
+        with open(self._sparse_file(repo), 'a') as fd:
+            fd.write("".join([glob.escape(p) + "\n" for p in paths]))
+        spec = self._sparse_spec(paths)
+        self._check(self._execute(['sparse-checkout', 'add', '--stdin'],
+                                  stdin="\n".join(spec).encode('utf-8'),
+                                  cwd=repo.rootdir),
+                    "update sparse checkout")
 
     def config(self, what='get', params=None):
         """
@@ -524,11 +1211,29 @@ class GitRepoManager(RepoManagerBase):
             self.username = params['User']['user.name']
             self.fullname = params['User']['user.fullname']
             self.email = params['User']['user.email']
+            if self.executor is not None:
+                self.executor.close()
+            self.executor = None
+
+            if self.catalog is not None:
+                self.catalog.close()
+            self.catalog = Catalog(self.workspace)
+            self.repos = {}
 
             repodir = os.path.join(self.workspace, 'datasets')
             if not os.path.exists(repodir):
                 return
 
+            # The remote URLs of the repos known to the catalog are
+            # taken from it
+            known = {}
+            if self.catalog.exists():
+                try:
+                    for entry in self.catalog.search():
+                        known[(entry['username'], entry['reponame'])] = entry
+                except Exception as e:
+                    print("Could not read the workspace catalog:", e)
+
             for username in os.listdir(repodir):
                 for reponame in os.listdir(os.path.join(repodir, username)):
                     if self.is_my_repo(username, reponame):
@@ -540,11 +1245,26 @@ class GitRepoManager(RepoManagerBase):
                             print("Skipping: {}/{}".format(username, reponame))
                             continue
 
-                        packagedata = open(package).read()
-                        r.package = json.JSONDecoder(object_pairs_hook=collections.OrderedDict).decode(packagedata)
+                        # The package is parsed when it is first used
+                        r.set_package_loader(self.load_package)
                         r.manager = self
+                        entry = known.get((username, reponame))
+                        if entry is not None and entry['rootdir'] == r.rootdir:
+                            r.remoteurl = entry['remoteurl']
+                        else:
+                            result = self._execute(['config', '--get', 'remote.origin.url'],
+                                                   cwd=r.rootdir)
+                            if result.returncode == 0:
+                                r.remoteurl = result.output.strip()
                         self.add(r)
 
+            # Add the new repos to the catalog and remove the ones
+            # that are gone
+            try:
+                self.catalog.reconcile(list(self.repos.values()))
+            except Exception as e:
+                print("Could not update the workspace catalog:", e)
+
 def setup(mgr):
 
     obj = GitRepoManager()
@@ -4,7 +4,6 @@ import os, sys, glob2
 from collections import OrderedDict
 from dgitcore.plugins.representation import RepresentationBase
 from dgitcore.config import get_config
-from dgitcore.helper import cd
 import daff 
 from messytables import type_guess, \
   types_processor, headers_guess, headers_processor, \
@@ -4,7 +4,8 @@ import os, sys, glob2
 from collections import OrderedDict
 from dgitcore.plugins.validator import ValidatorBase
 from dgitcore.config import get_config
-from dgitcore.helper import compute_sha256, cd
+from dgitcore.datasets.fingerprint import checksums as fingerprint_checksums
+from dgitcore.datasets.objectstore import read_pointer
 
 class MetadataValidator(ValidatorBase):
     """
@@ -48,49 +49,56 @@ class MetadataValidator(ValidatorBase):
     def evaluate(self, repo, spec, args):
         """
         Check the integrity of the datapackage.json
+
+        Checksums are looked up in the fingerprint cache. Pass --verify
+        (or set verify in the spec) to rehash every file.
         """
 
+        verify = (spec.get('verify', repo.options.get('verify-checksums', False))
+                  or '--verify' in args)
+
         status = []
-        with cd(repo.rootdir):
-            files = spec.get('files', ['*'])
-            resource_files = repo.find_matching_files(files)
-            files = glob2.glob("**/*")
-            disk_files = [f for f in files if os.path.isfile(f) and f != "datapackage.json"]
-
-            allfiles = list(set(resource_files + disk_files))
-            allfiles.sort()
-
-            for f in allfiles:
-                if f in resource_files and f in disk_files:
-                    r = repo.get_resource(f)
-                    coded_sha256 = r['sha256']
-                    computed_sha256 = compute_sha256(f)
-                    if computed_sha256 != coded_sha256:
-                        status.append({
-                            'target': f,
-                            'rules': "",
-                            'validator': self.name,
-                            'description': self.description,
-                            'status': 'ERROR',
-                            'message': "Mismatch in checksum on disk and in datapackage.json"
-                        })
-                    else:
-                        status.append({
-                            'target': f,
-                            'rules': "",
-                            'validator': self.name,
-                            'description': self.description,
-                            'status': 'OK',
-                            'message': ""
-                        })
-                elif f in resource_files:
+        files = spec.get('files', ['*'])
+        resource_files = repo.find_matching_files(files)
+        rootdir = repo.rootdir
+        files = glob2.glob(os.path.join(rootdir, "**/*"))
+        disk_files = [os.path.relpath(f, rootdir) for f in files if os.path.isfile(f)]
+        disk_files = [f for f in disk_files if f != "datapackage.json"]
+
+        allfiles = list(set(resource_files + disk_files))
+        allfiles.sort()
+
+        common = [f for f in allfiles
+                  if f in resource_files and f in disk_files]
+
+        # Large files are represented by a pointer that carries
+        # the checksum of the content
+        pointers = {}
+        for f in common:
+            if repo.get_resource(f).get('storage') == 'objectstore':
+                pointer = read_pointer(os.path.join(rootdir, f))
+                if pointer is not None:
+                    pointers[f] = pointer['sha256']
+
+        paths = OrderedDict([(os.path.join(rootdir, f), f)
+                             for f in common if f not in pointers])
+        checksums = fingerprint_checksums(repo, list(paths.keys()), verify)
+        checksums = dict([(paths[p], sha256) for (p, sha256) in checksums.items()])
+        checksums.update(pointers)
+
+        for f in allfiles:
+            if f in resource_files and f in disk_files:
+                r = repo.get_resource(f)
+                coded_sha256 = r['sha256']
+                computed_sha256 = checksums[f]
+                if computed_sha256 != coded_sha256:
                     status.append({
                         'target': f,
                         'rules': "",
                         'validator': self.name,
                         'description': self.description,
                         'status': 'ERROR',
-                        'message': "In datapackage.json but not in repo"
+                        'message': "Mismatch in checksum on disk and in datapackage.json"
                     })
                 else:
                     status.append({
@@ -98,9 +106,27 @@ class MetadataValidator(ValidatorBase):
                         'rules': "",
                         'validator': self.name,
                         'description': self.description,
-                        'status': 'ERROR',
-                        'message': "In repo but not in datapackage.json"
-                        })
+                        'status': 'OK',
+                        'message': ""
+                    })
+            elif f in resource_files:
+                status.append({
+                    'target': f,
+                    'rules': "",
+                    'validator': self.name,
+                    'description': self.description,
+                    'status': 'ERROR',
+                    'message': "In datapackage.json but not in repo"
+                })
+            else:
+                status.append({
+                    'target': f,
+                    'rules': "",
+                    'validator': self.name,
+                    'description': self.description,
+                    'status': 'ERROR',
+                    'message': "In repo but not in datapackage.json"
+                    })
 
 
         return status
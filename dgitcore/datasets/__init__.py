@@ -13,10 +13,12 @@ def _reexport(mod):
     for var in mod.__all__:
         globals()[var] = getattr(mod, var)
 
-from ..datasets import common, files, validation, auto, transformation
+from ..datasets import common, files, validation, auto, transformation, objectstore, batch
 
 _reexport(common)
 _reexport(files)
 _reexport(validation)
 _reexport(auto)
 _reexport(transformation)
+_reexport(objectstore)
+_reexport(batch)
@@ -5,7 +5,7 @@ import fnmatch, re
 from ..config import get_config
 from ..plugins.common import plugins_get_mgr
 from .common import clone as common_clone, init as common_init, post as common_post
-from .files import add as files_add
+from .files import add_many as files_add_many
 from .history import get_history
 from datetime import datetime
 
@@ -215,7 +215,7 @@ def auto_get_repo(autooptions, debug=False):
             url = autooptions['remoteurl']
             if debug:
                 print("Doesnt exist. trying to clone: {}".format(url))
-            common_clone(url)
+            common_clone(url, autooptions)
             repo = repomgr.lookup(username=autooptions['username'],
                                   reponame=autooptions['reponame'])
             if debug:
@@ -291,8 +291,7 @@ def auto_add(repo, autooptions, files):
     keys = mapping.keys()
     keys = sorted(keys, key=lambda k: len(k), reverse=True)
 
-    count = 0
-    params = []
+    entries = []
     for f in files:
 
         # Find the destination
@@ -304,12 +303,13 @@ def auto_add(repo, autooptions, files):
                 relativepath = f.replace(k + "/", v)
                 break
 
-        # Now add to repository
-        count += files_add(repo=repo,
-                           args=[f],
-                           targetdir=os.path.dirname(relativepath))
+        entries.append(OrderedDict([
+            ('path', f),
+            ('targetdir', os.path.dirname(relativepath))
+        ]))
 
-    return count
+    # Now add to repository
+    return files_add_many(repo, entries)
 
 def auto_update(autofile, force_init):
 
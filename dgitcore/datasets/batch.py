@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Workspace-level batch operations. push, pull, status and commit are run
+on many repos over a bounded pool of worker threads. The number of
+operations in flight against each kind of backend (s3, git, local) can
+be limited separately so that, for instance, a large workspace does not
+open too many connections to S3 at once.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from ..plugins.common import plugins_get_mgr
+from ..exceptions import *
+from . import common
+
+#####################################################
+# Exports
+#####################################################
+
+__all__ = ['batch']
+
+# Number of repos processed in parallel unless specified
+BATCH_CONCURRENCY = 8
+
+batch_commands = OrderedDict([
+    ('push', common.push),
+    ('pull', common.pull),
+    ('status', common.status),
+    ('commit', common.commit),
+])
+
+def backend_type(repo):
+    """
+    Kind of backend behind the repo's remote: s3, git (remote git
+    server) or local
+    """
+    remoteurl = repo.remoteurl or ""
+    if remoteurl.startswith('s3'):
+        return 's3'
+    if "://" in remoteurl or "@" in remoteurl:
+        return 'git'
+    return 'local'
+
+def batch(cmd, repos=None, args=[], concurrency=None, limits=None):
+    """
+    Run a command on many repos in parallel
+
+    Parameters
+    ----------
+
+    cmd: push, pull, status or commit
+    repos: List of repos ((username, reponame) or repository objects).
+           Default: all the repos in the workspace
+    args: Arguments to the git command (e.g., ['-a', '-m', message]
+          for commit)
+    concurrency: Maximum number of repos processed at a time
+          (default: BATCH_CONCURRENCY)
+    limits: dict with the maximum number of repos processed at a time
+          for each backend type (s3, git, local)
+
+    Returns
+    -------
+
+    List of results in the order of repos. Each result has the
+    username, reponame and the cmd, status and message of the command.
+    """
+    if cmd not in batch_commands:
+        raise InvalidParameters("Unsupported batch command {}. Use one of {}".format(
+            cmd, ", ".join(batch_commands.keys())))
+
+    mgr = plugins_get_mgr()
+    repomgr = mgr.get(what='repomanager', name='git')
+
+    if repos is None:
+        repos = repomgr.get_repo_list()
+        repos.sort()
+    repos = [r if not isinstance(r, (list, tuple)) else
+             repomgr.lookup(username=r[0], reponame=r[1])
+             for r in repos]
+    if len(repos) == 0:
+        return []
+
+    if concurrency is None:
+        concurrency = BATCH_CONCURRENCY
+    concurrency = max(1, min(int(concurrency), len(repos)))
+
+    semaphores = {}
+    for (backend, limit) in (limits or {}).items():
+        semaphores[backend] = threading.BoundedSemaphore(max(1, int(limit)))
+
+    func = batch_commands[cmd]
+
+    def process(repo):
+        semaphore = semaphores.get(backend_type(repo))
+        if semaphore is not None:
+            semaphore.acquire()
+        try:
+            result = func(repo, list(args))
+        except Exception as e:
+            result = {
+                'cmd': [cmd] + list(args),
+                'status': 'error',
+                'message': str(e)
+            }
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+        return OrderedDict([
+            ('username', repo.username),
+            ('reponame', repo.reponame),
+            ('cmd', result.get('cmd', [cmd] + list(args))),
+            ('status', result['status']),
+            ('message', result['message'])
+        ])
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(process, repos))
+
+    failed = len([r for r in results if r['status'] != 'success'])
+    print("{}: {} repo(s), {} failed".format(cmd, len(results), failed))
+    return results
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Content-defined chunk store for large files. A file is split into
+chunks at boundaries that depend only on the bytes around them, so a
+new version of a file that changes a few rows shares all but the
+chunks around the change with the previous version. Only the new
+chunks are written.
+
+Layout (under the workspace):
+
+    chunks/<sha[:2]>/<sha[2:]>          zlib compressed chunk
+    manifests/<sha[:2]>/<sha[2:]>.json  chunk list of one file version
+
+Chunk boundaries are evaluated at line ends (datasets are mostly
+record oriented). A boundary is placed after a line if the hash of the
+window of bytes ending there is below a threshold proportional to the
+length of the line, which gives an average chunk size of
+CHUNK_AVGSIZE independent of the line length. Chunks are at least
+CHUNK_MINSIZE and at most CHUNK_MAXSIZE bytes long. Data without line
+ends is cut at CHUNK_MAXSIZE.
+"""
+
+import os, json, zlib, tempfile
+from hashlib import sha256 as sha256_hash
+from collections import OrderedDict
+
+CHUNK_MINSIZE = 16 * 1024
+CHUNK_AVGSIZE = 64 * 1024
+CHUNK_MAXSIZE = 256 * 1024
+CHUNK_WINDOW = 64
+
+# Size of the reads from the file being chunked
+CHUNK_READSIZE = 4 * 1024 * 1024
+
+def find_boundary(buf, start, final=False,
+                  minsize=CHUNK_MINSIZE, avgsize=CHUNK_AVGSIZE,
+                  maxsize=CHUNK_MAXSIZE):
+    """
+    Find the end of the chunk that starts at offset start of buf.
+    Returns None if buf does not have enough data to decide (and
+    final is False).
+    """
+    limit = min(len(buf), start + maxsize)
+    pos = start + minsize
+    if pos >= limit:
+        if final or limit == start + maxsize:
+            return limit
+        return None
+
+    # Start of the line that ends at the first candidate
+    linestart = buf.rfind(b'\n', 0, pos - 1) + 1
+    while True:
+        nl = buf.find(b'\n', pos - 1, limit)
+        if nl < 0:
+            break
+        end = nl + 1
+        h = zlib.crc32(buf[max(0, end - CHUNK_WINDOW):end])
+        if h < ((end - linestart) << 32) // avgsize:
+            return end
+        linestart = end
+        pos = end + 1
+
+    if final or limit == start + maxsize:
+        return limit
+    return None
+
+def iter_chunks(fd, readsize=CHUNK_READSIZE):
+    """
+    Read the file object and yield its content as chunks
+    """
+    buf = b""
+    final = False
+    while not final:
+        data = fd.read(readsize)
+        final = len(data) == 0
+        buf = buf + data if len(buf) > 0 else data
+        start = 0
+        while start < len(buf):
+            end = find_boundary(buf, start, final)
+            if end is None:
+                break
+            yield buf[start:end]
+            start = end
+        buf = buf[start:]
+
+class ChunkStore(object):
+    """
+    Store of file versions as chunks
+
+    Parameters
+    ----------
+
+    rootdir: Directory of the store (the workspace)
+    """
+    def __init__(self, rootdir):
+        self.rootdir = rootdir
+
+    def chunk_key(self, sha256):
+        return os.path.join('chunks', sha256[:2], sha256[2:])
+
+    def manifest_key(self, sha256):
+        return os.path.join('manifests', sha256[:2], sha256[2:] + ".json")
+
+    def path(self, key):
+        return os.path.join(self.rootdir, key)
+
+    def has(self, key):
+        return os.path.exists(self.path(key))
+
+    def write(self, key, content):
+        """
+        Atomically write content to key
+        """
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except:
+            pass
+        (handle, tmpname) = tempfile.mkstemp(dir=os.path.dirname(path),
+                                             prefix='.tmp')
+        with os.fdopen(handle, 'wb') as fd:
+            fd.write(content)
+        os.replace(tmpname, path)
+
+    def put(self, source, stats=None):
+        """
+        Chunk a file and store the chunks that are not in the store yet
+
+        Parameters
+        ----------
+
+        source: Path of the file
+        stats: Optional dict that is updated with the number and size
+               of the chunks written
+
+        Returns
+        -------
+
+        Manifest (dict with sha256, size and chunks)
+        """
+        filehash = sha256_hash()
+        chunks = []
+        size = 0
+        written = 0
+        writtenbytes = 0
+        with open(source, 'rb') as fd:
+            for chunk in iter_chunks(fd):
+                filehash.update(chunk)
+                size += len(chunk)
+                sha256 = sha256_hash(chunk).hexdigest()
+                chunks.append([sha256, len(chunk)])
+                key = self.chunk_key(sha256)
+                if not self.has(key):
+                    content = zlib.compress(chunk)
+                    self.write(key, content)
+                    written += 1
+                    writtenbytes += len(content)
+
+        manifest = OrderedDict([
+            ('sha256', filehash.hexdigest()),
+            ('size', size),
+            ('chunks', chunks)
+        ])
+        key = self.manifest_key(manifest['sha256'])
+        if not self.has(key):
+            self.write(key, json.dumps(manifest).encode('utf-8'))
+
+        if stats is not None:
+            stats['chunks'] = stats.get('chunks', 0) + len(chunks)
+            stats['written'] = stats.get('written', 0) + written
+            stats['writtenbytes'] = stats.get('writtenbytes', 0) + writtenbytes
+
+        return manifest
+
+    def manifest(self, sha256):
+        """
+        Load the manifest of a file version
+        """
+        path = self.path(self.manifest_key(sha256))
+        return json.loads(open(path).read())
+
+    def missing(self, manifest):
+        """
+        Keys of the chunks of a manifest that are not in the store
+        """
+        keys = OrderedDict()
+        for (sha256, size) in manifest['chunks']:
+            key = self.chunk_key(sha256)
+            if not self.has(key):
+                keys[key] = True
+        return list(keys.keys())
+
+    def assemble(self, manifest, target):
+        """
+        Write the content of a file version to target. The checksum of
+        the result is verified.
+        """
+        filehash = sha256_hash()
+        with open(target, 'wb') as fd:
+            for (sha256, size) in manifest['chunks']:
+                path = self.path(self.chunk_key(sha256))
+                chunk = zlib.decompress(open(path, 'rb').read())
+                filehash.update(chunk)
+                fd.write(chunk)
+
+        if filehash.hexdigest() != manifest['sha256']:
+            raise Exception("Checksum mismatch while assembling {}".format(manifest['sha256']))
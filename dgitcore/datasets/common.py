@@ -22,9 +22,12 @@ except:
     from urlparse import urlparse
 from ..config import get_config
 from ..plugins.common import plugins_get_mgr
-from ..helper import bcolors, clean_str, cd, compute_sha256, run, clean_name, log_repo_action 
+from ..helper import bcolors, clean_str, run, clean_name, log_repo_action 
 from ..exceptions import *
-from .history import get_history, get_diffs
+from .history import get_history, get_repo_history, get_diffs
+from . import fingerprint, objectstore
+from .package import write_package
+from .diffcache import DiffCache
 from .validation import validate
 
 #####################################################
@@ -37,7 +40,7 @@ __all__ = [
     'shellcmd',
     'log', 'show', 'push', 'pull', 'commit',
     'stash', 'drop', 'status', 'post',
-    'clone', 'init', 'diff',
+    'clone', 'init', 'diff', 'sparse_checkout',
     'remote', 'delete'
 ]
 
@@ -64,17 +67,29 @@ def list_repos(remote=False):
     Parameters
     ----------
 
-    remote: Flag
+    remote: Flag. Include the remote URL of each repo
+
+    Returns
+    -------
+
+    List of (username, reponame) or, if remote is set, (username,
+    reponame, remoteurl)
     """
     mgr = plugins_get_mgr()
+    repomgr = mgr.get(what='repomanager', name='git')
 
     if not remote:
-        repomgr = mgr.get(what='repomanager', name='git')
         repos = repomgr.get_repo_list()
         repos.sort()
         return repos
+    elif repomgr.catalog is not None:
+        return [(e['username'], e['reponame'], e['remoteurl'])
+                for e in repomgr.catalog.search()]
     else:
-        raise Exception("Not supported yet")
+        repos = [(r.username, r.reponame, r.remoteurl)
+                 for r in repomgr.repos.values()]
+        repos.sort(key=lambda r: r[:2])
+        return repos
 
 
 #####################################################
@@ -91,9 +106,7 @@ def shellcmd(repo, args):
     repo: Repository object
     args: Shell command
     """
-    with cd(repo.rootdir):
-        result = run(args)
-        return result
+    return run(args, cwd=repo.rootdir)
 
 
 def datapackage_exists(repo):
@@ -153,7 +166,8 @@ def remote(repo, args=[]):
 @log_repo_action 
 def push(repo, args=[]):
     """
-    Push changes to the backend
+    Push changes to the backend. Large files are uploaded to the
+    backend first so that the pushed pointers can be resolved.
 
     Parameters
     ----------
@@ -161,6 +175,7 @@ def push(repo, args=[]):
     repo: Repository object
     args: Arguments to git command
     """
+    objectstore.push(repo)
     return generic_repo_cmd(repo, 'push', args)
 
 @log_repo_action 
@@ -174,7 +189,9 @@ def pull(repo, args=[]):
     repo: Repository object
     args: Arguments to git command
     """
-    return generic_repo_cmd(repo, 'pull', args)
+    result = generic_repo_cmd(repo, 'pull', args)
+    repo.manager.update_catalog(repo)
+    return result
 
 @log_repo_action 
 def commit(repo, args=[]):
@@ -187,7 +204,9 @@ def commit(repo, args=[]):
     repo: Repository object
     args: Arguments to git command
     """
-    return generic_repo_cmd(repo, 'commit', args)
+    result = generic_repo_cmd(repo, 'commit', args)
+    repo.manager.update_catalog(repo)
+    return result
 
 def drop(repo, args=[]):
     """
@@ -259,34 +278,25 @@ def delete(repo, args=[]):
     # Remove the files 
     result = generic_repo_cmd(repo, 'delete', args)
     if result['status'] != 'success': 
-        return status 
-
-    with cd(repo.rootdir): 
-        
-        package = repo.package 
-        resources = package['resources'] 
-
-        cleaned_resources = []
-        for r in resources: 
-            relativepath = r['relativepath'] 
-            sha256 = r['sha256'] 
-            if relativepath not in ['', None]: 
-                if not os.path.exists(relativepath): 
-                    # This file does not exist on disk. 
-                    print("Skipping", relativepath) 
-                    continue 
-            cleaned_resources.append(r) 
-            
-        package['resources'] = cleaned_resources 
-        repo.package = package 
-        
-        with open('datapackage.json', 'w') as fd: 
-            fd.write(json.dumps(repo.package, indent=4))
-
-        return {
-            'status': 'success',
-            'message': ''
-        }
+        return result
+
+    removed = []
+    for r in repo.package['resources']:
+        relativepath = r['relativepath']
+        if relativepath not in ['', None]:
+            if not os.path.exists(os.path.join(repo.rootdir, relativepath)):
+                # This file does not exist on disk.
+                print("Skipping", relativepath)
+                removed.append(relativepath)
+
+    repo.remove_resources(removed)
+
+    write_package(repo)
+
+    return {
+        'status': 'success',
+        'message': ''
+    }
 
 
 
@@ -340,8 +350,8 @@ def bootstrap_datapackage(repo, force=False,
 
     # Now store the package...
     (handle, filename) = tempfile.mkstemp()
-    with open(filename, 'w') as fd:
-        fd.write(json.dumps(package, indent=4))
+    os.close(handle)
+    write_package(repo, filename, package)
 
     repo.package = package
 
@@ -408,10 +418,26 @@ def init(username, reponame, setup,
 
     args = ['-a', '-m', 'Bootstrapped the repo']
     repo.run('commit', args)
-    
+    repomgr.update_catalog(repo)
+
     return repo
 
-def clone(url):
+def sparse_checkout(repo, patterns):
+    """
+    Materialize only the resources of the repo that match the
+    patterns. datapackage.json continues to list all the resources;
+    each is marked with materialized=true/false.
+
+    Parameters
+    ----------
+
+    repo: Repository object
+    patterns: List of patterns (as in find_matching_files) or None to
+              materialize all the resources
+    """
+    repo.manager.sparse_checkout(repo, patterns)
+
+def clone(url, options=None):
     """
     Clone a URL. Examples include:
 
@@ -423,6 +449,9 @@ def clone(url):
     ----------
 
     url: URL of the repo
+    options: Clone options (clone-depth, clone-filter,
+             clone-single-branch, clone-sparse), usually the content
+             of dgit.json. See GitRepoManager.clone
 
     """
     backend = None
@@ -436,13 +465,14 @@ def clone(url):
 
     mgr = plugins_get_mgr()
     repomgr = mgr.get(what='repomanager', name='git')
-    backendmgr = mgr.get(what='backend', name=backendtype)
+    if backendtype is not None:
+        backendmgr = mgr.get(what='backend', name=backendtype)
 
     # print("Testing {} with backend {}".format(url, backendmgr))
     if backendmgr is not None and not backendmgr.url_is_valid(url):
         raise InvalidParameters("Invalid URL")
 
-    key = repomgr.clone(url, backendmgr)
+    key = repomgr.clone(url, backendmgr, options)
 
     # Insert a datapackage if it doesnt already exist...
     repo = repomgr.lookup(key=key)
@@ -459,6 +489,7 @@ def clone(url):
         args = ['-a', '-m', 'Bootstrapped the repo']
         repo.run('commit', args)
 
+    repomgr.update_catalog(repo)
     return repo
 
 
@@ -486,12 +517,14 @@ def annotate_metadata_data(repo, task, patterns=["*"], size=0):
             path = os.path.join(rootdir, relativepath)
             if task == 'preview':
                 print("Adding preview for ", relativepath)
-                f['content'] = open(path).read()[:size]
+                content = objectstore.materialize(repo, relativepath)
+                f['content'] = open(content).read()[:size]
             elif task == 'schema':
                 for r in representations: 
                     if r.can_process(path): 
                         print("Adding schema for ", path)
-                        f['schema'] = r.get_schema(path)
+                        content = objectstore.materialize(repo, relativepath)
+                        f['schema'] = r.get_schema(content)
                         break 
 
 def annotate_metadata_code(repo, files):
@@ -501,17 +534,23 @@ def annotate_metadata_code(repo, files):
 
     package = repo.package
     package['code'] = []
+
+    matching_files = []
     for p in files:
-        matching_files = glob2.glob("**/{}".format(p))
-        for f in matching_files:
-            absf = os.path.abspath(f)
-            print("Add commit data for {}".format(f))
-            package['code'].append(OrderedDict([
-                ('script', f),
-                ('permalink', repo.manager.permalink(repo, absf)),
-                ('mimetypes', mimetypes.guess_type(absf)[0]),
-                ('sha256', compute_sha256(absf))
-            ]))
+        matching_files.extend(glob2.glob("**/{}".format(p)))
+
+    absfiles = [os.path.abspath(f) for f in matching_files]
+    verify = repo.options.get('verify-checksums', False)
+    checksums = fingerprint.checksums(repo, absfiles, verify)
+    permalinks = repo.manager.permalinks(repo, absfiles)
+    for f, absf in zip(matching_files, absfiles):
+        print("Add commit data for {}".format(f))
+        package['code'].append(OrderedDict([
+            ('script', f),
+            ('permalink', permalinks[absf]),
+            ('mimetypes', mimetypes.guess_type(absf)[0]),
+            ('sha256', checksums[absf])
+        ]))
 
 
 def annotate_metadata_action(repo):
@@ -521,21 +560,20 @@ def annotate_metadata_action(repo):
     package = repo.package    
 
     print("Including history of actions")
-    with cd(repo.rootdir): 
-        filename = ".dgit/log.json"        
-        if os.path.exists(filename):             
-            history = open(filename).readlines() 
-            actions = []
-            for a in history: 
-                try: 
-                    a = json.loads(a)
-                    for x in ['code']: 
-                        if x not in a or a[x] == None: 
-                            a[x] = "..."
-                    actions.append(a)
-                except:
-                    pass 
-            package['actions'] = actions
+    filename = os.path.join(repo.rootdir, ".dgit", "log.json")
+    if os.path.exists(filename):             
+        history = open(filename).readlines() 
+        actions = []
+        for a in history: 
+            try: 
+                a = json.loads(a)
+                for x in ['code']: 
+                    if x not in a or a[x] == None: 
+                        a[x] = "..."
+                actions.append(a)
+            except:
+                pass 
+        package['actions'] = actions
 
 def annotate_metadata_platform(repo):
     """
@@ -551,8 +589,13 @@ def annotate_metadata_platform(repo):
 def annotate_metadata_diffs(repo):
 
     print("Computing schema changes")
-    with cd(repo.rootdir):
-        get_diffs(repo.package['history'])
+    options = repo.options
+    get_diffs(repo.package['history'], repo.rootdir,
+              workers=options.get('diff-workers'),
+              budget=options.get('diff-time-budget'),
+              maxdiffs=options.get('diff-max'),
+              memory=options.get('diff-memory'),
+              cache=DiffCache(repo, options.get('diff-cache-size')))
 
 def annotate_metadata_validation(repo):
 
@@ -638,7 +681,7 @@ def post(repo, args=[]):
 
         # Add data repo history
         if 'include-data-history' in metadata and metadata['include-data-history']:
-            repo.package['history'] = get_history(repo.rootdir)
+            repo.package['history'] = get_repo_history(repo)
 
         # Add action history 
         if 'include-action-history' in metadata and metadata['include-action-history']:
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Persistent cache of diffs. A diff between two blobs computed by a
+given version of a representation never changes, so it is stored in
+the repo's cache (.dgit/diffs) under the hash of (blob1, blob2,
+representation name, representation version) and reused by later
+runs. The cache is bounded in size; the least recently used entries
+are removed first.
+"""
+
+import os, json, hashlib, tempfile
+
+# Changed whenever the format of the entries changes
+DIFF_CACHE_VERSION = 1
+
+# Default bound on the size of the cache (MB)
+DIFF_CACHE_SIZE = 64
+
+class DiffCache(object):
+    """
+    Diffs stored as .dgit/diffs/<xx>/<hash>.json. The modification
+    time of an entry is updated when it is used and serves as its
+    recency.
+
+    Parameters
+    ----------
+
+    repo: Repository object
+    maxsize: Bound on the size of the cache in MB (default:
+             DIFF_CACHE_SIZE)
+    """
+    def __init__(self, repo, maxsize=None):
+        self.repo = repo
+        self.cachedir = os.path.dirname(repo.cache_path('diffs', 'entry')['full'])
+        if maxsize is None:
+            maxsize = DIFF_CACHE_SIZE
+        self.maxsize = float(maxsize) * 1024 * 1024
+        self.hits = 0
+        self.added = 0
+        # Entries added since the cache was last pruned
+        self.unpruned = 0
+
+    def cachepath(self, blobs, representation):
+        """
+        Location of the entry for a pair of blobs and a representation
+        (a plugin key with name and version). See Repo.cache_path.
+        """
+        key = json.dumps([DIFF_CACHE_VERSION, blobs[0], blobs[1],
+                          representation.name, representation.version])
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return self.repo.cache_path(os.path.join('diffs', digest[:2]),
+                                    digest, 'json')
+
+    def path(self, blobs, representation):
+        return self.cachepath(blobs, representation)['full']
+
+    def lookup(self, blobs, representation):
+        """
+        Returns (found, diff). The diff may be None if the
+        representation could not compute one.
+        """
+        cachepath = self.cachepath(blobs, representation)
+        try:
+            diff = json.loads(self.repo.cache_read(cachepath))
+        except (IOError, OSError, ValueError):
+            return (False, None)
+
+        try:
+            os.utime(cachepath['full'])
+        except OSError:
+            pass
+        self.hits += 1
+        return (True, diff)
+
+    def update(self, blobs, representation, diff):
+        path = self.path(blobs, representation)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except:
+            pass
+
+        (handle, tmpname) = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(handle, 'w') as fd:
+            fd.write(json.dumps(diff))
+        os.replace(tmpname, path)
+        self.added += 1
+        self.unpruned += 1
+
+    def prune(self):
+        """
+        Remove the least recently used entries until the cache is
+        within its size bound. The cache only grows when entries are
+        added, so nothing is done otherwise.
+        """
+        if self.unpruned == 0:
+            return
+
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.cachedir):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        self.unpruned = 0
+
+        if total <= self.maxsize:
+            return
+
+        entries.sort()
+        for (_, size, path) in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
@@ -16,20 +16,22 @@ import uuid, shutil
 from dateutil import parser
 from ..config import get_config
 from ..plugins.common import plugins_get_mgr
-from ..helper import bcolors, clean_str, cd, compute_sha256, run, clean_name
+from ..helper import bcolors, clean_str, compute_sha256_many, run, clean_name
+from . import fingerprint
+from .package import write_package
+from .ingest import IngestPipeline, merge_record
 
 #####################################################
 # Exports
 #####################################################
 
-__all__ = ['add']
+__all__ = ['add', 'add_many', 'commit_many']
 
 ############################################################
 # Add files and links...
 ############################################################
-def annotate_record(h):
+def insert_defaults(h):
 
-    # Insert defaults
     defaults = OrderedDict([
         ('type', 'data'),
         ('generator', False),
@@ -40,14 +42,37 @@ def annotate_record(h):
         if k not in h:
             h[k] = v
 
+    return h
+
+def annotate_records(records, cache=None):
+    """
+    Insert defaults, mimetypes and checksums into a batch of records.
+    The files are hashed together so that large batches can use the
+    process pool. If the fingerprint cache is specified, files that
+    have not changed are not rehashed.
+    """
+
+    for h in records:
+        insert_defaults(h)
+
+    paths = [h['localfullpath'] for h in records]
+    if cache is not None:
+        checksums = cache.checksums(paths)
+    else:
+        checksums = compute_sha256_many(paths)
+
     # Update UUID and other detauls
-    f = h['localfullpath']
-    h.update(OrderedDict([
-        ('mimetypes', mimetypes.guess_type(f)[0]),
-        ('sha256', compute_sha256(f))
-    ]))
+    for h in records:
+        f = h['localfullpath']
+        h.update(OrderedDict([
+            ('mimetypes', mimetypes.guess_type(f)[0]),
+            ('sha256', checksums[f])
+        ]))
 
-    return h
+    return records
+
+def annotate_record(h):
+    return annotate_records([h])[0]
 
 def add_link(f):
     update = OrderedDict([
@@ -87,27 +112,32 @@ def add_file_normal(f, targetdir, generator,script, source):
         ('relativepath', relativepath),
         ('content', ""),
         ('source', source),
-        ('localfullpath', f),
+        ('localfullpath', os.path.abspath(f)),
         ('localrelativepath', relpath)
     ])
 
-    update = annotate_record(update)
-
     return (basename, update)
 
 
-def add_files(args, targetdir, generator, source, script):
+def gather_entries(entries):
+    """
+    Build the resource records for a batch of entries. Each entry is
+    a dict with the path of the file and optionally the targetdir,
+    generator, source and script flags (see add). Mimetypes and
+    checksums are filled in by the ingest pipeline.
+    """
 
-    seen = []
+    seen = set()
     files = []
-    for f in args:
+    for e in entries:
+        f = e['path']
         # print("Looking at", f)
         if "://" not in f:
             (base, update) = add_file_normal(f=f,
-                                             targetdir=targetdir,
-                                             generator=generator,
-                                             script=script,
-                                             source=source)
+                                             targetdir=e.get('targetdir', '.'),
+                                             generator=e.get('generator', False),
+                                             script=e.get('script', False),
+                                             source=e.get('source', None))
         else:
             print("Adding special file")
             (base, update) = add_link(f)
@@ -115,13 +145,13 @@ def add_files(args, targetdir, generator, source, script):
         if base not in seen:
             update['change'] = 'add'
             ts = datetime.now()
-            seen.append(base)
+            seen.add(base)
         else:
             update['change'] = 'update'
             ts = os.path.getmtime(f)
             ts = datetime.fromtimestamp(ts)
         update['ts'] = ts.isoformat()
-        files.append(update)
+        files.append(insert_defaults(update))
 
     return files
 
@@ -244,6 +274,7 @@ def extract_files(filename, includes):
 
     result = []
     ts = datetime.now().isoformat()
+    checksums = compute_sha256_many(filenames)
     for f in filenames:
         relativepath = prefixes[os.path.dirname(f)]
         if relativepath == ".":
@@ -257,7 +288,7 @@ def extract_files(filename, includes):
             ('actions', files[f]),
             ('mimetypes', mimetypes.guess_type(f)[0]),
             ('content', open(f).read(512)),
-            ('sha256', compute_sha256(f)),
+            ('sha256', checksums[f]),
             ('ts', ts),
             ('localrelativepath', os.path.relpath(f, ".")),
             ('localfullpath', os.path.abspath(f)),
@@ -349,7 +380,8 @@ def run_executable(repo, args, includes):
 def add(repo, args, targetdir,
         execute=False, generator=False,
         includes=[], script=False,
-        source=None):
+        source=None, verify=None, ingest_mode=None,
+        concurrency=None):
     """
     Add files to the repository by explicitly specifying them or by
     specifying a pattern over files accessed during execution of an
@@ -372,61 +404,157 @@ def add(repo, args, targetdir,
     script: Is this a script?
     generator: Is this a generator
     source: Link to the original source of the data
+    verify: Rehash all files ignoring the fingerprint cache (default:
+         verify-checksums in dgit.json)
+    ingest_mode: How files are copied into the repo - reflink, hardlink,
+         copy_file_range or copy (default: ingest-mode in dgit.json)
+    concurrency: Number of files hashed and copied in parallel
+         (default: ingest-concurrency in dgit.json)
 
     """
 
-    # Gather the files...
     if not execute:
-        files = add_files(args=args,
-                          targetdir=targetdir,
-                          source=source,
-                          script=script,
-                          generator=generator)
-    else:
-        files = run_executable(repo, args, includes)
+        entries = [OrderedDict([
+            ('path', f),
+            ('targetdir', targetdir),
+            ('generator', generator),
+            ('source', source),
+            ('script', script)
+        ]) for f in args]
+        return add_many(repo, entries,
+                        verify=verify,
+                        ingest_mode=ingest_mode,
+                        concurrency=concurrency)
+
+    if verify is None:
+        verify = repo.options.get('verify-checksums', False)
+    cache = fingerprint.FingerprintCache(repo, verify)
+
+    files = run_executable(repo, args, includes)
+
+    return ingest_records(repo, files, cache, ingest_mode, concurrency)
+
+def add_many(repo, entries, verify=None, ingest_mode=None,
+             concurrency=None):
+    """
+    Add a batch of files to the repository. The whole batch is
+    annotated, deduplicated against the existing resources, copied
+    and staged together, and datapackage.json is written once.
+
+    Parameters
+    ----------
+
+    repo: Repository
+    entries: List of dicts, one per file, with
+         path: Path of the file (or URL)
+         targetdir: Target directory in the repo (default: .)
+         generator, script: Flags as in add (default: False)
+         source: Link to the original source of the data
+    verify: Rehash all files ignoring the fingerprint cache (default:
+         verify-checksums in dgit.json)
+    ingest_mode: How files are copied into the repo (see add)
+    concurrency: Number of files hashed and copied in parallel (see add)
+
+    Returns
+    -------
+
+    Number of files added or updated
+    """
+
+    if verify is None:
+        verify = repo.options.get('verify-checksums', False)
+    cache = fingerprint.FingerprintCache(repo, verify)
+
+    files = gather_entries(entries)
+
+    return ingest_records(repo, files, cache, ingest_mode, concurrency)
+
+def ingest_records(repo, files, cache, ingest_mode=None, concurrency=None):
+    """
+    Update the package with the records that have changed, copy and
+    stage the files and write datapackage.json
+    """
 
     if files is None or len(files) == 0:
-        return repo
+        return 0
 
+    # A path may show up more than once in a batch. The last one wins.
+    files = list(OrderedDict([(h['relativepath'], h) for h in files]).values())
 
-    # Update the repo package but with only those that have changed.
+    # Files are copied into the checkout. It must be up to date.
+    repo.manager.refresh_worktree(repo)
 
-    filtered_files = []
-    package = repo.package
-    for h in files:
-        found = False
-        for i, r in  enumerate(package['resources']):
-            if h['relativepath'] == r['relativepath']:
-                found = True
-                if h['sha256'] == r['sha256']:
-                    change = False
-                    for attr in ['source']:
-                        if h[attr] != r[attr]:
-                            r[attr] = h[attr]
-                            change = True
-                    if change:
-                        filtered_files.append(h)
-                    continue
-                else:
-                    filtered_files.append(h)
-                    package['resources'][i] = h
-                break
-        if not found:
-            filtered_files.append(h)
-            package['resources'].append(h)
+    # Update the repo package but with only those that have changed.
+    # Hashing, copying and staging overlap in the pipeline.
+    pipeline = IngestPipeline(repo, cache,
+                              concurrency=concurrency,
+                              mode=ingest_mode)
+    filtered_files = pipeline.run(files)
+    cache.save()
 
     if len(filtered_files) == 0:
         return 0
 
-    # Copy the files
-    repo.manager.add_files(repo, filtered_files)
-
     # Write to disk...
-    rootdir = repo.rootdir
-    with cd(rootdir):
-        datapath = "datapackage.json"
-        with open(datapath, 'w') as fd:
-            fd.write(json.dumps(package, indent=4))
+    write_package(repo)
 
     return len(filtered_files)
 
+def commit_many(repo, entries, message, verify=None, refresh=False):
+    """
+    Add and commit a batch of files without copying them into the
+    checkout or staging them. The blobs, tree and commit are written
+    directly (see GitRepoManager.commit_files). This is meant for
+    append-only ingestion of many files.
+
+    Parameters
+    ----------
+
+    repo: Repository
+    entries: List of dicts, one per file (see add_many)
+    message: Commit message
+    verify: Rehash all files ignoring the fingerprint cache (default:
+         verify-checksums in dgit.json)
+    refresh: Update the checkout right away. Otherwise it is updated
+         the next time it is used.
+
+    Returns
+    -------
+
+    Number of files added or updated
+    """
+
+    if verify is None:
+        verify = repo.options.get('verify-checksums', False)
+    cache = fingerprint.FingerprintCache(repo, verify)
+
+    files = gather_entries(entries)
+    files = list(OrderedDict([(h['relativepath'], h) for h in files]).values())
+
+    paths = [h['localfullpath'] for h in files if h['localfullpath'] is not None]
+    checksums = cache.checksums(paths)
+    cache.save()
+
+    changed = []
+    content = []
+    for h in files:
+        f = h['localfullpath']
+        if f is not None:
+            h['mimetypes'] = mimetypes.guess_type(f)[0]
+            h['sha256'] = checksums[f]
+        change = merge_record(repo, h)
+        if change is None:
+            continue
+        changed.append(h)
+        if change == 'content':
+            content.append(h)
+
+    if len(changed) == 0:
+        return 0
+
+    result = repo.manager.commit_files(repo, content, message, refresh=refresh)
+    if result is not None and result['status'] != 'success':
+        raise Exception("Could not commit files: " + result['message'])
+    repo.manager.update_catalog(repo)
+
+    return len(changed)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Persistent cache of file checksums. Each entry is keyed by the path of
+the file and validated against (inode, size, mtime_ns) so that files
+that have not changed since they were last hashed are not read again.
+"""
+
+import os, json, time, tempfile
+from collections import OrderedDict
+from ..helper import compute_sha256_many
+
+class FingerprintCache(object):
+    """
+    Map of path => (inode, size, mtime_ns, sha256) stored in
+    .dgit/fingerprints/sha256.json of the repo.
+
+    Paths within the repo are stored relative to the repo root. Paths
+    outside (e.g., sources of files being added) are stored as
+    absolute paths.
+
+    Parameters
+    ----------
+
+    repo: Repository object
+    verify: Ignore the cached checksums, rehash every file and record
+            the files whose cached checksum turned out to be stale
+    """
+
+    # Files modified within this window (in ns) are not cached. Their
+    # mtime may not change on a subsequent write with filesystems
+    # that have coarse timestamps.
+    racy_window = 2 * 10**9
+
+    def __init__(self, repo, verify=False):
+        self.repo = repo
+        self.verify = verify
+        self.cachepath = repo.cache_path('fingerprints', 'sha256', 'json')
+        self.entries = {}
+        self.mismatches = []
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not self.repo.cache_check(self.cachepath):
+            return
+        try:
+            self.entries = json.loads(self.repo.cache_read(self.cachepath))
+        except:
+            # Corrupted cache. It will be rebuilt.
+            self.entries = {}
+
+    def save(self):
+        """
+        Atomically write the cache if it has changed
+        """
+        if not self.dirty:
+            return
+
+        path = self.cachepath['full']
+        try:
+            os.makedirs(os.path.dirname(path))
+        except:
+            pass
+
+        (handle, tmpname) = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(handle, 'w') as fd:
+            fd.write(json.dumps(self.entries))
+        os.replace(tmpname, path)
+        self.dirty = False
+
+    def key(self, path):
+        path = os.path.abspath(path)
+        rootdir = os.path.abspath(self.repo.rootdir)
+        if path.startswith(rootdir + os.sep):
+            return os.path.relpath(path, rootdir)
+        return path
+
+    def lookup(self, path, st=None):
+        """
+        Return the cached sha256 of the path if the file is unchanged
+        """
+        entry = self.entries.get(self.key(path))
+        if entry is None:
+            return None
+
+        if st is None:
+            st = os.stat(path)
+        if entry[:3] != [st.st_ino, st.st_size, st.st_mtime_ns]:
+            return None
+        return entry[3]
+
+    def update(self, path, sha256, st=None):
+        if st is None:
+            st = os.stat(path)
+        if st.st_mtime_ns > time.time() * 10**9 - self.racy_window:
+            return
+        self.entries[self.key(path)] = [st.st_ino, st.st_size,
+                                        st.st_mtime_ns, sha256]
+        self.dirty = True
+
+    def invalidate(self, paths=None):
+        """
+        Drop the cached entries for paths (all entries if None)
+        """
+        if paths is None:
+            if len(self.entries) > 0:
+                self.entries = {}
+                self.dirty = True
+            return
+
+        for p in paths:
+            if self.entries.pop(self.key(p), None) is not None:
+                self.dirty = True
+
+    def checksums(self, paths):
+        """
+        Compute the sha256 of paths, hashing only the files that are
+        not in the cache (or all files in verify mode).
+
+        Returns
+        -------
+
+        OrderedDict of path => sha256 in the order of the paths
+        """
+
+        paths = list(OrderedDict.fromkeys(paths))
+        stats = {}
+        result = OrderedDict()
+        missing = []
+        for p in paths:
+            st = os.stat(p)
+            stats[p] = st
+            cached = None if self.verify else self.lookup(p, st)
+            if cached is None:
+                missing.append(p)
+            result[p] = cached
+
+        computed = compute_sha256_many(missing)
+        for p in missing:
+            sha256 = computed[p]
+            if self.verify and self.lookup(p, stats[p]) not in [None, sha256]:
+                self.mismatches.append(p)
+            result[p] = sha256
+            self.update(p, sha256, stats[p])
+
+        return result
+
+def checksums(repo, paths, verify=False):
+    """
+    Compute the checksums of the paths using the repo's fingerprint
+    cache. The cache is saved before returning.
+    """
+    cache = FingerprintCache(repo, verify)
+    result = cache.checksums(paths)
+    if len(cache.mismatches) > 0:
+        print("Stale fingerprints found for {} file(s)".format(len(cache.mismatches)))
+    cache.save()
+    return result
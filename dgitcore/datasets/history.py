@@ -1,116 +1,211 @@
 #!/usr/bin/env python
 
-import os, sys, parse, shutil 
-import traceback 
-import subprocess, pipes
+import os
+import subprocess
 from collections import OrderedDict
 import tempfile 
-import json
-import daff
-from ..helper import run, cd
+import json, time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from ..gitexec import get_executor
 from ..plugins.common import plugins_get_mgr
 
-def get_change():
-
-    cmd = ["git", "log", "--all", "--branches", "--numstat"]
-    output = run(cmd)
+def run_git(args, gitdir=None):
+    """
+    Run git in gitdir (default: current directory) and return the
+    output
+    """
+    return get_executor().run(args, cwd=gitdir).output.strip()
 
-    #commit 6a9c9e0db3869df252910dbcdae8cc97fa0291e4
-    #Author: Venkata Pingali <pingali@gmail.com>
-    #Date:   Fri Feb 26 17:07:50 2016 +0530
-    #
-    #    1. Simplify the SQL and post-processing scripts
-    #
-    #5       3       performance/bin/analyze
-    #21      20      performance/bin/gather-rawdata.sh
-    #
+def is_partial(gitdir="."):
+    """
+    Check if the repo is a partial clone (objects may be missing and
+    are fetched from the remote when they are read)
+    """
+    output = run_git(["config", "--get-regexp",
+                      r"^(extensions\.partialclone|remote\..*\.promisor)$"],
+                     gitdir)
+    return output != ""
+
+# Fields of a commit record and their git log placeholders. Nested
+# fields (author, commiter) are given as (field, subfield).
+history_fields = [
+    ('commit', '%H'),
+    ('abbreviated_commit', '%h'),
+    ('tree', '%T'),
+    ('abbreviated_tree', '%t'),
+    ('parent', '%P'),
+    ('abbreviated_parent', '%p'),
+    ('refs', '%d'),
+    ('encoding', '%e'),
+    ('subject', '%s'),
+    ('sanitized_subject_line', '%f'),
+    (('author', 'name'), '%aN'),
+    (('author', 'email'), '%aE'),
+    (('author', 'date'), '%ai'),
+    (('commiter', 'name'), '%cN'),
+    (('commiter', 'email'), '%cE'),
+    (('commiter', 'date'), '%ci'),
+]
+
+# Size of the pieces in which the output of git log is read
+HISTORY_READSIZE = 64 * 1024
+
+def _tokens(stream):
+    """
+    Split a stream into NUL-terminated tokens
+    """
+    leftover = b""
+    while True:
+        data = stream.read(HISTORY_READSIZE)
+        if len(data) == 0:
+            break
+        tokens = (leftover + data).split(b"\0")
+        leftover = tokens.pop()
+        for t in tokens:
+            yield t.decode('utf-8', 'replace')
+    if len(leftover) > 0:
+        yield leftover.decode('utf-8', 'replace')
+
+def _new_record(values):
+    record = OrderedDict()
+    for ((key, _), value) in zip(history_fields, values):
+        if isinstance(key, tuple):
+            record.setdefault(key[0], OrderedDict())[key[1]] = value
+        else:
+            record[key] = value
+        if key == 'sanitized_subject_line':
+            record['commit_notes'] = ""
+    record['changes'] = []
+    return record
 
+def iter_history(gitdir=".", reverse=False, exclude=None):
+    """
+    Stream the commits of all the branches with the files that each
+    commit changed (added and deleted lines, or "-" for binary files
+    and in partial clones). A single git log is run and records are
+    yielded as they are parsed, so memory use does not grow with the
+    length of the history.
+
+    Parameters
+    ----------
+
+    gitdir: Directory of the repo
+    reverse: Oldest commit first (default: newest first)
+    exclude: Commits whose history is left out (e.g., the tips
+             of a history that has already been processed)
+    """
 
+    # --numstat needs the content of every version of every file. In
+    # a partial clone that would fetch all the blobs, so only the
+    # names of the changed files are collected.
+    partial = is_partial(gitdir)
+
+    # Each commit is \x01 followed by the NUL separated fields and
+    # then the NUL terminated changes:
+    #   <added>\t<deleted>\t<path> with --numstat
+    #   <status>, <path> with --name-status
+    fmt = "%x01" + "%x00".join([placeholder for (_, placeholder) in history_fields])
+    # --date-order so that parents always come before children in
+    # reverse (associate_branches depends on it) even when commits
+    # have the same timestamp
+    cmd = ["log", "--exclude=refs/notes/*", "--all", "--date-order", "-z",
+           "--no-renames", "--format=" + fmt]
+    cmd.append("--name-status" if partial else "--numstat")
+    if reverse:
+        cmd.append("--reverse")
+    if exclude:
+        cmd += ["--not"] + list(exclude)
+
+    executor = get_executor()
+    p = subprocess.Popen([executor.git] + cmd,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL,
+                         cwd=gitdir,
+                         env=executor.environ)
+    try:
+        record = None
+        values = None
+        status = None
+        for token in _tokens(p.stdout):
+            if token.startswith("\x01"):
+                if record is not None:
+                    yield record
+                record = None
+                values = [token[1:]]
+                status = None
+            elif values is not None:
+                values.append(token)
+            elif record is not None:
+                token = token.lstrip("\n")
+                if token == "":
+                    continue
+                if partial:
+                    if status is None:
+                        status = token
+                        continue
+                    record['changes'].append({
+                        'added': "-",
+                        'deleted': "-",
+                        'path': token
+                    })
+                    status = None
+                else:
+                    parts = token.split("\t", 2)
+                    if len(parts) == 3:
+                        record['changes'].append({
+                            'added': parts[0],
+                            'deleted': parts[1],
+                            'path': parts[2]
+                        })
+
+            if values is not None and len(values) == len(history_fields):
+                record = _new_record(values)
+                values = None
+
+        if record is not None:
+            yield record
+    finally:
+        if p.poll() is None:
+            p.kill()
+        p.stdout.close()
+        p.wait()
+
+def get_change(gitdir="."):
+    """
+    Files changed by each commit (keyed by the abbreviated commit)
+    """
     changes = {}
-    h = None
-    lines = output.split("\n")
-    for l in lines:
-        #if l.startswith("Date") or l.startswith("Author"):
-        #    continue
-        r =  parse.parse("commit {commit}", l)
-        if r is not None:
-            if h is not None:
-                changes[h['abbrev-commit']] = h
-            h = {
-                'abbrev-commit': r['commit'][:7],
-                'commit': r['commit'],
-                'changes': []
-            }
-            continue
-
-        r =  parse.parse("{added}\t{deleted}\t{path}", l)
-        if r is not None:
-            h['changes'].append({
-                'added': r['added'],
-                'deleted': r['deleted'],
-                'path': r['path']
-            })
-            continue
-
-        # print("Skipping ", l)
-
-    if h is not None:
-        changes[h['abbrev-commit']] = h
-
+    for h in iter_history(gitdir):
+        changes[h['abbreviated_commit']] = {
+            'abbrev-commit': h['abbreviated_commit'],
+            'commit': h['commit'],
+            'changes': h['changes']
+        }
     return changes
 
 def get_tree(gitdir="."):
     """
-    Get the commit history for a given dataset
+    Get the commit history for a given dataset. First commit first.
     """
+    return list(iter_history(gitdir, reverse=True))
 
-    cmd = ["git", "log", "--all", "--branches", '--pretty=format:{  "commit": "%H",  "abbreviated_commit": "%h",  "tree": "%T",  "abbreviated_tree": "%t",  "parent": "%P",  "abbreviated_parent": "%p",  "refs": "%d",  "encoding": "%e",  "subject": "%s", "sanitized_subject_line": "%f",  "commit_notes": "",  "author": {    "name": "%aN",    "email": "%aE",    "date": "%ai"  },  "commiter": {    "name": "%cN",    "email": "%cE",    "date": "%ci"  }},']
-
-    output = run(cmd)
-    lines = output.split("\n")
-
-    content = ""
-    history = []
-    for l in lines:
-        try:
-            revisedcontent = content + l
-            if revisedcontent.count('"') % 2 == 0:
-                j = json.loads(revisedcontent[:-1])
-                if "Notes added by" in j['subject']:
-                    content = ""
-                    continue
-                history.append(j)
-                content = ""
-            else:
-                content = revisedcontent
-        except Exception as e:
-            print("Error while parsing record")
-            print(revisedcontent)
-            content = ""
-
-    # Order by time. First commit first...
-    history.reverse()
-
-    #
-    changes = get_change()
-
-    for i in range(len(history)):
-        abbrev_commit = history[i]['abbreviated_commit']
-        if abbrev_commit not in changes:
-            raise Exception("Missing changes for " + abbrev_commit)
-
-        history[i]['changes'] = changes[abbrev_commit]['changes']
-
-
-    return history
-
-def associate_branches(history):
+def associate_branches(history, start=0):
+    """
+    Annotate each commit with its branch and action (commit, branch,
+    merge). Commits before start are taken to be annotated already.
+    """
 
     # print(json.dumps(history, indent=4))
 
     branches = {}
+    for h in history[:start]:
+        branches[h['commit']] = {
+            'branch': h['branch'],
+            'children': []
+        }
 
-    for i in range(len(history)):
+    for i in range(start, len(history)):
 
         h = history[i]
         # print(json.dumps(h, indent=4))
@@ -126,16 +221,18 @@ def associate_branches(history):
             'timestamp': timestamp,
             'author': author,
         }
-        if parent == "":
+        # Parents that are not in the history (boundary of a shallow
+        # clone, unavailable objects) are ignored
+        parent = [p for p in parent.split(" ") if p in branches]
+        if len(parent) == 0:
             d.update({
                 'parent-branches': [],
                 'branch': 'master',
                 'action': 'commit',
                 'children': []
             })
-        elif " " in parent:
+        elif len(parent) > 1:
             # Merge action
-            parent = parent.split(" ")
             d.update({
                 'parent-branches': [branches[parent[0]]['branch'],
                                      branches[parent[1]]['branch']],
@@ -145,8 +242,8 @@ def associate_branches(history):
             })
             branches[parent[0]]['children'].append(commit)
             branches[parent[1]]['children'].append(commit)
-        elif ((refs == "") or (refs != "" and 'tag' in refs)) \
-             and parent in branches:
+        elif (refs == "") or (refs != "" and 'tag' in refs):
+            parent = parent[0]
             d.update({
                 'parent-branches': [branches[parent]['branch']],
                 'branch': branches[parent]['branch'],
@@ -154,8 +251,8 @@ def associate_branches(history):
                 'children': []
             })
             branches[parent]['children'].append(commit)
-
-        elif refs != "" and parent in branches :
+        else:
+            parent = parent[0]
             # print("REF", refs)
             # Clean refs...
             refs = refs.replace("(","")
@@ -170,14 +267,12 @@ def associate_branches(history):
                 'action': 'branch',
                 'children': []
             })
-        else:
-            raise Exception("Could not construct tree")
 
         branches[commit] = d
 
         # print("updated branches with", d)
 
-    for i in range(len(history)):
+    for i in range(start, len(history)):
         commit = history[i]['commit']
         if commit not in branches:
             raise Exception("Missing branch information for " + commit)
@@ -193,27 +288,133 @@ def associate_branches(history):
     return history
 
 
-def get_diffs(history):
+# Defaults for get_diffs
+DIFF_WORKERS = os.cpu_count() or 1
+DIFF_MEMORY = 2048 # MB of address space per worker
+
+def _diff_blobs(reader, handler, blobs, path, scratch):
     """
-    Look at files and compute the diffs intelligently
+    Diff two blobs of a file. The blobs are streamed into the scratch
+    directory for the handler and removed afterwards.
     """
+    # The handlers go by the extension
+    filenames = []
+    try:
+        for blob in blobs:
+            filename = os.path.join(scratch, "{}-{}".format(blob, os.path.basename(path)))
+            filenames.append(filename)
+            with open(filename, 'wb') as fd:
+                reader.read(blob, fd)
+
+        return handler.get_diff(filenames[0], filenames[1])
+    finally:
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+# State of a diff worker process (see _diff_worker_init)
+diff_worker = {}
+
+def _memory_limit(memory):
+    """
+    Limit the address space of this process to memory MB, using the
+    resource module. The limit cannot exceed the hard limit of the
+    process. Returns the previous limit or None if no limit was set.
+    """
+    try:
+        import resource
+        limit = int(memory) * 1024 * 1024
+        previous = resource.getrlimit(resource.RLIMIT_AS)
+        (soft, hard) = previous
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+        return previous
+    except (ImportError, ValueError, OSError):
+        return None
+
+def _memory_restore(previous):
+    """
+    Restore the address space limit returned by _memory_limit
+    """
+    if previous is not None:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, previous)
 
-    # First get all possible representations
-    mgr = plugins_get_mgr() 
-    keys = mgr.search('representation')['representation']
-    representations = [mgr.get_by_key('representation', k) for k in keys]
+def _memory_used():
+    """
+    Address space (bytes) of this process (0 if not known)
+    """
+    try:
+        import resource
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[0]) * resource.getpagesize()
+    except (ImportError, IOError, OSError, ValueError, IndexError):
+        return 0
+
+def _diff_worker_init(gitdir, scratch, memory):
+    """
+    Set up a worker: limit its memory, start its own git processes
+    (those of the parent are not shared) and load the plugins if the
+    process did not inherit them.
 
-    for i in range(len(history)):
-        if i+1 > len(history) - 1:
-            continue
+    If the memory limit cannot be set, the worker runs without it. If
+    the worker cannot be set up, the error is recorded and the jobs
+    given to the worker are returned unattempted (see _diff_job).
+    """
+    try:
+        if memory:
+            _memory_limit(memory)
+
+        from .. import gitexec
+        gitexec.executor = None
+
+        from ..plugins.common import plugins_load
+        if plugins_get_mgr() is None:
+            plugins_load()
+
+        diff_worker['reader'] = get_executor().reader(gitdir)
+        diff_worker['scratch'] = tempfile.mkdtemp(dir=scratch)
+    except Exception as e:
+        diff_worker['error'] = e
+
+def _diff_job(job):
+    """
+    Compute one diff in a worker. Returns (job number, success, diff).
+    The diff computation may fail (e.g., run out of memory). success
+    is None if the worker could not be set up.
+    """
+    (n, key, blobs, path) = job
+    if 'error' in diff_worker:
+        return (n, None, None)
+    try:
+        handler = plugins_get_mgr().get_by_key('representation', key)
+        diff = _diff_blobs(diff_worker['reader'], handler, blobs, path,
+                           diff_worker['scratch'])
+    except (Exception, MemoryError):
+        return (n, False, None)
+    return (n, True, diff)
+
+def _diff_jobs(history, reader, representations):
+    """
+    List of diffs to compute, most recent commits first: (history
+    index, change index, representation key, (blob1, blob2), path).
+    Each changed file is compared with its version in the (first)
+    parent commit. Files that are missing in either commit or whose
+    content is the same are skipped.
+    """
+    jobs = []
+    for i in range(len(history) - 1, -1, -1):
+        curr = history[i]
 
-        prev = history[i]
-        curr = history[i+1]
+        parents = curr['parent'].split()
+        if len(parents) == 0:
+            continue
 
-        #print(prev['subject'], "==>", curr['subject'])
+        #print(curr['subject'])
         #print(curr['changes'])
-        for c in curr['changes']:
-            
+        for j, c in enumerate(curr['changes']):
+
             path = c['path']
 
             # Skip the metadata file
@@ -222,70 +423,369 @@ def get_diffs(history):
 
             # Find a handler for this kind of file...
             handler = None 
-            for r in representations: 
+            for (key, r) in representations: 
                 if r.can_process(path): 
-                    handler = r 
+                    handler = key 
                     break 
-            
+
             if handler is None: 
                 continue 
 
-            # print(path, "being handled by", handler)
+            blobs = []
+            for h in [parents[0], curr['commit']]:
+                found = reader.info("{}:{}".format(h, path))
+                if found is None or found[1] != 'blob':
+                    # File not present in commit
+                    break
+                blobs.append(found[0])
+
+            if len(blobs) < 2 or blobs[0] == blobs[1]:
+                continue
+
+            jobs.append((i, j, handler, tuple(blobs), path))
 
-            v1_hex = prev['commit']
-            v2_hex = curr['commit']
+    return jobs
+
+def _diff_pool(jobs, pending, computed, failed, gitdir, scratch,
+               workers, memory, deadline):
+    """
+    Compute the pending diffs on a pool of worker processes. Diffs
+    are added to computed (job number => diff) as they complete and
+    the jobs that fail are added to failed. If a worker dies (e.g., is
+    killed for using too much memory), the job that killed it is not
+    known and none of the unfinished jobs are tried again.
+
+    Returns False if the workers could not be started. The jobs they
+    did not attempt are neither computed nor failed.
+    """
+    try:
+        executor = ProcessPoolExecutor(max_workers=workers,
+                                       initializer=_diff_worker_init,
+                                       initargs=(os.path.abspath(gitdir),
+                                                 scratch, memory))
+    except (OSError, ImportError, NotImplementedError):
+        return False
+
+    started = True
+    futures = {}
+    try:
+        for n in pending:
+            job = (n, jobs[n][2], jobs[n][3], jobs[n][4])
+            futures[executor.submit(_diff_job, job)] = n
+
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, deadline - time.time())
+        for future in as_completed(futures, timeout):
+            (n, success, diff) = future.result()
+            if success is None:
+                started = False
+                break
+            if success:
+                computed[n] = diff
+            else:
+                failed.add(n)
+    except TimeoutError:
+        pass
+    except OSError:
+        started = False
+    except BrokenProcessPool:
+        unfinished = [n for n in futures.values()
+                      if n not in computed and n not in failed]
+        print("A diff worker died. Abandoning {} diff(s)".format(len(unfinished)))
+        failed.update(unfinished)
+    finally:
+        # Workers still busy when the budget runs out are killed. The
+        # executor has no way to stop a running job.
+        for future in futures:
+            future.cancel()
+        processes = list((getattr(executor, '_processes', None) or {}).values())
+        for process in processes:
+            process.terminate()
+        executor.shutdown(wait=True)
+
+    return started
+
+def get_diffs(history, gitdir=".", workers=None, budget=None,
+              maxdiffs=None, memory=None, cache=None):
+    """
+    Look at files and compute the diffs intelligently. The versions
+    of the files are read through the repo's object reader into a
+    scratch directory that is removed at the end. The diffs are
+    computed by a pool of worker processes and stored in the changes
+    of each commit (c['diff']).
+
+    Diffs that have been computed before are taken from the diff
+    cache. The most recent changes are processed first. If there is a
+    time budget or a limit on the number of diffs computed, the older
+    changes are left without a diff.
+
+    Parameters
+    ----------
+
+    history: History (see get_history)
+    gitdir: Directory of the repo
+    workers: Number of worker processes (default: DIFF_WORKERS). With
+             one worker, or if the workers cannot be started, the
+             diffs are computed in this process. Diffs that fail are
+             not tried again.
+    budget: Time (in seconds) after which the remaining diffs are
+            abandoned
+    maxdiffs: Maximum number of diffs to compute
+    memory: Address space limit (MB) of each worker (default:
+            DIFF_MEMORY, 0 for no limit). Diffs computed in this
+            process may use as much memory in addition to what the
+            process already uses.
+    cache: DiffCache of the repo (see Repo.cache_path) or None
+           (default) to compute every diff
+    """
 
-            temp1 = tempfile.mkdtemp(prefix="dgit-diff-") 
-            
-            try: 
-                for h in [v1_hex, v2_hex]: 
-                    filename = '{}/{}/checkout.tar'.format(temp1, h)
+    # First get all possible representations
+    mgr = plugins_get_mgr() 
+    keys = mgr.search('representation')['representation']
+    representations = [(k, mgr.get_by_key('representation', k)) for k in keys]
+
+    reader = get_executor().reader(gitdir)
+
+    jobs = _diff_jobs(history, reader, representations)
+
+    # Job number => diff
+    diffs = {}
+    if cache:
+        for n, (_, _, key, blobs, _) in enumerate(jobs):
+            (found, diff) = cache.lookup(blobs, key)
+            if found:
+                diffs[n] = diff
+    cached = len(diffs)
+
+    # Only the diffs that are not cached are computed
+    pending = [n for n in range(len(jobs)) if n not in diffs]
+    if maxdiffs is not None:
+        pending = pending[:int(maxdiffs)]
+
+    if workers is None:
+        workers = DIFF_WORKERS
+    workers = max(1, min(int(workers), len(pending)))
+    if memory is None:
+        memory = DIFF_MEMORY
+
+    deadline = None
+    if budget is not None:
+        deadline = time.time() + float(budget)
+
+    computed = {}
+    failed = set()
+    with tempfile.TemporaryDirectory(prefix="dgit-diff-") as scratch:
+        inprocess = True
+        if workers > 1:
+            inprocess = not _diff_pool(jobs, pending, computed, failed, gitdir,
+                                       scratch, workers, memory, deadline)
+            if inprocess:
+                print("Diff workers could not be started. Computing the diffs in this process")
+
+        # Under the same memory limit as a worker
+        if inprocess:
+            handlers = dict(representations)
+            previous = None
+            if memory:
+                previous = _memory_limit(_memory_used() / (1024 * 1024) + int(memory))
+            try:
+                for n in pending:
+                    if n in computed or n in failed:
+                        continue
+                    if deadline is not None and time.time() > deadline:
+                        break
+                    (_, _, key, blobs, path) = jobs[n]
                     try:
-                        os.makedirs(os.path.dirname(filename))
-                    except:
-                        pass 
-                    extractcmd = ['git', 'archive', '-o', filename, h, path]
-                    output = run(extractcmd)
-                    if 'fatal' in output: 
-                        raise Exception("File not present in commit") 
-                    with cd(os.path.dirname(filename)): 
-                        cmd = ['tar', 'xvf', 'checkout.tar']
-                        output = run(cmd) 
-                        if 'fatal' in output: 
-                            print("Cleaning up - fatal 1", temp1)
-                            shutil.rmtree(temp1)
-                            continue 
-
-                # Check to make sure that 
-                path1 = os.path.join(temp1, v1_hex, path) 
-                path2 = os.path.join(temp1, v2_hex, path) 
-                if not os.path.exists(path1) or not os.path.exists(path2): 
-                    # print("One of the two output files is missing") 
-                    shutil.rmtree(temp1)
-                    continue 
-
-                #print(path1, path2) 
-
-                # Now call the handler
-                diff = handler.get_diff(path1, path2)
-
-                # print("Inserting diff", diff)
-                c['diff'] = diff
-
-            except Exception as e: 
-                #traceback.print_exc() 
-                #print("Cleaning up - Exception ", temp1)
-                shutil.rmtree(temp1)
+                        computed[n] = _diff_blobs(reader, handlers[key], blobs,
+                                                  path, scratch)
+                    except (Exception, MemoryError) as e:
+                        #traceback.print_exc()
+                        failed.add(n)
+            finally:
+                _memory_restore(previous)
+
+    if cache:
+        for n, diff in computed.items():
+            cache.update(jobs[n][3], jobs[n][2], diff)
+        cache.prune()
+    diffs.update(computed)
+
+    # Results are stored in the order of the jobs, independent of the
+    # order in which they were computed
+    for n, (i, j, _, _, _) in enumerate(jobs):
+        if diffs.get(n) is not None:
+            # print("Inserting diff", diff)
+            history[i]['changes'][j]['diff'] = diffs[n]
+
+    print("{} diff(s): {} cached, {} computed, {} failed, {} skipped".format(
+        len(jobs), cached, len(computed), len(failed),
+        len(jobs) - len(diffs) - len(failed)))
 
 def get_history(gitdir="."):
 
-    with cd(gitdir):
-        history = get_tree()
-        history = associate_branches(history)
+    history = get_tree(gitdir)
+    history = associate_branches(history)
 
     return history
 
 
+# Changed whenever the format of the cached history changes
+HISTORY_CACHE_VERSION = 1
+
+def _history_state(gitdir):
+    """
+    Decorations of the commits at the tips of all the refs (these
+    identify the history), the number of commits and the shallow
+    boundary
+    """
+    output = run_git(["log", "--no-walk", "--exclude=refs/notes/*", "--all",
+                      "--format=%H%x00%d"], gitdir)
+    refs = OrderedDict()
+    for line in output.split("\n"):
+        if "\0" in line:
+            (commit, decoration) = line.split("\0", 1)
+            refs[commit] = decoration
+
+    # The git directory is not always .git (bare repos, worktrees)
+    shallow = run_git(["rev-parse", "--git-path", "shallow"], gitdir)
+    shallow = os.path.join(gitdir, shallow)
+    if os.path.exists(shallow):
+        shallow = sorted(open(shallow).read().split())
+    else:
+        shallow = []
+
+    return refs, shallow
+
+def _load_history_cache(repo):
+    """
+    Read the cached history: the state (version, refs, shallow
+    boundary, partial clone, count) and the annotated commits, one
+    JSON record per line. Returns (state, history, offsets) where
+    offsets[i] is the position of commit i in the file, or
+    (None, None, None) if there is no usable cache.
+    """
+    statepath = repo.cache_path('history', 'state', 'json')
+    commitspath = repo.cache_path('history', 'commits', 'jsonl')
+    if not (repo.cache_check(statepath) and repo.cache_check(commitspath)):
+        return (None, None, None)
+
+    try:
+        state = json.loads(repo.cache_read(statepath))
+        if state.get('version') != HISTORY_CACHE_VERSION:
+            return (None, None, None)
+
+        # The file may have more records than the state if a write
+        # was interrupted
+        with open(commitspath['full'], 'rb') as fd:
+            lines = fd.read().split(b"\n")[:state['count']]
+        if len(lines) != state['count'] or b"" in lines:
+            return (None, None, None)
+        offsets = [0]
+        for line in lines:
+            offsets.append(offsets[-1] + len(line) + 1)
+
+        # Decoded in one go, which is much faster than line by line
+        history = json.loads((b"[" + b",".join(lines) + b"]").decode('utf-8'))
+    except:
+        return (None, None, None)
+
+    return (state, history, offsets)
+
+def _save_history_cache(repo, state, history, start, offsets):
+    """
+    Write the commits from start onwards (the ones before are already
+    in the file) and then the state
+    """
+    statepath = repo.cache_path('history', 'state', 'json')
+    commitspath = repo.cache_path('history', 'commits', 'jsonl')
+    try:
+        os.makedirs(os.path.dirname(commitspath['full']))
+    except:
+        pass
+
+    if start == 0 or offsets is None:
+        mode, offset = 'wb', 0
+    else:
+        mode, offset = 'r+b', offsets[start]
+    with open(commitspath['full'], mode) as fd:
+        fd.seek(offset)
+        fd.truncate()
+        for h in history[start:]:
+            fd.write(json.dumps(h).encode('utf-8') + b"\n")
+
+    state['count'] = len(history)
+    repo.cache_write(statepath, json.dumps(state))
+
+def get_repo_history(repo):
+    """
+    History of the repo (as get_history) with a cache in
+    .dgit/history. Only the commits made since the cached history
+    was computed are parsed, annotated and written. The cache is
+    rebuilt if the history has been rewritten (e.g., rebased or
+    branches removed).
+
+    Parameters
+    ----------
+
+    repo: Repository object
+    """
+    gitdir = repo.rootdir
+    (cache, history, offsets) = _load_history_cache(repo)
+
+    (refs, shallow) = _history_state(gitdir)
+    state = OrderedDict([
+        ('version', HISTORY_CACHE_VERSION),
+        ('refs', refs),
+        ('shallow', shallow),
+        ('partial', is_partial(gitdir))
+    ])
+
+    if (cache is not None and
+        [cache[k] for k in state] != [state[k] for k in state]):
+        if (cache['shallow'] != state['shallow'] or
+            cache['partial'] != state['partial']):
+            history = None
+        else:
+            # Commits reachable from the old tips have been parsed.
+            # The history is only extended if all of them are still
+            # reachable (otherwise it has been rewritten or branches
+            # removed).
+            reader = get_executor().reader(gitdir)
+            oldtips = list(cache['refs'].keys())
+            dropped = None
+            if all([reader.info(c) is not None for c in oldtips]):
+                dropped = run_git(["rev-list", "--count"] + oldtips +
+                                  ["--not", "--exclude=refs/notes/*", "--all"],
+                                  gitdir)
+            if dropped != "0":
+                history = None
+    elif cache is not None:
+        return history
+
+    if history is None:
+        history = get_tree(gitdir)
+        start = 0
+    else:
+        start = len(history)
+        history.extend(iter_history(gitdir, reverse=True,
+                                    exclude=list(cache['refs'].keys())))
+
+        # Refs that have moved change the decorations (and with them
+        # the branches) of the commits that were cached. The
+        # annotations are recomputed from the first one that changed.
+        for i in range(start):
+            h = history[i]
+            decoration = refs.get(h['commit'], "")
+            if h['refs'] != decoration:
+                h['refs'] = decoration
+                start = min(start, i)
+
+    history = associate_branches(history, start)
+    _save_history_cache(repo, state, history, start, offsets)
+
+    return history
+
 if __name__ == "__main__":
 
     history = get_history()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Pipelined ingest of files into a repo. Hashing, copying and staging of
+different files overlap on a thread pool (hashlib and file I/O release
+the GIL) with bounded queues between the stages so that memory stays
+flat for large batches.
+"""
+
+import os, time, threading, mimetypes
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from ..helper import compute_sha256
+
+def merge_record(repo, h):
+    """
+    Merge an annotated record into the repo's package. Returns None if
+    nothing changed, 'metadata' if only the attributes of an existing
+    resource changed and 'content' if the file is new or has changed
+    (and has to be copied).
+    """
+    r = repo.find_resource(h['relativepath'])
+    if r is not None and h['sha256'] == r['sha256']:
+        change = None
+        for attr in ['source']:
+            if h.get(attr) != r.get(attr):
+                r[attr] = h.get(attr)
+                repo.mark_package_modified()
+                change = 'metadata'
+        return change
+
+    repo.add_resource(h)
+    return 'content'
+
+class Stager(threading.Thread):
+    """
+    Stage files with the repo manager in batches as they arrive. Each
+    git add rewrites the index, so files are staged only once a full
+    batch has accumulated (or at the end).
+    """
+    def __init__(self, repo, batchsize):
+        super(Stager, self).__init__()
+        self.daemon = True
+        self.repo = repo
+        self.batchsize = batchsize
+        self.queue = queue.Queue(maxsize=batchsize)
+        self.error = None
+        self.staged = 0
+
+    def put(self, path):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(path)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def stage(self, batch):
+        if len(batch) == 0:
+            return
+        result = self.repo.manager.stage_files(self.repo, batch)
+        if result is not None and result['status'] != 'success':
+            raise Exception("Could not stage files: " + result['message'])
+        self.staged += len(batch)
+
+    def run(self):
+        # The queue is read up to the end marker even after a failure
+        # so that producers (and close) never block
+        done = False
+        while not done:
+            batch = []
+            while len(batch) < self.batchsize:
+                item = self.queue.get()
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            if self.error is not None:
+                continue
+            try:
+                self.stage(batch)
+            except Exception as e:
+                self.error = e
+
+class IngestPipeline(object):
+    """
+    Ingest a batch of resource records into the repo
+
+    Parameters
+    ----------
+
+    repo: Repository object
+    cache: Fingerprint cache
+    concurrency: Number of worker threads (default: ingest-concurrency
+          in dgit.json or 4)
+    queuesize: Maximum number of files in flight in each stage
+          (default: ingest-queue-size in dgit.json or 4 x concurrency)
+    mode: Ingest mode (see GitRepoManager.copy_file)
+    stagebatch: Number of files staged by one git invocation (default:
+          ingest-stage-batch in dgit.json or 256). Staging overlaps
+          with hashing and copying only if a batch is much smaller
+          than the ingest.
+    """
+    def __init__(self, repo, cache, concurrency=None, queuesize=None,
+                 mode=None, stagebatch=None):
+        options = repo.options
+        if concurrency is None:
+            concurrency = options.get('ingest-concurrency', 4)
+        if queuesize is None:
+            queuesize = options.get('ingest-queue-size', 4 * concurrency)
+        if stagebatch is None:
+            stagebatch = options.get('ingest-stage-batch', 256)
+
+        self.repo = repo
+        self.cache = cache
+        self.concurrency = max(1, int(concurrency))
+        self.queuesize = max(1, int(queuesize))
+        self.mode = mode
+        self.stagebatch = max(1, int(stagebatch))
+
+    def prepare(self, h, needhash):
+        """
+        Annotate the record. Hash the file only if needed for dedupe
+        """
+        f = h['localfullpath']
+        if f is None:
+            return h
+        h['mimetypes'] = mimetypes.guess_type(f)[0]
+        if needhash:
+            h['sha256'] = compute_sha256(f)
+        return h
+
+    def copy(self, h):
+        """
+        Copy the file into the repo. Hash the copy if the ingest mode
+        did not read the file.
+        """
+        target = self.repo.manager.copy_file(self.repo, h, self.mode)
+        if h.get('sha256') in [None, ""]:
+            h['sha256'] = compute_sha256(target)
+        return h
+
+    def run(self, files):
+        """
+        Run the records through the pipeline. The records that are new
+        or changed are added to the repo's package and returned in the
+        order of files.
+        """
+
+        start = time.time()
+        repo = self.repo
+        cache = self.cache
+
+        changed = []
+        sources = {}
+        totalbytes = [0]
+
+        prepared = deque()
+        copies = deque()
+        stager = Stager(repo, self.stagebatch)
+        stager.start()
+
+        def signature(st):
+            return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+        def finish_copy():
+            h = copies.popleft().result()
+            f = h['localfullpath']
+            st = os.stat(f)
+            totalbytes[0] += st.st_size
+            if signature(st) == signature(sources[f]):
+                cache.update(f, h['sha256'], sources[f])
+            print("Updating: {}".format(h['relativepath']))
+            stager.put(h['relativepath'])
+
+        def dedupe():
+            h = prepared.popleft().result()
+            change = merge_record(repo, h)
+            if change is None:
+                return
+            changed.append(h)
+            if change != 'content' or h['localfullpath'] is None:
+                return
+            while len(copies) >= self.queuesize:
+                finish_copy()
+            copies.append(pool.submit(self.copy, h))
+
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            for h in files:
+                f = h['localfullpath']
+                needhash = False
+                if f is not None:
+                    st = os.stat(f)
+                    sources[f] = st
+                    if h.get('sha256') in [None, ""]:
+                        cached = None if cache.verify else cache.lookup(f, st)
+                        h['sha256'] = cached
+                        # Only resources that already exist have to be
+                        # compared. New files are hashed by the copy.
+                        needhash = (cached is None and
+                                    repo.find_resource(h['relativepath']) is not None)
+
+                while len(prepared) >= self.queuesize:
+                    dedupe()
+                prepared.append(pool.submit(self.prepare, h, needhash))
+
+            while len(prepared) > 0:
+                dedupe()
+            while len(copies) > 0:
+                finish_copy()
+        finally:
+            pool.shutdown(wait=True)
+            stager.close()
+
+        elapsed = time.time() - start
+        rate = totalbytes[0] / elapsed if elapsed > 0 else 0
+        print("Ingested {} file(s), {:.1f} MB in {:.2f}s ({:.1f} MB/s)".format(
+            stager.staged, totalbytes[0] / 1e6, elapsed, rate / 1e6))
+
+        return changed
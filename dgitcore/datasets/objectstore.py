@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""
+Content-addressed store for large files. Files above the
+large-file-threshold (dgit.json) are not committed to git. The content
+goes into <workspace>/objects/<sha256[:2]>/<sha256[2:]> and, for s3
+backed repos, into the bucket on push. The repo only tracks a small
+pointer file:
+
+    version https://github.com/pingali/dgit/large-file/v1
+    oid sha256:<sha256>
+    size <bytes>
+
+The content is fetched from the backend the first time it is read
+(see materialize).
+
+With large-file-chunking enabled in dgit.json, files are stored as
+content-defined chunks instead (see chunkstore) and the resource
+refers to the manifest of the version.
+"""
+
+import os, tempfile
+from ..plugins.common import plugins_get_mgr
+from ..helper import compute_sha256, ingest_file
+from ..exceptions import *
+from .chunkstore import ChunkStore
+
+#####################################################
+# Exports
+#####################################################
+
+__all__ = ['materialize']
+
+POINTER_VERSION = "https://github.com/pingali/dgit/large-file/v1"
+
+# Pointers are tiny. Anything larger is not read when looking for one.
+POINTER_MAXSIZE = 1024
+
+def pointer_content(sha256, size):
+    return "version {}\noid sha256:{}\nsize {}\n".format(POINTER_VERSION,
+                                                         sha256, size)
+
+def read_pointer(path):
+    """
+    Parse a pointer file. Returns dict with sha256 and size or None if
+    the path is not a pointer.
+    """
+    try:
+        if os.path.getsize(path) > POINTER_MAXSIZE:
+            return None
+        with open(path, 'rb') as fd:
+            content = fd.read().decode('utf-8')
+    except (OSError, IOError, UnicodeDecodeError):
+        return None
+
+    lines = content.splitlines()
+    if len(lines) < 3 or lines[0] != "version " + POINTER_VERSION:
+        return None
+
+    pointer = {}
+    for line in lines[1:]:
+        if line.startswith("oid sha256:"):
+            pointer['sha256'] = line[len("oid sha256:"):]
+        elif line.startswith("size "):
+            pointer['size'] = int(line[len("size "):])
+    if 'sha256' not in pointer or 'size' not in pointer:
+        return None
+    return pointer
+
+def threshold(repo):
+    """
+    Size (in bytes) above which files go to the object store. None if
+    large-file storage is not enabled for the repo.
+    """
+    value = repo.options.get('large-file-threshold', None)
+    if value in [None, "", 0]:
+        return None
+    return int(value)
+
+class ObjectStore(object):
+    """
+    Large-file store of a repo. The workspace copy is always used as
+    the local cache. Depending on large-file-backend in dgit.json
+    (default: s3 if the repo is s3 backed, local otherwise) objects are
+    also uploaded to the backend on push. Chunked versions are
+    assembled into the object cache when they are read.
+
+    Parameters
+    ----------
+
+    repo: Repository object
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.rootdir = os.path.join(repo.manager.workspace, 'objects')
+        self.chunking = repo.options.get('large-file-chunking', False)
+        self.chunks = ChunkStore(repo.manager.workspace)
+
+        backendtype = repo.options.get('large-file-backend', None)
+        if backendtype is None:
+            remoteurl = repo.remoteurl or ""
+            backendtype = 's3' if remoteurl.startswith('s3') else 'local'
+
+        self.backend = None
+        if backendtype != 'local':
+            mgr = plugins_get_mgr()
+            self.backend = mgr.get(what='backend', name=backendtype)
+            if self.backend is None:
+                raise InvalidParameters("Unknown large-file backend {}".format(backendtype))
+
+    def key(self, sha256):
+        return os.path.join(sha256[:2], sha256[2:])
+
+    def path(self, sha256):
+        return os.path.join(self.rootdir, self.key(sha256))
+
+    def has(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def put(self, source, sha256=None, mode='copy'):
+        """
+        Ingest a file into the store. The file is ingested into a
+        temporary name first and renamed once the checksum is known.
+        The object never shares storage with the source (hardlink is
+        ingested as reflink) so that later changes to the source do
+        not change the stored object.
+
+        Returns
+        -------
+
+        dict with sha256, size and (for chunked versions) manifest
+        """
+        size = os.path.getsize(source)
+        if self.chunking:
+            return self.put_chunks(source, sha256)
+
+        if sha256 not in [None, ""] and self.has(sha256):
+            return { 'sha256': sha256, 'size': size }
+
+        try:
+            os.makedirs(self.rootdir)
+        except:
+            pass
+
+        if mode == 'hardlink':
+            mode = 'reflink'
+
+        (handle, tmpname) = tempfile.mkstemp(dir=self.rootdir, prefix='.tmp')
+        os.close(handle)
+        try:
+            (used, computed) = ingest_file(source, tmpname, mode)
+            if computed is None:
+                computed = compute_sha256(tmpname)
+            if sha256 not in [None, ""] and computed != sha256:
+                raise Exception("Checksum of {} changed while ingesting".format(source))
+
+            target = self.path(computed)
+            try:
+                os.makedirs(os.path.dirname(target))
+            except:
+                pass
+            os.replace(tmpname, target)
+        except:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+
+        return { 'sha256': computed, 'size': size }
+
+    def put_chunks(self, source, sha256=None):
+        """
+        Store a file as chunks. Only the chunks that are not in the
+        store already are written.
+        """
+        if sha256 not in [None, ""]:
+            key = self.chunks.manifest_key(sha256)
+            if self.chunks.has(key):
+                return { 'sha256': sha256,
+                         'size': os.path.getsize(source),
+                         'manifest': key }
+
+        stats = {}
+        manifest = self.chunks.put(source, stats)
+        if sha256 not in [None, ""] and manifest['sha256'] != sha256:
+            raise Exception("Checksum of {} changed while ingesting".format(source))
+        print("Stored {} new of {} chunk(s) ({:.1f} MB)".format(
+            stats['written'], stats['chunks'], stats['writtenbytes'] / 1e6))
+
+        return { 'sha256': manifest['sha256'],
+                 'size': manifest['size'],
+                 'manifest': self.chunks.manifest_key(manifest['sha256']) }
+
+    def upload(self, sha256, manifest=None):
+        """
+        Upload an object (or the chunks of a version) to the backend if
+        it is not there already
+        """
+        if self.backend is None:
+            return False
+
+        if manifest is not None:
+            if (not self.chunks.has(manifest) or
+                self.backend.has_object(manifest)):
+                return False
+            m = self.chunks.manifest(sha256)
+            for (chunk, size) in m['chunks']:
+                key = self.chunks.chunk_key(chunk)
+                if not self.backend.has_object(key):
+                    self.backend.put_object(key, self.chunks.path(key))
+            # The manifest goes last so that it is only visible once
+            # all its chunks are.
+            self.backend.put_object(manifest, self.chunks.path(manifest))
+            return True
+
+        if not self.has(sha256):
+            return False
+        if self.backend.has_object(self.key(sha256)):
+            return False
+        self.backend.put_object(self.key(sha256), self.path(sha256))
+        return True
+
+    def fetch_chunks(self, sha256, manifest):
+        """
+        Download the manifest and the chunks of a version that are not
+        available locally
+        """
+        if not self.chunks.has(manifest):
+            if self.backend is None:
+                raise Exception("Large file manifest {} is not available locally".format(manifest))
+            self.download(manifest, self.chunks.path(manifest))
+
+        m = self.chunks.manifest(sha256)
+        missing = self.chunks.missing(m)
+        if len(missing) > 0 and self.backend is None:
+            raise Exception("Chunks of large file {} are not available locally".format(sha256))
+        for key in missing:
+            self.download(key, self.chunks.path(key))
+        return m
+
+    def download(self, key, target):
+        try:
+            os.makedirs(os.path.dirname(target))
+        except:
+            pass
+        (handle, tmpname) = tempfile.mkstemp(dir=os.path.dirname(target),
+                                             prefix='.tmp')
+        os.close(handle)
+        try:
+            self.backend.get_object(key, tmpname)
+            os.replace(tmpname, target)
+        except:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+
+    def fetch(self, sha256, manifest=None):
+        """
+        Make sure that the object is available locally and return its
+        path
+        """
+        target = self.path(sha256)
+        if os.path.exists(target):
+            return target
+
+        if manifest is None and self.backend is None:
+            raise Exception("Large file {} is not available locally".format(sha256))
+
+        try:
+            os.makedirs(os.path.dirname(target))
+        except:
+            pass
+        (handle, tmpname) = tempfile.mkstemp(dir=os.path.dirname(target),
+                                             prefix='.tmp')
+        os.close(handle)
+        try:
+            if manifest is not None:
+                m = self.fetch_chunks(sha256, manifest)
+                self.chunks.assemble(m, tmpname)
+            else:
+                print("Fetching large file", sha256)
+                self.backend.get_object(self.key(sha256), tmpname)
+                if compute_sha256(tmpname) != sha256:
+                    raise Exception("Checksum mismatch for large file {}".format(sha256))
+            os.replace(tmpname, target)
+        except:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+
+        return target
+
+def materialize(repo, relativepath):
+    """
+    Return the path of the content of a file in the repo. For large
+    files this is the object in the store, fetched from the backend if
+    needed. Other files are read from the repo directly.
+    """
+    path = os.path.join(repo.rootdir, relativepath)
+    pointer = read_pointer(path)
+    if pointer is None:
+        return path
+
+    manifest = None
+    r = repo.find_resource(relativepath)
+    if r is not None and r.get('sha256') == pointer['sha256']:
+        manifest = r.get('manifest')
+    return ObjectStore(repo).fetch(pointer['sha256'], manifest)
+
+def push(repo):
+    """
+    Upload the large files referenced by the repo to its backend
+    """
+    resources = [r for r in repo.package['resources']
+                 if r.get('storage') == 'objectstore']
+    if len(resources) == 0:
+        return 0
+
+    store = ObjectStore(repo)
+    count = 0
+    for r in resources:
+        if store.upload(r['sha256'], r.get('manifest')):
+            count += 1
+    if count > 0:
+        print("Uploaded {} large file(s)".format(count))
+    return count
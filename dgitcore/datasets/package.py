@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Persistence of the package (datapackage.json).
+
+The package is serialized canonically (keys sorted, resources ordered
+by relativepath) so that the same content always produces the same
+bytes. By default, each top-level key and each element of a top-level
+list (e.g., each resource) is on a line of its own. The package-encoding
+option 'compact' puts everything on one line without whitespace. The
+file is replaced atomically and is not written at all if its content
+would not change, which keeps its mtime (and git's view of it) stable.
+If the repo's package has not changed since it was loaded or written,
+it is not even serialized.
+"""
+
+import os, json, tempfile
+
+# Keys computed when the package is loaded that are not persisted
+transient_resource_keys = ['materialized']
+
+def canonical_package(package):
+    """
+    Copy of the package with the resources in a stable order and
+    without the transient keys
+    """
+    package = dict(package)
+    if 'resources' in package:
+        resources = []
+        for r in package['resources']:
+            r = dict(r)
+            for k in transient_resource_keys:
+                r.pop(k, None)
+            resources.append(r)
+        resources.sort(key=lambda r: r.get('relativepath') or "")
+        package['resources'] = resources
+    return package
+
+def dumps_package(package, encoding=None):
+    """
+    Serialize the package. Each line is encoded with json's C encoder,
+    which is only used without indentation.
+
+    Parameters
+    ----------
+
+    package: Package (dict)
+    encoding: 'compact' or None (default: a line per top-level key
+              and per element of a top-level list)
+    """
+    package = canonical_package(package)
+    if encoding == 'compact':
+        return json.dumps(package, sort_keys=True, separators=(',', ':'))
+
+    encode = json.JSONEncoder(sort_keys=True).encode
+    keys = sorted(package.keys())
+    lines = ["{"]
+    for n, k in enumerate(keys):
+        v = package[k]
+        end = "," if n < len(keys) - 1 else ""
+        if isinstance(v, list) and len(v) > 0:
+            lines.append("    {}: [".format(encode(k)))
+            lines.append(",\n".join(["        " + encode(x) for x in v]))
+            lines.append("    ]" + end)
+        else:
+            lines.append("    {}: {}{}".format(encode(k), encode(v), end))
+    lines.append("}")
+    return "\n".join(lines)
+
+def write_package(repo, path=None, package=None):
+    """
+    Write the package of the repo if it has changed
+
+    Parameters
+    ----------
+
+    repo: Repository object
+    path: Where to write (default: datapackage.json in the repo)
+    package: Package to write (default: repo.package)
+
+    Returns
+    -------
+
+    True if the file was written, False if it was already up to date
+    """
+    # The repo's own package is only serialized if it has changed
+    own = path is None and package is None
+    if path is None:
+        path = os.path.join(repo.rootdir, 'datapackage.json')
+    if package is None:
+        package = repo.package
+    if own and not repo.package_modified() and os.path.exists(path):
+        return False
+
+    written = _write(repo, path, package)
+    if own:
+        repo.mark_package_modified(False)
+    return written
+
+def _write(repo, path, package):
+    """
+    Write the package to path unless the file has the same content
+    """
+    content = dumps_package(package,
+                            repo.options.get('package-encoding')).encode('utf-8')
+
+    # Only files of the same size can have the same content
+    mode = 0o644
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0o777
+        if os.path.getsize(path) == len(content):
+            with open(path, 'rb') as fd:
+                if fd.read() == content:
+                    return False
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    (handle, tmppath) = tempfile.mkstemp(dir=dirname, prefix=".datapackage")
+    try:
+        with os.fdopen(handle, 'wb') as fd:
+            fd.write(content)
+        os.chmod(tmppath, mode)
+        os.replace(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+
+    return True
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Shell-free execution of git commands.
+
+GitExecutor runs git with an argument vector (no shell, no quoting)
+and a cached environment, and reports the real exit code. Objects are
+read through long-lived git cat-file --batch/--batch-check processes
+(one pair per repo, see GitObjectReader) so that reading many blobs
+does not start a process per object.
+"""
+
+import os, shutil, subprocess, threading, atexit
+from collections import namedtuple
+
+GitResult = namedtuple("GitResult", ["returncode", "output"])
+
+# Size of the pieces in which large objects are streamed
+OBJECT_READSIZE = 1024 * 1024
+
+def find_git():
+    return shutil.which('git') or '/usr/bin/git'
+
+class GitObjectReader(object):
+    """
+    Read objects of a repo using git cat-file --batch (content) and
+    --batch-check (type and size). The processes are started on first
+    use and restarted if they exit. Objects are identified by any
+    revision that cat-file understands (sha, commit:path, ...).
+
+    Parameters
+    ----------
+
+    gitdir: Directory of the repo (checkout or bare)
+    executor: GitExecutor whose environment is used
+    """
+    def __init__(self, gitdir, executor):
+        self.gitdir = gitdir
+        self.executor = executor
+        self.processes = {}
+        self.lock = threading.Lock()
+
+    def _process(self, option):
+        p = self.processes.get(option)
+        if p is None or p.poll() is not None:
+            p = subprocess.Popen([self.executor.git, 'cat-file', option],
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 cwd=self.gitdir,
+                                 env=self.executor.environ)
+            self.processes[option] = p
+        return p
+
+    def _header(self, p, rev):
+        if "\n" in rev:
+            raise ValueError("Invalid revision {}".format(rev))
+
+        p.stdin.write(rev.encode('utf-8') + b"\n")
+        p.stdin.flush()
+        line = p.stdout.readline()
+        if line == b"":
+            raise Exception("git cat-file exited unexpectedly")
+
+        # <sha> <type> <size> or <rev> missing|ambiguous. The rev may
+        # contain spaces (e.g., commit:path).
+        line = line.decode('utf-8').rstrip("\n")
+        if line.rsplit(" ", 1)[-1] in ['missing', 'ambiguous']:
+            return None
+        parts = line.split(" ")
+        if len(parts) != 3:
+            raise Exception("Unexpected output from git cat-file: {}".format(line))
+        return (parts[0], parts[1], int(parts[2]))
+
+    def info(self, rev):
+        """
+        Returns (sha, type, size) of the object or None if it does not
+        exist
+        """
+        with self.lock:
+            return self._header(self._process('--batch-check'), rev)
+
+    def read(self, rev, fd=None):
+        """
+        Read an object. If fd (a binary file object) is specified, the
+        content is streamed into it instead of being returned.
+
+        Returns
+        -------
+
+        (sha, type, content) or None if the object does not exist.
+        content is None if fd was specified.
+        """
+        with self.lock:
+            p = self._process('--batch')
+            header = self._header(p, rev)
+            if header is None:
+                return None
+
+            (sha, objtype, size) = header
+            if fd is None:
+                content = p.stdout.read(size)
+            else:
+                content = None
+                remaining = size
+                while remaining > 0:
+                    data = p.stdout.read(min(remaining, OBJECT_READSIZE))
+                    if len(data) == 0:
+                        raise Exception("git cat-file exited unexpectedly")
+                    fd.write(data)
+                    remaining -= len(data)
+
+            # Each object is followed by a newline
+            p.stdout.read(1)
+            return (sha, objtype, content)
+
+    def close(self):
+        with self.lock:
+            for p in self.processes.values():
+                try:
+                    p.stdin.close()
+                    p.wait()
+                except:
+                    pass
+            self.processes = {}
+
+class GitExecutor(object):
+    """
+    Run git commands
+
+    Parameters
+    ----------
+
+    env: Environment variables added to the current environment for
+         all commands (e.g., author and committer)
+    """
+    def __init__(self, env=None):
+        self.git = find_git()
+        self.environ = os.environ.copy()
+        if env is not None:
+            self.environ.update(env)
+        self.readers = {}
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def run(self, args, cwd=None, stdin=None, env=None):
+        """
+        Run git with the arguments. stderr is merged into the output.
+
+        Parameters
+        ----------
+
+        args: Arguments to git
+        cwd: Directory to run the command in (default: current)
+        stdin: bytes to be fed to the command's standard input
+        env: Additional environment variables for this command
+
+        Returns
+        -------
+
+        GitResult(returncode, output)
+        """
+        environ = self.environ
+        if env is not None:
+            environ = dict(environ)
+            environ.update(env)
+
+        p = subprocess.run([self.git] + list(args),
+                           input=stdin,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT,
+                           cwd=cwd,
+                           env=environ)
+        return GitResult(p.returncode, p.stdout.decode('utf-8', 'replace'))
+
+    def reader(self, gitdir):
+        """
+        Object reader for the repo at gitdir (created on first use)
+        """
+        gitdir = os.path.abspath(gitdir)
+        with self.lock:
+            if gitdir not in self.readers:
+                self.readers[gitdir] = GitObjectReader(gitdir, self)
+            return self.readers[gitdir]
+
+    def release(self, gitdir):
+        """
+        Stop the object reader of a repo (e.g., before it is removed)
+        """
+        with self.lock:
+            r = self.readers.pop(os.path.abspath(gitdir), None)
+        if r is not None:
+            r.close()
+
+    def close(self):
+        with self.lock:
+            readers = list(self.readers.values())
+            self.readers = {}
+        for r in readers:
+            r.close()
+
+executor = None
+
+def get_executor():
+    """
+    Shared executor for code that does not have a repo manager at hand
+    """
+    global executor
+    if executor is None:
+        executor = GitExecutor()
+    return executor
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import os, sys, re, unicodedata
+import os, sys, re, unicodedata, shutil
 import json, inspect 
 import shelve
 from hashlib import sha256
@@ -8,8 +8,12 @@ import subprocess, pipes
 from datetime import datetime
 import getpass
 import uuid
+import time
 import subprocess
 from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from .exceptions import InvalidParameters
 
 class bcolors:
     HEADER = '\033[95m'
@@ -109,36 +113,207 @@ def clean_name(n):
     n = "".join([x if (x.isalnum() or x == "-") else "_" for x in n])
     return n
 
-def compute_sha256(filename):
+# Size of the buffer used while streaming files through hashlib and
+# the number of processes used to hash a batch of files (None => one
+# per cpu).
+HASH_BUFSIZE = 1024 * 1024
+HASH_WORKERS = None
+
+# Batches smaller than this are hashed in-process. Starting a process
+# pool costs more than hashing a few small files.
+HASH_POOL_MINBYTES = 16 * 1024 * 1024
+
+def compute_sha256(filename, bufsize=None):
     """
-    Try the library. If it doesnt work, use the command line..
+    Compute the sha256 of a file by streaming it in fixed size chunks
     """
-    try:
-        h = sha256()
-        fd = open(filename, 'rb')
+    if bufsize is None:
+        bufsize = HASH_BUFSIZE
+
+    h = sha256()
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(filename, 'rb') as fd:
         while True:
-            buf = fd.read(0x1000000)
-            if buf in [None, ""]:
+            n = fd.readinto(buf)
+            if not n:
                 break
-            h.update(buf.encode('utf-8'))
-        fd.close()
-        return h.hexdigest()
-    except:
-        output = run(["sha256sum", "-b", filename])
-        return output.split(" ")[0]
+            h.update(view[:n])
+    return h.hexdigest()
+
+def compute_sha256_many(filenames, workers=None, bufsize=None,
+                        stats=None, verbose=True):
+    """
+    Compute the sha256 of a batch of files. Large batches are fanned
+    out across a process pool.
+
+    Parameters
+    ----------
+
+    filenames: List of paths to be hashed
+    workers: Number of processes (default: HASH_WORKERS, i.e., one per cpu)
+    bufsize: Size of the read buffer (default: HASH_BUFSIZE)
+    stats: Optional dictionary updated with files, bytes, seconds and
+           bytes-per-sec of this batch
+    verbose: Print the throughput
+
+    Returns
+    -------
+
+    OrderedDict of filename => sha256 in the order of filenames
+    """
+    filenames = list(OrderedDict.fromkeys(filenames))
+    if bufsize is None:
+        bufsize = HASH_BUFSIZE
+    if workers is None:
+        workers = HASH_WORKERS or os.cpu_count() or 1
+
+    totalbytes = sum([os.path.getsize(f) for f in filenames])
+
+    start = time.time()
+    if (workers > 1 and len(filenames) > 1 and
+        totalbytes >= HASH_POOL_MINBYTES):
+        workers = min(workers, len(filenames))
+        chunksize = max(1, len(filenames) // (workers * 4))
+        func = partial(compute_sha256, bufsize=bufsize)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            digests = list(executor.map(func, filenames,
+                                        chunksize=chunksize))
+    else:
+        digests = [compute_sha256(f, bufsize) for f in filenames]
+    elapsed = time.time() - start
+
+    rate = totalbytes / elapsed if elapsed > 0 else 0
+    if stats is not None:
+        stats.update({
+            'files': len(filenames),
+            'bytes': totalbytes,
+            'seconds': elapsed,
+            'bytes-per-sec': rate
+        })
+    if verbose and len(filenames) > 0:
+        print("Hashed {} file(s), {:.1f} MB in {:.2f}s ({:.1f} MB/s)".format(
+            len(filenames), totalbytes / 1e6, elapsed, rate / 1e6))
+
+    return OrderedDict(zip(filenames, digests))
+
+###################################################################
+# Copying files into the repo
+###################################################################
+
+# Supported ingest modes and the order in which they are tried when a
+# mode is not supported (e.g., reflink on ext4, hardlink across
+# filesystems)
+INGEST_FALLBACKS = OrderedDict([
+    ('reflink', ['reflink', 'copy_file_range', 'copy']),
+    ('hardlink', ['hardlink', 'reflink', 'copy_file_range', 'copy']),
+    ('copy_file_range', ['copy_file_range', 'copy']),
+    ('copy', ['copy'])
+])
+
+# ioctl to clone a file on btrfs/xfs (linux/fs.h)
+FICLONE = 0x40049409
+
+def _ingest_reflink(source, target):
+    import fcntl
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def _ingest_hardlink(source, target):
+    os.link(source, target)
+
+def _ingest_copy_file_range(source, target):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        while offset < size:
+            if hasattr(os, 'copy_file_range'):
+                n = os.copy_file_range(src.fileno(), dst.fileno(),
+                                       size - offset, offset)
+            else:
+                n = os.sendfile(dst.fileno(), src.fileno(),
+                                offset, size - offset)
+            if n == 0:
+                break
+            offset += n
+
+def _ingest_copy(source, target, bufsize=None):
+    """
+    Copy the file and compute its sha256 in the same pass
+    """
+    if bufsize is None:
+        bufsize = HASH_BUFSIZE
+
+    h = sha256()
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        while True:
+            n = src.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+            dst.write(view[:n])
+    shutil.copymode(source, target)
+    return h.hexdigest()
+
+def ingest_file(source, target, mode='copy', bufsize=None):
+    """
+    Copy source to target using the cheapest mechanism available
+
+    Parameters
+    ----------
+
+    source: Path of the file to be ingested
+    target: Path within the repo
+    mode: One of reflink, hardlink, copy_file_range or copy. The next
+          mechanism in INGEST_FALLBACKS is tried if a mode is not
+          supported. Note that with hardlink, later changes to the
+          source show up in the repo.
+    bufsize: Buffer size for copy
+
+    Returns
+    -------
+
+    (mode used, sha256). sha256 is computed only by the copy mode,
+    which reads the file anyway, and is None otherwise.
+    """
+    if mode not in INGEST_FALLBACKS:
+        raise InvalidParameters("Unknown ingest mode {}".format(mode))
+
+    for m in INGEST_FALLBACKS[mode]:
+        # Never write through an existing target. It may be a
+        # hardlink to a source file.
+        if os.path.lexists(target):
+            os.unlink(target)
+
+        if m == 'copy':
+            return (m, _ingest_copy(source, target, bufsize))
+
+        try:
+            if m == 'reflink':
+                _ingest_reflink(source, target)
+            elif m == 'hardlink':
+                _ingest_hardlink(source, target)
+            else:
+                _ingest_copy_file_range(source, target)
+            return (m, None)
+        except (OSError, IOError, AttributeError):
+            continue
 
-def run(cmd):
+def run(cmd, cwd=None):
     """
-    Run a shell command
+    Run a shell command (in cwd if specified)
     """
     cmd = [pipes.quote(c) for c in cmd]
     cmd = " ".join(cmd)
     cmd += "; exit 0"
-    # print("Running {} in {}".format(cmd, os.getcwd()))
+    # print("Running {} in {}".format(cmd, cwd or os.getcwd()))
     try:
         output = subprocess.check_output(cmd,
                                          stderr=subprocess.STDOUT,
-                                         shell=True)
+                                         shell=True,
+                                         cwd=cwd)
     except subprocess.CalledProcessError as e:
             output = e.output
 
@@ -167,7 +342,8 @@ def log_action(func, result, *args, **kwargs):
         funcname = s[3] 
         if filename.endswith("bin/dgit"): 
             trigger = "user" 
-        elif filename.endswith("dgitcore/api.py"):
+        elif (filename.endswith("dgitcore/api.py") or
+              filename.endswith("dgitcore/api_async.py")):
             trigger = "api"
         elif filename.endswith("datasets/common.py") and funcname == "post": 
             trigger = "auto"
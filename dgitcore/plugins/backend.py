@@ -3,6 +3,7 @@
 import os, sys
 import json
 from collections import namedtuple
+from ..exceptions import *
 
 Key = namedtuple("Key", ["name","version"])
 
@@ -69,5 +70,28 @@ class BackendBase(object):
         """
         return
 
+    def has_object(self, key):
+        """
+        Check if a large-file object exists in the backend
+
+        Parameters
+        ----------
+
+        key: Relative path of the object (see ObjectStore)
+        """
+        return False
+
+    def put_object(self, key, filename):
+        """
+        Upload a large-file object to the backend
+        """
+        raise NotImplemented("Backend {} does not store large files".format(self.name))
+
+    def get_object(self, key, filename):
+        """
+        Download a large-file object from the backend into filename
+        """
+        raise NotImplemented("Backend {} does not store large files".format(self.name))
+
     def config(self, what='get', params=None):
         return
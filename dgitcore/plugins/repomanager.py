@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import os, sys
+import os, sys, threading
 import json
 import fnmatch, re
 from collections import namedtuple
@@ -16,13 +16,132 @@ class Repo:
     def __init__(self, username, reponame):
         self.username = username
         self.reponame = reponame
-        self.package = None
+        self._package = None
+        self._package_loader = None
+        self._package_lock = threading.Lock()
+        self._package_modified = False
+        self._resource_index = None
         self.manager = None
         self.rootdir = None
         self.options = {}
         self.key = None
         self.remoteurl = None
 
+    # The package (content of datapackage.json) is loaded on first
+    # access if a loader has been specified. The package is loaded
+    # once even if several threads ask for it. If loading fails, the
+    # error is raised and the next access tries again.
+    @property
+    def package(self):
+        if self._package is None and self._package_loader is not None:
+            with self._package_lock:
+                if self._package is None and self._package_loader is not None:
+                    self._package = self._package_loader(self)
+                    self._package_loader = None
+                    self._package_modified = False
+        return self._package
+
+    @package.setter
+    def package(self, package):
+        with self._package_lock:
+            self._package = package
+            self._package_loader = None
+            self._resource_index = None
+            self._package_modified = True
+
+    def set_package_loader(self, loader):
+        """
+        Load the package with loader(repo) when it is first accessed
+        """
+        with self._package_lock:
+            self._package = None
+            self._package_loader = loader
+            self._resource_index = None
+            self._package_modified = False
+
+    def package_loaded(self):
+        return self._package is not None
+
+    # Whether the package may differ from datapackage.json, i.e., it
+    # has changed since it was loaded or written (see
+    # datasets.package.write_package). The methods below record their
+    # changes. Changes made to the package in place must be recorded
+    # with mark_package_modified.
+    def package_modified(self):
+        return self._package_modified
+
+    def mark_package_modified(self, modified=True):
+        self._package_modified = modified
+
+    # Index of resources by relativepath. The index maps the path to
+    # the position in package['resources'] and is rebuilt if the list
+    # has been modified without going through the methods below.
+    def reindex_resources(self):
+        resources = self.package['resources']
+        self._resource_index = {
+            'list': resources,
+            'length': len(resources),
+            'positions': dict([(r['relativepath'], i)
+                               for i, r in enumerate(resources)])
+        }
+        return self._resource_index
+
+    def _resource_position(self, p):
+        index = self._resource_index
+        resources = self.package['resources']
+        if ((index is None) or
+            (index['list'] is not resources) or
+            (index['length'] != len(resources))):
+            index = self.reindex_resources()
+
+        i = index['positions'].get(p)
+        if i is not None and resources[i]['relativepath'] != p:
+            index = self.reindex_resources()
+            i = index['positions'].get(p)
+        return i
+
+    def find_resource(self, p):
+        """
+        Get metadata for a given file or None if it is not a resource
+        """
+        i = self._resource_position(p)
+        if i is None:
+            return None
+        return self.package['resources'][i]
+
+    def add_resource(self, r):
+        """
+        Add a resource or replace the existing resource with the same
+        relativepath. Returns the replaced resource if any.
+        """
+        p = r['relativepath']
+        i = self._resource_position(p)
+        resources = self.package['resources']
+        self._package_modified = True
+        if i is None:
+            resources.append(r)
+            self._resource_index['positions'][p] = len(resources) - 1
+            self._resource_index['length'] = len(resources)
+            return None
+
+        previous = resources[i]
+        resources[i] = r
+        return previous
+
+    def remove_resources(self, paths):
+        """
+        Remove the resources with the given relativepaths
+        """
+        paths = set(paths)
+        if len(paths) == 0:
+            return
+        resources = self.package['resources']
+        length = len(resources)
+        resources[:] = [r for r in resources if r['relativepath'] not in paths]
+        if len(resources) != length:
+            self._package_modified = True
+        self.reindex_resources()
+
     def find_matching_files(self, includes):
         """
         For various actions we need files that match patterns
@@ -95,12 +214,12 @@ class Repo:
         """
         Get metadata for a given file
         """
-        for r in self.package['resources']:
-            if r['relativepath'] == p:
-                r['localfullpath'] = os.path.join(self.rootdir, p)
-                return r
+        r = self.find_resource(p)
+        if r is None:
+            raise Exception("Invalid path")
 
-        raise Exception("Invalid path")
+        r['localfullpath'] = os.path.join(self.rootdir, p)
+        return r
 
 
 class RepoManagerBase(object):
@@ -116,6 +235,7 @@ class RepoManagerBase(object):
         self.enabled = 'y'
         self.initialize()
         self.repos = {}
+        self.catalog = None
 
     def initialize(self):
         pass
@@ -124,12 +244,18 @@ class RepoManagerBase(object):
         return self.enabled.lower() != 'n'
 
     def get_repo_list(self):
+        if self.catalog is not None:
+            return self.search(None, None)
         return list(self.repos.keys())
 
     def get_repo_details(self, key):
         return self.repos[key]
 
     def search(self, username, reponame):
+        if self.catalog is not None:
+            entries = self.catalog.search(username, reponame)
+            return [self.key(e['username'], e['reponame']) for e in entries]
+
         matches = []
 
         for k in list(self.repos.keys()):
@@ -234,6 +360,27 @@ class RepoManagerBase(object):
         """
         key = repo.key
         del self.repos[key]
+        if self.catalog is not None:
+            self.catalog.remove(repo.username, repo.reponame)
+
+    def head(self, repo):
+        """
+        Current version (commit) of the repo
+        """
+        return None
+
+    def update_catalog(self, repo):
+        """
+        Record the current state of the repo in the workspace
+        catalog. Failures are reported but do not fail the operation
+        that changed the repo.
+        """
+        if self.catalog is None:
+            return
+        try:
+            self.catalog.update(repo)
+        except Exception as e:
+            print("Could not update the workspace catalog:", e)
 
 
     def push(self, repo, args):
@@ -242,6 +389,12 @@ class RepoManagerBase(object):
     def status(self, repo, args):
         pass
 
+    def after_pull(self, repo):
+        """
+        Bring the in-memory state of the repo up to date after a pull
+        """
+        pass
+
     def show(self, repo, args):
         pass
 
@@ -257,12 +410,46 @@ class RepoManagerBase(object):
     def add_raw(self, repo, files):
         pass
 
-    def add_files(self, repo, files):
+    def add_files(self, repo, files, mode=None):
+        """
+        Files is a list with simple dict structure with relativepath
+        and fullpath. Mode specifies how the files are ingested
+        (reflink, hardlink, copy_file_range, copy)
+        """
+        pass
+
+    def copy_file(self, repo, f, mode=None):
+        """
+        Copy a single file into the repo without staging it. Returns
+        the path of the copy.
+        """
+        pass
+
+    def stage_files(self, repo, paths):
+        """
+        Stage files (relative paths) already copied into the repo
+        """
+        pass
+
+    def commit_files(self, repo, files, message, refresh=False, mode=None):
+        """
+        Commit files (and datapackage.json) directly without going
+        through the checkout
+        """
+        pass
+
+    def refresh_worktree(self, repo):
         """
-        Files is a list with simple dict structure with relativepath and fullpath
+        Bring the checkout up to date after commit_files
         """
         pass
 
+    def sparse_checkout(self, repo, patterns):
+        """
+        Materialize only the resources matching patterns (None for all)
+        """
+        raise NotImplemented("Sparse checkout is not supported by " + self.name)
+
     def clone(self, repo, newusername, newreponame):
         """
         Clone repo
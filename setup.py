@@ -33,7 +33,6 @@ requirements = [
     'messytables',
     'parse',
     'daff',
-    'sh',
     'numpydoc'
 ]
 
@@ -1,4 +1,4 @@
-import os, sys, shutil, tempfile, json, stat
+import os, sys, shutil, tempfile, json, stat, hashlib, asyncio
 from nose import with_setup
 from nose.tools import assert_raises
 from unittest import TestCase
@@ -88,6 +88,33 @@ def basic_result_check(result):
     assert isinstance(result, dict)
     assert result['status'] == 'success'
 
+def create_git_repo(commits):
+    """
+    Plain git repo in a temporary directory. Each commit is a
+    (message, {path: content}) pair; a content of None removes the
+    file.
+    """
+    import subprocess
+    gitdir = tempfile.mkdtemp()
+    def git(*args):
+        subprocess.check_output(['git', '-c', 'user.name=test',
+                                 '-c', 'user.email=test@example.com'] + list(args),
+                                cwd=gitdir)
+    git('init', '-q', '.')
+    for (message, files) in commits:
+        for path, content in files.items():
+            if content is None:
+                git('rm', '-q', path)
+                continue
+            filename = os.path.join(gitdir, path)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as fd:
+                fd.write(content)
+            git('add', path)
+        git('commit', '-q', '--allow-empty', '-m', message)
+    return gitdir
+
 ###########################################
 # Group 1
 # Simple checks
@@ -180,6 +207,14 @@ def test_remote():
     st = os.stat(path)
     assert bool(st.st_mode & stat.S_IXUSR)
 
+    # Partial clones of the server-side repos are allowed
+    import subprocess
+    for name in ['simple1', 's3']:
+        result = api.remote(basic_repo_lookup(name), ['-v'])
+        output = subprocess.check_output(['git', 'config', 'uploadpack.allowFilter'],
+                                         cwd=get_remote_path(result))
+        assert output.strip() == b'true'
+
 def test_check_package():
     """
     Metadata validity
@@ -197,6 +232,568 @@ def test_check_package():
         valid = False
     assert valid
 
+def test_catalog():
+    """
+    Workspace catalog
+    """
+    repos = api.list_repos(remote=True)
+    assert len(repos) == 3
+    remotes = dict([((r[0], r[1]), r[2]) for r in repos])
+    assert remotes[tuple(repo_configurations['s3'][:2])].startswith('s3://')
+
+    # Reload. The repos are registered from the catalog.
+    api.initialize()
+    repos = api.list_repos()
+    assert len(repos) == 3
+    repo = basic_repo_lookup('s3')
+    assert repo.remoteurl.startswith('s3://')
+    assert len(repo.package['resources']) >= 0
+
+    # Repos added and removed outside dgit are picked up on startup
+    # without loading the packages
+    from dgitcore.plugins.common import plugins_get_mgr
+    repo = basic_repo_lookup('simple1')
+    copydir = os.path.join(os.path.dirname(repo.rootdir), 'catalogcopy')
+    shutil.copytree(repo.rootdir, copydir, symlinks=True)
+    try:
+        api.initialize()
+        repomgr = plugins_get_mgr().get(what='repomanager', name='git')
+        assert not any(r.package_loaded() for r in repomgr.repos.values())
+        assert (repo.username, 'catalogcopy') in api.list_repos()
+    finally:
+        shutil.rmtree(copydir)
+
+    api.initialize()
+    assert (repo.username, 'catalogcopy') not in api.list_repos()
+    assert len(api.list_repos()) == 3
+
+def test_batch():
+    """
+    Batch status over the workspace
+    """
+    results = api.batch('status', limits={'s3': 1})
+    assert len(results) == 3
+    for r in results:
+        assert r['status'] == 'success'
+        assert r['cmd'][0] == 'status'
+
+    with assert_raises(InvalidParameters):
+        api.batch('drop')
+
+def test_write_package():
+    """
+    datapackage.json is canonical, atomic and only written on change
+    """
+    from dgitcore.datasets import package as dpackage
+    from dgitcore.datasets.package import write_package
+    repo = basic_repo_lookup('simple1')
+    path = os.path.join(repo.rootdir, 'datapackage.json')
+    write_package(repo)
+    content = open(path).read()
+    assert not write_package(repo)
+
+    # Key order does not matter
+    repo.package = json.loads(content, object_pairs_hook=lambda p: dict(reversed(p)))
+    assert repo.package_modified()
+    assert not write_package(repo)
+    assert not repo.package_modified()
+
+    # An unchanged package is not serialized
+    dumps_package = dpackage.dumps_package
+    def failing_dumps(*args):
+        raise Exception("Serialized")
+    dpackage.dumps_package = failing_dumps
+    try:
+        assert not write_package(repo)
+        repo.add_resource({'relativepath': 'unwritten.csv', 'sha256': ''})
+        assert_raises(Exception, write_package, repo)
+    finally:
+        dpackage.dumps_package = dumps_package
+    repo.remove_resources(['unwritten.csv'])
+    assert not write_package(repo)
+
+    # The encoding applies from the next change
+    repo.options['package-encoding'] = 'compact'
+    try:
+        assert not write_package(repo)
+        repo.mark_package_modified()
+        assert write_package(repo)
+        assert "\n" not in open(path).read()
+        assert json.loads(open(path).read()) == json.loads(content)
+    finally:
+        del repo.options['package-encoding']
+        repo.mark_package_modified()
+        write_package(repo)
+    assert open(path).read() == content
+
+def test_package_loader():
+    """
+    Packages are loaded once, on first access, and failed loads are
+    retried
+    """
+    import threading, time
+    from dgitcore.plugins.repomanager import Repo
+
+    calls = []
+    def loader(repo):
+        calls.append(repo)
+        if len(calls) == 1:
+            raise ValueError("Bad datapackage.json")
+        time.sleep(0.1)
+        return {'resources': []}
+
+    repo = Repo('test', 'loader')
+    repo.set_package_loader(loader)
+    with assert_raises(ValueError):
+        repo.package
+    assert not repo.package_loaded()
+
+    packages = []
+    threads = [threading.Thread(target=lambda: packages.append(repo.package))
+               for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 2
+    assert packages == [{'resources': []}] * 4
+    assert all(p is packages[0] for p in packages)
+
+def test_unsupported_operations():
+    """
+    Repo managers and backends without sparse checkouts or large
+    files say so
+    """
+    from dgitcore.plugins.repomanager import RepoManagerBase
+    mgr = RepoManagerBase('test', 'v0', 'Test manager')
+    with assert_raises(NotImplemented) as cm:
+        mgr.sparse_checkout(None, None)
+    assert 'test' in cm.exception.message
+
+    from dgitcore.plugins.backend import BackendBase
+    backend = BackendBase('test', 'v0', 'Test backend')
+    with assert_raises(NotImplemented) as cm:
+        backend.put_object('key', 'filename')
+    assert 'test' in cm.exception.message
+    assert_raises(NotImplemented, backend.get_object, 'key', 'filename')
+
+def test_object_reader_missing():
+    """
+    Missing objects whose names have spaces are reported as missing
+    """
+    import subprocess
+    from dgitcore.gitexec import get_executor
+    from dgitcore.datasets.history import get_history, get_diffs
+
+    tempdir = tempfile.mkdtemp()
+    def git(*args):
+        subprocess.check_output(['git', '-c', 'user.name=test',
+                                 '-c', 'user.email=test@example.com'] + list(args),
+                                cwd=tempdir)
+    try:
+        git('init', '-q', '.')
+        for content in ["a,b\n1,2\n", "a,b\n1,3\n"]:
+            with open(os.path.join(tempdir, 'x y.csv'), 'w') as fd:
+                fd.write(content)
+            git('add', 'x y.csv')
+            git('commit', '-q', '-m', 'Update')
+        git('rm', '-q', 'x y.csv')
+        git('commit', '-q', '-m', 'Remove')
+
+        reader = get_executor().reader(tempdir)
+        assert reader.info("HEAD:x y.csv") is None
+        assert reader.read("HEAD:x y z.csv") is None
+        assert reader.info("HEAD~1:x y.csv")[1] == 'blob'
+
+        # Diffs across the removal
+        history = get_history(tempdir)
+        get_diffs(history, tempdir, cache=False)
+        assert 'diff' in history[1]['changes'][0]
+    finally:
+        get_executor().release(tempdir)
+        shutil.rmtree(tempdir)
+
+def test_history_names():
+    """
+    Subjects with quotes and paths with spaces and tabs
+    """
+    from dgitcore.datasets.history import get_history, iter_history
+    subject = """Say "hi" and 'bye' {"x": 1}"""
+    commits = [(subject, {'a\tb.csv': "a\n1\n", 'c d.csv': "x\n"}),
+               ("Second", {'c d.csv': "y\n"})]
+    gitdir = create_git_repo(commits)
+    try:
+        history = get_history(gitdir)
+        assert [h['subject'] for h in history] == [subject, "Second"]
+        assert sorted(c['path'] for c in history[0]['changes']) == \
+            ['a\tb.csv', 'c d.csv']
+        assert history[1]['changes'] == [
+            {'path': 'c d.csv', 'added': '1', 'deleted': '1'}
+        ]
+        assert len(list(iter_history(gitdir))) == 2
+    finally:
+        shutil.rmtree(gitdir)
+
+def test_blob_diffs():
+    """
+    Diffs of changed blobs, without scratch files left behind
+    """
+    import subprocess
+    from dgitcore.datasets.history import get_history, get_diffs
+    commits = [("Version 1", {'data.csv': "a,b\n1,2\n"}),
+               ("Version 2", {'data.csv': "a,b\n1,3\n"})]
+    gitdir = create_git_repo(commits)
+    scratch = tempfile.mkdtemp()
+    tempdir = tempfile.tempdir
+    try:
+        # Same content, different mode
+        subprocess.check_output(['git', 'update-index', '--chmod=+x', 'data.csv'],
+                                cwd=gitdir)
+        subprocess.check_output(['git', '-c', 'user.name=test',
+                                 '-c', 'user.email=test@example.com',
+                                 'commit', '-q', '-m', 'Mode'], cwd=gitdir)
+
+        tempfile.tempdir = scratch
+        for workers in [1, 2]:
+            history = get_history(gitdir)
+            get_diffs(history, gitdir, workers=workers, cache=False)
+            assert history[1]['changes'][0]['diff']['data']['->'][1] == 1
+            assert 'diff' not in history[2]['changes'][0]
+            assert os.listdir(scratch) == []
+    finally:
+        tempfile.tempdir = tempdir
+        shutil.rmtree(scratch)
+        shutil.rmtree(gitdir)
+
+def test_diff_cache():
+    """
+    Cached diffs are not computed again and the cache stays within
+    its size bound
+    """
+    from dgitcore.plugins.common import Key
+    from dgitcore.datasets.diffcache import DiffCache
+    from dgitcore.datasets.history import get_history, get_diffs
+    from dgitcore.plugins.repomanager import Repo
+    commits = [("Version {}".format(i),
+                {'data.csv': "a,b\n1,{}\n".format(i)}) for i in range(4)]
+    gitdir = create_git_repo(commits)
+    repo = Repo('test', 'diffs')
+    repo.rootdir = gitdir
+    try:
+        history = get_history(gitdir)
+        cache = DiffCache(repo)
+        get_diffs(history, gitdir, cache=cache)
+        assert (cache.hits, cache.added) == (0, 3)
+        expected = get_change_diffs(history)
+
+        history = get_history(gitdir)
+        cache = DiffCache(repo)
+        get_diffs(history, gitdir, cache=cache)
+        assert (cache.hits, cache.added) == (3, 0)
+        assert get_change_diffs(history) == expected
+        assert cache.cachedir == os.path.join(gitdir, '.dgit', 'diffs')
+
+        # Each entry is about 1KB and the bound is 4KB
+        key = Key(name="test", version="v0")
+        cache = DiffCache(repo, maxsize=4.0/1024)
+        for i in range(10):
+            cache.update(("a", str(i)), key, "x" * 1000)
+            os.utime(cache.path(("a", str(i)), key), (i, i))
+        cache.prune()
+        sizes = [os.path.getsize(os.path.join(root, f))
+                 for root, dirs, files in os.walk(cache.cachedir)
+                 for f in files]
+        assert sum(sizes) <= 4096
+        # The most recently used entries are kept
+        assert cache.lookup(("a", "9"), key) == (True, "x" * 1000)
+        assert cache.lookup(("a", "0"), key) == (False, None)
+
+        # Nothing is removed (or scanned) unless entries were added
+        def entries():
+            return sum(len(files) for root, dirs, files in os.walk(cache.cachedir))
+        cache = DiffCache(repo, maxsize=0)
+        cache.prune()
+        assert entries() > 0
+        cache.update(("a", "10"), key, "x")
+        cache.prune()
+        assert entries() == 0
+    finally:
+        shutil.rmtree(gitdir)
+
+def test_history_shallow():
+    """
+    Shallow boundary of the history in a bare repo
+    """
+    import subprocess
+    from dgitcore.datasets.history import _history_state
+    commits = [("Version {}".format(i),
+                {'data.csv': "a,b\n1,{}\n".format(i)}) for i in range(3)]
+    gitdir = create_git_repo(commits)
+    clonedir = tempfile.mkdtemp()
+    try:
+        subprocess.check_output(['git', 'clone', '-q', '--bare', '--depth', '1',
+                                 'file://' + gitdir, clonedir])
+        (refs, shallow) = _history_state(clonedir)
+        assert shallow == list(refs.keys())
+        assert _history_state(gitdir)[1] == []
+    finally:
+        shutil.rmtree(clonedir)
+        shutil.rmtree(gitdir)
+
+def test_permalinks():
+    """
+    Permalinks point to the last commit of each path and follow HEAD
+    """
+    import subprocess
+    repo = basic_repo_lookup('simple1')
+    commits = [("First", {'a b.csv': "a\n1\n", 'sub/x.csv': "x\n1\n"}),
+               ("Second", {'sub/y.csv': "y\n1\n"}),
+               ("Third", {'a b.csv': "a\n2\n"})]
+    gitdir = create_git_repo(commits)
+    def git(*args):
+        return subprocess.check_output(['git', '-c', 'user.name=test',
+                                         '-c', 'user.email=test@example.com'] + list(args),
+                                        cwd=gitdir).decode('utf-8').strip()
+    def expected(relpath):
+        return (relpath, "https://github.com/test/perm/blob/{}/{}".format(
+            git('log', '-n', '1', '--format=%H', '--', relpath), relpath))
+
+    try:
+        git('remote', 'add', 'origin', 'git@github.com:test/perm.git')
+        relpaths = ['a b.csv', os.path.join('sub', 'x.csv'), 'sub', '.']
+        paths = [os.path.join(gitdir, p) for p in relpaths]
+        links = repo.manager.permalinks(repo, paths)
+        assert [links[p] for p in paths] == [expected(p) for p in relpaths]
+        assert links[paths[0]] != links[paths[1]]
+
+        # A new commit moves HEAD and the cached commits are dropped
+        with open(paths[1], 'w') as fd:
+            fd.write("x\n2\n")
+        git('commit', '-q', '-a', '-m', "Fourth")
+        links = repo.manager.permalinks(repo, paths)
+        assert [links[p] for p in paths] == [expected(p) for p in relpaths]
+        assert links[paths[1]][1].split("/")[6] == git('rev-parse', 'HEAD')
+        assert repo.manager.permalink(repo, paths[0]) == expected('a b.csv')
+    finally:
+        shutil.rmtree(gitdir)
+
+def get_change_diffs(history):
+    return [[c.get('diff') for c in h['changes']] for h in history]
+
+def test_diff_workers():
+    """
+    Diffs computed by the workers are those computed in this process
+    """
+    from dgitcore.datasets import history as dhistory
+    commits = [("Version {}".format(i),
+                {'data.csv': "a,b\n1,{}\n".format(i)}) for i in range(4)]
+    gitdir = create_git_repo(commits)
+    try:
+        history = dhistory.get_history(gitdir)
+        dhistory.get_diffs(history, gitdir, workers=1, cache=False)
+        expected = get_change_diffs(history)
+        assert all(d[0] is not None for d in expected[1:])
+
+        history = dhistory.get_history(gitdir)
+        dhistory.get_diffs(history, gitdir, workers=2, cache=False)
+        assert get_change_diffs(history) == expected
+
+        # Workers that cannot start fall back to this process
+        def failing_executor(*args, **kwargs):
+            raise OSError("Cannot start")
+        executor = dhistory.ProcessPoolExecutor
+        dhistory.ProcessPoolExecutor = failing_executor
+        try:
+            history = dhistory.get_history(gitdir)
+            dhistory.get_diffs(history, gitdir, workers=2, cache=False)
+        finally:
+            dhistory.ProcessPoolExecutor = executor
+        assert get_change_diffs(history) == expected
+    finally:
+        shutil.rmtree(gitdir)
+
+def test_diff_worker_failures():
+    """
+    Diffs that fail in a worker, or whose worker dies, are left unset
+    and are not computed again in this process
+    """
+    import subprocess
+    from dgitcore.datasets import history as dhistory
+    commits = [("Version {}".format(i),
+                {'data.csv': "a,b\n1,{}\n".format(i)}) for i in range(4)]
+    gitdir = create_git_repo(commits)
+    newest = subprocess.check_output(['git', 'rev-parse', 'HEAD:data.csv'],
+                                     cwd=gitdir).decode('utf-8').strip()
+
+    def out_of_memory():
+        raise MemoryError()
+    def killed():
+        os._exit(1)
+
+    parent = os.getpid()
+    diff_blobs = dhistory._diff_blobs
+    try:
+        for failure in [out_of_memory, killed]:
+            # The diff of the most recent change fails in the worker
+            attempts = []
+            def failing_diff_blobs(reader, handler, blobs, path, scratch):
+                if os.getpid() == parent:
+                    attempts.append(blobs)
+                elif blobs[1] == newest:
+                    failure()
+                return diff_blobs(reader, handler, blobs, path, scratch)
+
+            dhistory._diff_blobs = failing_diff_blobs
+            try:
+                history = dhistory.get_history(gitdir)
+                dhistory.get_diffs(history, gitdir, workers=2, cache=False)
+            finally:
+                dhistory._diff_blobs = diff_blobs
+
+            diffs = get_change_diffs(history)
+            assert diffs[-1][0] is None
+            assert attempts == []
+            if failure == out_of_memory:
+                assert diffs[1][0] is not None and diffs[2][0] is not None
+    finally:
+        shutil.rmtree(gitdir)
+
+def test_diff_limits():
+    """
+    The limits on diffs leave the older changes without a diff
+    """
+    from dgitcore.datasets.history import get_history, get_diffs
+    commits = [("Version {}".format(i),
+                {'data.csv': "a,b\n1,{}\n".format(i)}) for i in range(4)]
+    gitdir = create_git_repo(commits)
+    try:
+        for workers in [1, 2]:
+            history = get_history(gitdir)
+            get_diffs(history, gitdir, workers=workers, maxdiffs=1, cache=False)
+            diffs = get_change_diffs(history)
+            assert diffs[-1][0] is not None
+            assert diffs[1][0] is None and diffs[2][0] is None
+
+            history = get_history(gitdir)
+            get_diffs(history, gitdir, workers=workers, budget=0, cache=False)
+            assert all(d[0] is None for d in get_change_diffs(history))
+    finally:
+        shutil.rmtree(gitdir)
+
+def test_async_status():
+    """
+    asyncio API
+    """
+    from dgitcore import api_async
+    repos = [basic_repo_lookup(name) for name in repo_configurations]
+
+    async def run():
+        return await asyncio.gather(*[api_async.status(r) for r in repos])
+
+    results = asyncio.run(run())
+    assert len(results) == 3
+    for r in results:
+        basic_result_check(r)
+
+def test_async_cancel():
+    """
+    Cancelling an asynchronous call kills the git process and the
+    processes it started
+    """
+    import subprocess, time, signal
+    from dgitcore import api_async
+    repo = basic_repo_lookup('simple1')
+    hooksdir = subprocess.check_output(['git', 'rev-parse', '--git-path', 'hooks'],
+                                       cwd=repo.rootdir).decode('utf-8').strip()
+    hook = os.path.join(repo.rootdir, hooksdir, 'pre-commit')
+    piddir = tempfile.mkdtemp()
+    with open(hook, 'w') as fd:
+        fd.write("#!/bin/sh\necho $PPID > {0}/git.pid\necho $$ > {0}/hook.pid\nexec sleep 30\n".format(piddir))
+    os.chmod(hook, 0o755)
+
+    def readpid(name):
+        with open(os.path.join(piddir, name)) as fd:
+            return int(fd.read())
+
+    def running(pid):
+        # Killed processes may remain as zombies until reaped
+        try:
+            with open('/proc/{}/stat'.format(pid)) as fd:
+                return fd.read().rsplit(')', 1)[1].split()[0] != 'Z'
+        except IOError:
+            return False
+
+    async def run():
+        task = asyncio.ensure_future(api_async.commit(repo, ['--allow-empty', '-m', 'Cancelled']))
+        for i in range(100):
+            if os.path.exists(os.path.join(piddir, 'hook.pid')):
+                break
+            await asyncio.sleep(0.1)
+        task.cancel()
+        with assert_raises(asyncio.CancelledError):
+            await task
+
+    try:
+        start = time.time()
+        asyncio.run(run())
+        assert time.time() - start < 20
+        assert not running(readpid('git.pid'))
+        assert not running(readpid('hook.pid'))
+    finally:
+        try:
+            os.kill(readpid('hook.pid'), signal.SIGKILL)
+        except Exception:
+            pass
+        os.unlink(hook)
+        shutil.rmtree(piddir)
+
+def test_async_serialized():
+    """
+    Asynchronous operations on the same repo run one at a time. A
+    clone is serialized with the operations on the repo it creates.
+    """
+    import time, threading
+    from dgitcore import api_async, datasets
+    events = []
+    guard = threading.Lock()
+
+    def operation(name, *args, **kwargs):
+        with guard:
+            events.append(('start', name))
+        time.sleep(0.3)
+        with guard:
+            events.append(('end', name))
+
+    def fake_init(username, reponame, *args):
+        operation('init ' + reponame)
+
+    def fake_clone(url, options=None):
+        operation('clone ' + url)
+
+    async def run():
+        await asyncio.gather(
+            api_async.init('test', 'serialrepo', 'git+s3'),
+            api_async.clone('git@localhost:elsewhere/serialrepo.git'),
+            api_async.clone('git@localhost:elsewhere/otherrepo.git'))
+
+    (init, clone) = (datasets.init, datasets.clone)
+    datasets.init = fake_init
+    datasets.clone = fake_clone
+    try:
+        asyncio.run(run())
+    finally:
+        (datasets.init, datasets.clone) = (init, clone)
+
+    def overlap(a, b):
+        return events.index(('start', b)) < events.index(('end', a)) and \
+            events.index(('start', a)) < events.index(('end', b))
+
+    init = 'init serialrepo'
+    clone = 'clone git@localhost:elsewhere/serialrepo.git'
+    other = 'clone git@localhost:elsewhere/otherrepo.git'
+    assert not overlap(init, clone)
+    assert overlap(init, other) or overlap(clone, other)
+
 def test_repo_drop():
     """
     Drop repo
@@ -255,8 +852,11 @@ def test_simple_add_files():
         filenames = [r['relativepath'] for r in package['resources']]
         assert basename in filenames
 
-        # TODO
         # Check SHA checksum...
+        resource = [r for r in package['resources']
+                    if r['relativepath'] == basename][0]
+        expected = hashlib.sha256(open(filename, 'rb').read()).hexdigest()
+        assert resource['sha256'] == expected
 
         # Check if it is showing up in the status command.
         result = api.status(repo)
@@ -289,6 +889,438 @@ def test_simple_add_files():
     os.unlink(filename)
 
 
+def test_bulk_add_files():
+    """
+    Add files in bulk
+    """
+
+    repo = basic_repo_lookup('simple1')
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        entries = []
+        for i in range(3):
+            filename = os.path.join(tempdir, "bulk{}.csv".format(i))
+            with open(filename, 'w') as fd:
+                fd.write("a,b\n{},{}\n".format(i, i+1))
+            entries.append({
+                'path': filename,
+                'targetdir': 'bulk'
+            })
+
+        count = api.add_many(repo, entries)
+        assert count == 3
+
+        # Adding the same files again should be a no-op
+        count = api.add_many(repo, entries)
+        assert count == 0
+
+        rootdir = repo.rootdir
+        package = json.loads(open(os.path.join(rootdir, 'datapackage.json')).read())
+        filenames = [r['relativepath'] for r in package['resources']]
+        for i in range(3):
+            relativepath = os.path.join('bulk', "bulk{}.csv".format(i))
+            assert relativepath in filenames
+            assert os.path.exists(os.path.join(rootdir, relativepath))
+
+        result = api.status(repo)
+        basic_result_check(result)
+        assert "bulk/bulk0.csv" in result['message']
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_large_file_add():
+    """
+    Large files go to the object store and only a pointer is committed
+    """
+
+    repo = basic_repo_lookup('simple1')
+
+    tempdir = tempfile.mkdtemp()
+    repo.options['large-file-threshold'] = 100
+    try:
+        filename = os.path.join(tempdir, "large.csv")
+        content = "a,b\n" + "1,2\n" * 100
+        with open(filename, 'w') as fd:
+            fd.write(content)
+
+        count = api.add_many(repo, [{ 'path': filename, 'targetdir': 'large'}])
+        assert count == 1
+
+        sha256 = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        r = repo.find_resource('large/large.csv')
+        assert r['sha256'] == sha256
+        assert r['size'] == len(content)
+        assert r['storage'] == 'objectstore'
+
+        # The repo only has the pointer. The content is read from the
+        # store.
+        path = os.path.join(repo.rootdir, 'large', 'large.csv')
+        assert os.path.getsize(path) < 200
+        content_path = api.materialize(repo, 'large/large.csv')
+        assert content_path != path
+        assert open(content_path).read() == content
+
+        # The stored object does not change with the source, whatever
+        # the ingest mode
+        filename = os.path.join(tempdir, "linked.csv")
+        with open(filename, 'w') as fd:
+            fd.write(content + "3,4\n")
+        count = api.add_many(repo, [{ 'path': filename, 'targetdir': 'large'}],
+                             ingest_mode='hardlink')
+        assert count == 1
+        with open(filename, 'a') as fd:
+            fd.write("5,6\n")
+        content_path = api.materialize(repo, 'large/linked.csv')
+        assert open(content_path).read() == content + "3,4\n"
+    finally:
+        del repo.options['large-file-threshold']
+        shutil.rmtree(tempdir)
+
+def test_chunked_large_file_add():
+    """
+    Versions of chunked large files share the unchanged chunks
+    """
+
+    repo = basic_repo_lookup('simple1')
+
+    tempdir = tempfile.mkdtemp()
+    repo.options['large-file-threshold'] = 100
+    repo.options['large-file-chunking'] = True
+    try:
+        filename = os.path.join(tempdir, "chunked.csv")
+        rows = ["{},{}\n".format(i, i * i) for i in range(100000)]
+        for version in range(2):
+            if version == 1:
+                rows[50000] = "changed,row\n"
+            content = "".join(rows)
+            with open(filename, 'w') as fd:
+                fd.write(content)
+
+            count = api.add_many(repo, [{ 'path': filename, 'targetdir': 'chunked'}])
+            assert count == 1
+
+            r = repo.find_resource('chunked/chunked.csv')
+            sha256 = hashlib.sha256(content.encode('utf-8')).hexdigest()
+            assert r['sha256'] == sha256
+            assert r['manifest'].startswith('manifests')
+
+            content_path = api.materialize(repo, 'chunked/chunked.csv')
+            assert open(content_path).read() == content
+    finally:
+        del repo.options['large-file-threshold']
+        del repo.options['large-file-chunking']
+        shutil.rmtree(tempdir)
+
+def test_stager_failure():
+    """
+    A failure to stage is reported and does not block the producer
+    """
+    import threading
+    from dgitcore.datasets.ingest import Stager
+
+    class FailingManager(object):
+        def stage_files(self, repo, paths):
+            raise Exception("stage failed")
+
+    class FakeRepo(object):
+        manager = FailingManager()
+
+    for count in [1, 2, 3]:
+        stager = Stager(FakeRepo(), 2)
+        stager.start()
+        errors = []
+        def produce():
+            try:
+                for i in range(count):
+                    stager.put("file{}".format(i))
+            except Exception as e:
+                errors.append(e)
+            try:
+                stager.close()
+            except Exception as e:
+                errors.append(e)
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        producer.join(10)
+        assert not producer.is_alive()
+        assert len(errors) > 0
+
+def test_stage_batches():
+    """
+    Files are staged in batches of ingest-stage-batch
+    """
+    repo = basic_repo_lookup('simple1')
+    manager = repo.manager
+    batches = []
+    def stage_files(repo, paths):
+        batches.append(len(paths))
+        return stage(repo, paths)
+
+    tempdir = tempfile.mkdtemp()
+    stage = manager.stage_files
+    manager.stage_files = stage_files
+    repo.options['ingest-stage-batch'] = 2
+    try:
+        entries = []
+        for i in range(5):
+            filename = os.path.join(tempdir, "batch{}.csv".format(i))
+            with open(filename, 'w') as fd:
+                fd.write("a,b\n{},{}\n".format(i, i+1))
+            entries.append({'path': filename, 'targetdir': 'batches'})
+        assert api.add_many(repo, entries) == 5
+        assert batches == [2, 2, 1]
+    finally:
+        manager.stage_files = stage
+        del repo.options['ingest-stage-batch']
+        shutil.rmtree(tempdir)
+
+def test_commit_many():
+    """
+    Commit files without going through the checkout
+    """
+
+    repo = basic_repo_lookup('simple1')
+
+    result = api.commit(repo, ['-a', '-m', 'Commit staged files'])
+    basic_result_check(result)
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        entries = []
+        for i in range(3):
+            filename = os.path.join(tempdir, "direct{}.csv".format(i))
+            with open(filename, 'w') as fd:
+                fd.write("a,b\n{},{}\n".format(i, i+1))
+            entries.append({
+                'path': filename,
+                'targetdir': 'direct'
+            })
+
+        count = api.commit_many(repo, entries, "Direct commit")
+        assert count == 3
+        assert repo.find_resource('direct/direct0.csv') is not None
+
+        # The checkout is updated when it is used next
+        result = api.status(repo)
+        basic_result_check(result)
+        assert "direct" not in result['message']
+        assert os.path.exists(os.path.join(repo.rootdir, 'direct', 'direct0.csv'))
+
+        result = api.log(repo)
+        assert "Direct commit" in result['message']
+
+        count = api.commit_many(repo, entries, "Direct commit")
+        assert count == 0
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_commit_many_large_file():
+    """
+    The committed package records the large files of commit_many
+    """
+    import subprocess
+    repo = basic_repo_lookup('simple1')
+
+    tempdir = tempfile.mkdtemp()
+    repo.options['large-file-threshold'] = 100
+    try:
+        filename = os.path.join(tempdir, "directlarge.csv")
+        content = "a,b\n" + "7,8\n" * 100
+        with open(filename, 'w') as fd:
+            fd.write(content)
+
+        count = api.commit_many(repo, [{'path': filename, 'targetdir': 'direct'}],
+                                "Direct large commit", refresh=True)
+        assert count == 1
+
+        # Both the checkout and the commit have the store fields
+        committed = subprocess.check_output(['git', 'show', 'HEAD:datapackage.json'],
+                                            cwd=repo.rootdir)
+        for package in [json.load(open(os.path.join(repo.rootdir, 'datapackage.json'))),
+                        json.loads(committed.decode('utf-8'))]:
+            r = [r for r in package['resources']
+                 if r['relativepath'] == 'direct/directlarge.csv'][0]
+            assert r['storage'] == 'objectstore'
+            assert r['size'] == len(content)
+
+        # A fresh load of the repo can read the content
+        api.initialize()
+        repo = basic_repo_lookup('simple1')
+        content_path = api.materialize(repo, 'direct/directlarge.csv')
+        assert open(content_path).read() == content
+    finally:
+        repo.options.pop('large-file-threshold', None)
+        shutil.rmtree(tempdir)
+
+def test_history_cache():
+    """
+    History is cached and extended with new commits
+    """
+    from dgitcore.datasets.history import get_history, get_repo_history
+    repo = basic_repo_lookup('simple1')
+
+    history = get_repo_history(repo)
+    assert history == get_history(repo.rootdir)
+    assert get_repo_history(repo) == history
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tempdir, "history.csv")
+        with open(filename, 'w') as fd:
+            fd.write("a,b\n1,2\n")
+        api.commit_many(repo, [{'path': filename}], "History commit")
+    finally:
+        shutil.rmtree(tempdir)
+
+    updated = get_repo_history(repo)
+    assert len(updated) == len(history) + 1
+    assert updated[-1]['subject'] == "History commit"
+    assert updated == get_history(repo.rootdir)
+
+def push_sample_files(repo, files, message):
+    """
+    Commit files ({relativepath: content}) to the repo and push them
+    to its server-side repo. Returns the path of the server-side repo.
+    """
+    tempdir = tempfile.mkdtemp()
+    try:
+        entries = []
+        for relativepath, content in files.items():
+            (targetdir, basename) = os.path.split(relativepath)
+            filename = os.path.join(tempdir, basename)
+            with open(filename, 'w') as fd:
+                fd.write(content)
+            entries.append({'path': filename, 'targetdir': targetdir or '.'})
+        api.commit_many(repo, entries, message, refresh=True)
+    finally:
+        shutil.rmtree(tempdir)
+
+    basic_result_check(api.push(repo))
+    return get_remote_path(api.remote(repo, ['-v']))
+
+def test_clone_options():
+    """
+    Shallow, partial and single-branch clones
+    """
+    import subprocess
+    from dgitcore.datasets.history import is_partial, get_history, get_diffs
+    repo = basic_repo_lookup('simple1')
+    push_sample_files(repo, {'history.csv': "a,b\n1,3\n"}, "Clone commit")
+    server = push_sample_files(repo, {'history.csv': "a,b\n1,4\n"}, "Clone commit")
+
+    clone = api.clone(server, {
+        'clone-depth': 2,
+        'clone-filter': 'blob:none',
+        'clone-single-branch': True
+    })
+    try:
+        assert clone.rootdir != repo.rootdir
+        output = subprocess.check_output(['git', 'rev-parse', '--is-shallow-repository'],
+                                         cwd=clone.rootdir)
+        assert output.strip() == b'true'
+        assert is_partial(clone.rootdir)
+        output = subprocess.check_output(['git', 'branch', '-r'], cwd=clone.rootdir)
+        assert b'origin/master' in output
+
+        history = get_history(clone.rootdir)
+        assert [h['subject'] for h in history] == ["Clone commit"] * 2
+        get_diffs(history, clone.rootdir, cache=False)
+        change = [c for c in history[-1]['changes'] if c['path'] == 'history.csv'][0]
+        assert change['diff'] is not None
+    finally:
+        api.drop(clone)
+
+def test_sparse_checkout():
+    """
+    Sparse clones materialize only the selected resources
+    """
+    import subprocess
+    from dgitcore.datasets.package import write_package
+    repo = basic_repo_lookup('simple1')
+    server = push_sample_files(repo, {'keep/a.csv': "a\n1\n", 'skip/b.csv': "b\n1\n"},
+                               "Sparse commit")
+    clone = api.clone(server, {'clone-sparse': ['keep/*']})
+    try:
+        def materialized():
+            return dict([(r['relativepath'], r['materialized'])
+                         for r in clone.package['resources']])
+        def exists(relativepath):
+            return os.path.exists(os.path.join(clone.rootdir, relativepath))
+
+        assert exists('keep/a.csv') and not exists('skip/b.csv')
+        assert materialized()['keep/a.csv'] and not materialized()['skip/b.csv']
+
+        # The selection is kept in the git directory
+        output = subprocess.check_output(['git', 'rev-parse', '--git-path',
+                                          'info/dgit-sparse'], cwd=clone.rootdir)
+        sparsefile = os.path.join(clone.rootdir, output.decode('utf-8').strip())
+        assert open(sparsefile).read() == "keep/*\n"
+
+        # materialized is not written to datapackage.json
+        clone.mark_package_modified()
+        write_package(clone)
+        content = open(os.path.join(clone.rootdir, 'datapackage.json')).read()
+        assert 'materialized' not in content
+
+        # The selection is reapplied on pull
+        push_sample_files(repo, {'keep/c.csv': "c\n1\n", 'skip/d.csv': "d\n1\n"},
+                          "Sparse commit")
+        basic_result_check(api.pull(clone))
+        assert exists('keep/c.csv') and not exists('skip/d.csv')
+        assert materialized()['keep/c.csv'] and not materialized()['skip/d.csv']
+
+        # Files added later are part of the selection
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'e.csv')
+            with open(filename, 'w') as fd:
+                fd.write("e\n1\n")
+            api.add(clone, [filename], 'skip')
+        finally:
+            shutil.rmtree(tempdir)
+        output = subprocess.check_output(['git', 'diff', '--cached', '--name-only'],
+                                         cwd=clone.rootdir)
+        assert b'skip/e.csv' in output.split()
+        assert exists('skip/e.csv') and not exists('skip/d.csv')
+        assert 'skip/e.csv' in open(sparsefile).read()
+
+        # Everything is materialized without a selection
+        api.sparse_checkout(clone, None)
+        assert exists('skip/b.csv') and exists('skip/d.csv')
+        assert not os.path.exists(sparsefile)
+    finally:
+        api.drop(clone)
+
+def test_async_pull():
+    """
+    An asynchronous pull reloads the package and extends a sparse
+    checkout
+    """
+    from dgitcore import api_async
+    repo = basic_repo_lookup('simple1')
+    server = push_sample_files(repo, {'keep/a.csv': "a\n1\n", 'skip/b.csv': "b\n1\n"},
+                               "Async commit")
+    clone = api.clone(server, {'clone-sparse': ['keep/*']})
+    try:
+        assert clone.find_resource('keep/a.csv') is not None
+        push_sample_files(repo, {'keep/c.csv': "c\n1\n", 'skip/d.csv': "d\n1\n"},
+                          "Async commit")
+
+        result = asyncio.run(api_async.pull(clone))
+        basic_result_check(result)
+        resources = dict([(r['relativepath'], r) for r in clone.package['resources']])
+        assert resources['keep/c.csv']['materialized']
+        assert not resources['skip/d.csv']['materialized']
+        assert os.path.exists(os.path.join(clone.rootdir, 'keep', 'c.csv'))
+        assert not os.path.exists(os.path.join(clone.rootdir, 'skip', 'd.csv'))
+
+        entry = clone.manager.catalog.search(clone.username, clone.reponame)[0]
+        assert entry['resources'] == len(resources)
+    finally:
+        api.drop(clone)
+
 @with_setup(None, workspace_teardown)
 def test_end_group2():
     """